@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks for the scanner, scheduler and transcoder hot paths.
+
+Synthetic source and destination trees are generated in a temp folder and the stand-in
+executables in benchmarks/fakebin replace ffmpeg, ffprobe and x264, so no real media or
+encoder is needed. Results are written as JSON and can be compared with a baseline run:
+
+	python benchmarks/bench.py --sizes 1000,10000 --output results.json
+	python benchmarks/bench.py --sizes 1000,10000 --baseline results.json
+
+With --baseline the exit code is 1 if any benchmark got slower than the tolerance allows.
+"""
+import getopt
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKEBIN_DIR = os.path.join(BENCH_DIR, 'fakebin')
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+os.environ['PATH'] = FAKEBIN_DIR + os.pathsep + os.environ.get('PATH', '')
+
+from vidscan import common
+from vidscan.Scanner import SourceScanner
+from vidscan.ProbeCache import ProbeCache
+from vidscan.Scheduler import Scheduler
+from vidscan.Transcoder import FFmpegTranscoder
+
+logging.getLogger().addHandler(logging.NullHandler())
+
+EXTENSIONS = ['avi', 'mkv', 'mp4', 'm4v']
+FILES_PER_FOLDER = 100
+INSTANCES = ['bench1', 'bench2', 'bench3']
+
+def usage():
+	print('''
+Usage: python benchmarks/bench.py [options]
+
+	--sizes N[,N...]		Library sizes to benchmark (default 1000)
+	--scan-jobs N			Concurrent probes for the scan benchmark (default 4)
+	--transcodes N			Number of supervised fake encodes (default 5)
+	--progress-blocks N		Progress updates written by each fake encode (default 2000)
+	--output FILE			Write the results to FILE (default bench_output.json)
+	--baseline FILE			Compare with the results in FILE
+	--tolerance RATIO		Allowed slowdown against the baseline (default 0.25)
+	--keep				Keep the generated trees
+'''.strip())
+
+class Quiet(object):
+	"""
+	Swallow the console output of the code under test
+	"""
+	def __enter__(self):
+		self.stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+
+	def __exit__(self, *args):
+		sys.stdout.close()
+		sys.stdout = self.stdout
+
+def cpu_time():
+	"""
+	CPU seconds used by this process, not counting child processes
+	"""
+	if resource:
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		return usage.ru_utime + usage.ru_stime
+	return time.clock()
+
+def measure(results, name, func, items=None):
+	wall_start, cpu_start = time.time(), cpu_time()
+	with Quiet():
+		value = func()
+	wall, cpu = time.time() - wall_start, cpu_time() - cpu_start
+
+	result = {'seconds': round(wall, 4), 'cpu_seconds': round(cpu, 4)}
+	if items:
+		result['items'] = items
+		result['per_item_ms'] = round(wall * 1000.0 / items, 4)
+	results[name] = result
+	print('%-40s %10.3fs wall %10.3fs cpu' % (name, wall, cpu))
+	return value
+
+def make_source_tree(root, size):
+	"""
+	size whitelisted video files spread over folders, plus samples and other files the scanner must skip
+	"""
+	for index in range(size):
+		folder = os.path.join(root, 'show%04d' % (index // FILES_PER_FOLDER))
+		if index % FILES_PER_FOLDER == 0:
+			os.makedirs(folder)
+			with open(os.path.join(folder, 'info.nfo'), 'w') as f:
+				f.write('nfo')
+			with open(os.path.join(folder, 'episode-sample.avi'), 'w') as f:
+				f.write('sample')
+		with open(os.path.join(folder, 'episode%06d.%s' % (index, EXTENSIONS[index % len(EXTENSIONS)])), 'w') as f:
+			f.write(str(index))
+
+def make_destination_tree(root, videofiles):
+	"""
+	Outputs and status journals of several instances for every other source file
+	"""
+	journals = [open(os.path.join(root, '_status.' + instance + '.jsonl'), 'w') for instance in INSTANCES]
+	for journal in journals:
+		journal.write(common.json_compact({'journal': 'bench', 'created': time.time()}) + '\n')
+
+	content = b'\0' * 1024
+	md5 = hashlib.md5(content).hexdigest()
+	for index, videofile in enumerate(videofiles):
+		if index % 2:
+			continue
+		relpath = os.path.splitext(videofile.relpath)[0] + '.mp4'
+		fullpath = os.path.join(root, relpath)
+		if not os.path.isdir(os.path.dirname(fullpath)):
+			os.makedirs(os.path.dirname(fullpath))
+		with open(fullpath, 'wb') as f:
+			f.write(content)
+
+		status = {
+			'videofile': videofile,
+			'destinationfile': {'status': 'SUCCESS', 'relpath': relpath, 'md5': md5,
+				'timestamp_start': 1400000000 + index, 'timestamp_end': 1400000100 + index}
+		}
+		journals[index % len(journals)].write(common.json_compact(status) + '\n')
+
+	for journal in journals:
+		journal.close()
+
+def bench_size(workdir, size, scan_jobs, num_transcodes, progress_blocks):
+	results = {}
+	srcdir = os.path.join(workdir, 'src%d' % size)
+	dstdir = os.path.join(workdir, 'dst%d' % size)
+	os.makedirs(dstdir)
+	make_source_tree(srcdir, size)
+
+	"""
+	Scanner
+	"""
+	result = measure(results, 'scan', lambda: SourceScanner(srcdir, None, 1, None).run(), size)
+	measure(results, 'scan_jobs%d' % scan_jobs, lambda: SourceScanner(srcdir, None, scan_jobs, None).run(), size)
+
+	cache_path = os.path.join(workdir, 'probecache%d.json' % size)
+	with Quiet():
+		SourceScanner(srcdir, None, scan_jobs, ProbeCache(cache_path, srcdir)).run()
+	measure(results, 'scan_cached', lambda: SourceScanner(srcdir, None, 1, ProbeCache(cache_path, srcdir)).run(), size)
+
+	"""
+	Scheduler
+	"""
+	videofiles = result.videofiles
+	make_destination_tree(dstdir, videofiles)
+	measure(results, 'scheduler_init_cold', lambda: Scheduler(videofiles, dstdir), size)
+	scheduler = measure(results, 'scheduler_init', lambda: Scheduler(videofiles, dstdir), size)
+
+	def drain():
+		picks = 0
+		while scheduler.get_next_videofile() is not None:
+			picks += 1
+		return picks
+	measure(results, 'get_next_videofile', drain, max(1, size // 2))
+
+	"""
+	Transcoder supervision loop
+	"""
+	os.environ['FAKE_FFMPEG_PROGRESS_BLOCKS'] = str(progress_blocks)
+	# Time one ffmpeg run per job. Jobs aren't started through the scheduler so there's nothing to resume from
+	scheduler.checkpoint_interval = 0
+	with Quiet():
+		transcoder = FFmpegTranscoder(dstdir, videofiles, scheduler)
+	jobs = [(videofile,) + tuple(transcoder.get_transcoder_args(videofile)) for videofile in videofiles[:num_transcodes]]
+
+	def supervise():
+		for videofile, transcoder_args, destfullpath in jobs:
+			if not os.path.isdir(os.path.dirname(destfullpath)):
+				os.makedirs(os.path.dirname(destfullpath))
+			transcoder.transcode(videofile, transcoder_args, destfullpath)
+	measure(results, 'transcode_supervision', supervise, max(1, len(jobs) * progress_blocks))
+
+	return results
+
+def compare(results, baseline, tolerance):
+	"""
+	Print the change against the baseline and return the names of benchmarks that regressed
+	"""
+	regressions = []
+	print('\n%-40s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'change'))
+	for size, size_results in sorted(results.items()):
+		for name, result in sorted(size_results.items()):
+			base = baseline.get(size, {}).get(name)
+			if not base:
+				continue
+			key = size + '/' + name
+			change = (result['seconds'] - base['seconds']) / base['seconds'] if base['seconds'] else 0.0
+			# Ignore noise on benchmarks that only take a few milliseconds
+			regressed = change > tolerance and result['seconds'] - base['seconds'] > 0.05
+			print('%-40s %9.3fs %9.3fs %+7.1f%%%s' % (key, base['seconds'], result['seconds'], change * 100, ' REGRESSION' if regressed else ''))
+			if regressed:
+				regressions.append(key)
+	return regressions
+
+def main():
+	sizes = [1000]
+	scan_jobs = 4
+	num_transcodes = 5
+	progress_blocks = 2000
+	output = 'bench_output.json'
+	baseline_file = None
+	tolerance = 0.25
+	keep = False
+	try:
+		optlist, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'sizes=', 'scan-jobs=', 'transcodes=', 'progress-blocks=',
+			'output=', 'baseline=', 'tolerance=', 'keep'])
+		for opt, arg in optlist:
+			if opt in ('-h', '--help'):
+				usage()
+				sys.exit()
+			elif opt == '--sizes':
+				sizes = [int(size) for size in arg.split(',')]
+			elif opt == '--scan-jobs':
+				scan_jobs = int(arg)
+			elif opt == '--transcodes':
+				num_transcodes = int(arg)
+			elif opt == '--progress-blocks':
+				progress_blocks = int(arg)
+			elif opt == '--output':
+				output = arg
+			elif opt == '--baseline':
+				baseline_file = arg
+			elif opt == '--tolerance':
+				tolerance = float(arg)
+			elif opt == '--keep':
+				keep = True
+	except (getopt.GetoptError, ValueError) as e:
+		print('Input error: ' + str(e))
+		usage()
+		sys.exit(2)
+
+	workdir = tempfile.mkdtemp(prefix='vidscan-bench-')
+	results = {}
+	try:
+		for size in sizes:
+			print('# %d files' % size)
+			results[str(size)] = bench_size(workdir, size, scan_jobs, num_transcodes, progress_blocks)
+	finally:
+		if keep:
+			print('Kept generated trees in ' + workdir)
+		else:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	with open(output, 'w') as f:
+		json.dump({
+			'created': int(time.time()),
+			'host': common.gethostname(),
+			'python': platform.python_version(),
+			'results': results
+		}, f, sort_keys=True, indent=4, separators=(',', ': '))
+	print('Results written to ' + output)
+
+	if baseline_file:
+		with open(baseline_file) as f:
+			baseline = json.load(f)['results']
+		regressions = compare(results, baseline, tolerance)
+		if regressions:
+			print('%d benchmark(s) regressed by more than %d%%' % (len(regressions), tolerance * 100))
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
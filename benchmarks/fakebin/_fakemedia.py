@@ -0,0 +1,39 @@
+"""
+Deterministic fake media properties for the stand-in ffmpeg/ffprobe executables.
+Everything is derived from the file name so repeated runs see the same library
+"""
+import hashlib
+import os
+
+VIDEO_STREAMS = [
+	# (ffmpeg -i codec string, ffprobe codec_name, profile, codec_tag_string, codec_tag)
+	('mpeg4 (Advanced Simple Profile) (XVID / 0x44495658)', 'mpeg4', 'Advanced Simple Profile', 'XVID', '0x44495658'),
+	('h264 (High)', 'h264', 'High', '[0][0][0][0]', '0x0000'),
+	('h264 (Main) (avc1 / 0x31637661)', 'h264', 'Main', 'avc1', '0x31637661'),
+	('hevc (Main)', 'hevc', 'Main', '[0][0][0][0]', '0x0000'),
+	('mpeg2video (Main)', 'mpeg2video', 'Main', '[0][0][0][0]', '0x0000'),
+]
+RESOLUTIONS = [(640, 352), (720, 576), (1280, 720), (1920, 1080), (3840, 2160)]
+AUDIO_STREAMS = [
+	# (codec, channel layout, bitrate in kb/s)
+	('aac', 'stereo', 128),
+	('ac3', '5.1(side)', 448),
+	('mp3', 'stereo', 192),
+	('dts', '5.1(side)', 1536),
+	('flac', 'stereo', 900),
+]
+
+def describe(path):
+	seed = int(hashlib.md5(os.path.basename(path).encode('utf-8')).hexdigest(), 16)
+	duration = 600 + seed % 10200
+	return {
+		'video': VIDEO_STREAMS[seed % len(VIDEO_STREAMS)],
+		'resolution': RESOLUTIONS[(seed // 7) % len(RESOLUTIONS)],
+		'audio': AUDIO_STREAMS[(seed // 13) % len(AUDIO_STREAMS)],
+		'duration': duration + (seed % 100) / 100.0,
+		'bitrate': 800 + seed % 8000,
+	}
+
+def format_duration(seconds):
+	centiseconds = int(round(seconds * 100))
+	return '%02d:%02d:%02d.%02d' % (centiseconds // 360000, centiseconds // 6000 % 60, centiseconds // 100 % 60, centiseconds % 100)
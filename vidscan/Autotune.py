@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import subprocess
+import multiprocessing
+
+import common
+from common import AppError, AppLogger
+
+log = AppLogger(__name__)
+
+"""
+Frame sizes of the synthetic clip encoded for each resolution class
+"""
+BENCHMARK_SIZES = {
+	'SD': '720x576',
+	'HD': '1280x720',
+	'FHD': '1920x1080',
+	'UHD': '3840x2160'
+}
+BENCHMARK_RATE = 25
+BENCHMARK_SECONDS = 2
+# Settings used for files whose resolution is unknown
+DEFAULT_CLASS = 'FHD'
+
+class Autotuner(object):
+	"""
+	Finds the number of x264 threads per job and the number of parallel jobs that give the highest
+	combined fps on this computer, for each resolution class. The benchmark encodes a short synthetic
+	clip with every candidate split of the cores. Results are cached per host and reused until
+	the core count or the encoder settings change
+	"""
+	def __init__(self, preset, crf, cache_path=None):
+		self.preset = preset
+		self.crf = crf
+		self.cpu_count = multiprocessing.cpu_count()
+		self.cache_path = cache_path or self.default_path()
+		self.classes = {}
+
+	@staticmethod
+	def default_path():
+		return os.path.join(os.path.expanduser('~'), '.vidscan', 'autotune.' + common.gethostname() + '.json')
+
+	def key(self):
+		return {'cpu_count': self.cpu_count, 'preset': self.preset, 'crf': self.crf}
+
+	def load(self):
+		"""
+		Returns True if cached results for the current settings were found
+		"""
+		if not os.path.isfile(self.cache_path):
+			return False
+		try:
+			with open(self.cache_path, 'r') as f:
+				data = json.load(f)
+		except ValueError as e:
+			log.warn('Ignoring invalid autotune cache (' + self.cache_path + '). Error = ' + str(e))
+			return False
+		if data.get('key') != self.key() or set(data.get('classes', {}).keys()) != set(BENCHMARK_SIZES.keys()):
+			return False
+		self.classes = data['classes']
+		return True
+
+	def save(self):
+		folder = os.path.dirname(self.cache_path)
+		if folder and not os.path.isdir(folder):
+			os.makedirs(folder)
+		with open(self.cache_path, 'w') as f:
+			common.json_prettify_to_file({'key': self.key(), 'created': int(time.time()), 'classes': self.classes}, f)
+
+	def candidates(self):
+		"""
+		(threads, jobs) pairs that use every core, from one job with all threads to one thread per job
+		"""
+		result = []
+		threads = self.cpu_count
+		while threads >= 1:
+			pair = (threads, max(1, self.cpu_count // threads))
+			if pair not in result:
+				result.append(pair)
+			threads //= 2
+		if (1, self.cpu_count) not in result:
+			result.append((1, self.cpu_count))
+		return result
+
+	def benchmark(self, size, threads, jobs):
+		"""
+		Encode the test clip in jobs parallel processes. Returns the combined frames per second
+		"""
+		args = ['ffmpeg', '-nostats', '-loglevel', 'error', '-f', 'lavfi',
+			'-i', 'testsrc2=size=' + size + ':rate=' + str(BENCHMARK_RATE), '-t', str(BENCHMARK_SECONDS),
+			'-c:v', 'libx264', '-preset', self.preset, '-crf', str(self.crf), '-threads', str(threads), '-f', 'null', '-']
+		devnull = open(os.devnull, 'wb')
+		start = time.time()
+		try:
+			processes = [subprocess.Popen(args, stdout=devnull, stderr=devnull) for i in range(jobs)]
+			returncodes = [process.wait() for process in processes]
+		finally:
+			devnull.close()
+		elapsed = time.time() - start
+
+		if any(returncodes):
+			raise AppError('Autotune benchmark failed: ' + ' '.join(args))
+		return jobs * BENCHMARK_RATE * BENCHMARK_SECONDS / max(elapsed, 0.001)
+
+	def run(self):
+		log.info('Benchmarking encoder settings for ' + str(self.cpu_count) + ' cores. This only happens once...')
+		self.classes = {}
+		for resolution_class, size in sorted(BENCHMARK_SIZES.items()):
+			best = None
+			for threads, jobs in self.candidates():
+				fps = self.benchmark(size, threads, jobs)
+				log.debug(resolution_class + ': threads = ' + str(threads) + ', jobs = ' + str(jobs) + ', fps = ' + str(int(fps)))
+				if best is None or fps > best['fps']:
+					best = {'threads': threads, 'jobs': jobs, 'fps': round(fps, 1)}
+			self.classes[resolution_class] = best
+			log.info(resolution_class + ': ' + str(best['jobs']) + ' jobs x ' + str(best['threads']) + ' threads (' + str(int(best['fps'])) + ' fps combined)')
+		self.save()
+
+	def tune(self):
+		if not self.load():
+			self.run()
+		return self
+
+	def get(self, resolution_class):
+		"""
+		Settings for a resolution class: threads per job, parallel jobs and the measured combined fps
+		"""
+		return self.classes.get(resolution_class) or self.classes[DEFAULT_CLASS]
+
+	def max_jobs(self):
+		return max(settings['jobs'] for settings in self.classes.values())
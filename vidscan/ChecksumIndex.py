@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import threading
+
+import common
+from common import AppLogger
+from Metrics import registry as metrics
+from Walker import Walker
+
+log = AppLogger(__name__)
+
+class ChecksumIndex(object):
+	"""
+	Persistent md5 index for the video files in the destination folder.
+	Entries are keyed by relpath and remember the size and mtime they were hashed at,
+	so a file is only re-hashed when its stat changes. Hashing happens lazily in get().
+	"""
+	SAVE_INTERVAL = 30
+
+	def __init__(self, destpath):
+		self.destpath = destpath
+		self.index_path = os.path.join(destpath, '_checksums.' + common.gethostname() + '.json')
+		self.entries = {}
+		self.stats = {}
+		self.dirty = False
+		self.last_save = time.time()
+		self.lock = threading.RLock()
+
+		self.load()
+
+	def load(self):
+		if not os.path.isfile(self.index_path):
+			return
+
+		try:
+			with open(self.index_path, 'r') as f:
+				self.entries = json.load(f)
+		except ValueError as e:
+			log.warn('Ignoring invalid checksum index (' + self.index_path + '). Error = ' + str(e))
+			self.entries = {}
+
+	def save(self):
+		with self.lock:
+			if not self.dirty:
+				return
+			common.write_file_atomic(self.index_path, lambda f: json.dump(self.entries, f, sort_keys=True, separators=(',', ':')))
+			self.dirty = False
+			self.last_save = time.time()
+
+	def scan(self):
+		"""
+		Walk the destination folder and record the stat of every video file. Nothing is hashed here
+		"""
+		stats = {}
+		for root, files in Walker(self.destpath).walk():
+			for file in files:
+				extension = os.path.splitext(file)[1][1:]
+				if extension in common.EXTENSION_WHITELIST:
+					fullpath = os.path.join(root, file)
+					try:
+						st = os.stat(fullpath)
+					except OSError:
+						continue
+					stats[self.getrelpath(fullpath)] = [st.st_size, st.st_mtime]
+
+		with self.lock:
+			self.stats = stats
+			for relpath in list(self.entries.keys()):
+				if relpath not in stats:
+					del self.entries[relpath]
+					self.dirty = True
+
+	def getrelpath(self, fullpath):
+		return os.path.relpath(fullpath, self.destpath).replace('\\', '/')
+
+	def __contains__(self, relpath):
+		"""
+		True if the destination file exists. Its stat is refreshed, since the file may have been written,
+		replaced or removed by another instance after the scan, so get() re-hashes a file that changed
+		"""
+		try:
+			st = os.stat(os.path.join(self.destpath, relpath))
+		except OSError:
+			with self.lock:
+				self.stats.pop(relpath, None)
+			return False
+		with self.lock:
+			self.stats[relpath] = [st.st_size, st.st_mtime]
+		return True
+
+	def get(self, relpath):
+		"""
+		Return the md5 of a destination file, hashing it only if the index entry is missing or outdated
+		"""
+		with self.lock:
+			stat = self.stats.get(relpath)
+			if stat is None:
+				return None
+			entry = self.entries.get(relpath)
+			if entry and entry['stat'] == stat:
+				return entry['md5']
+
+		log.debug('Computing checksum of ' + relpath)
+		hash_start = time.time()
+		md5 = common.md5Checksum(os.path.join(self.destpath, relpath))
+		metrics.observe('vidscan_hash_duration_seconds', time.time() - hash_start)
+
+		with self.lock:
+			self.entries[relpath] = {'stat': stat, 'md5': md5}
+			self.dirty = True
+			if time.time() - self.last_save > ChecksumIndex.SAVE_INTERVAL:
+				self.save()
+		return md5
+
+	def set(self, relpath, md5):
+		"""
+		Record the checksum of a freshly written file
+		"""
+		st = os.stat(os.path.join(self.destpath, relpath))
+		stat = [st.st_size, st.st_mtime]
+		with self.lock:
+			self.stats[relpath] = stat
+			self.entries[relpath] = {'stat': stat, 'md5': md5}
+			self.dirty = True
+		self.save()
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import socket
+import threading
+import collections
+import SocketServer
+
+import common
+from common import AppError, AppLogger
+from Scheduler import Scheduler, StatusIndex, DestinationFile, LeaseTracker, CoordinatorError
+
+log = AppLogger(__name__)
+
+"""
+Optional work queue coordinator. Instead of every instance listing the status files and taking lock
+files on the destination share, instances send their claims and status updates to one coordinator
+and ask it for the status changes since their last look. Requests and responses are json objects,
+one per line, over TCP (host:port) or a Unix socket (unix:/path/to/socket).
+Instances still append to their own status journal so the files stay complete if the coordinator goes away
+"""
+
+def parse_address(address):
+	"""
+	Returns (socket family, address) for host:port, :port or unix:path
+	"""
+	if address.startswith('unix:'):
+		return (socket.AF_UNIX, address[len('unix:'):])
+
+	host, sep, port = address.rpartition(':')
+	if not sep or not port.isdigit():
+		raise AppError('Invalid coordinator address: ' + address + '. Expected host:port or unix:path')
+	return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+
+class CoordinatorState(object):
+	"""
+	The latest status of every destination file, in the order they were last updated. Every update
+	gets a sequence number so instances can ask for the updates they haven't seen yet
+	"""
+	# Seconds between reads of the status files, to pick up instances that write files only
+	SYNC_INTERVAL = 30
+
+	def __init__(self, destpath):
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.seq = 0
+		self.status_index = StatusIndex(destpath)
+		self.leases = LeaseTracker(Scheduler.LEASE_TIMEOUT, Scheduler.LEGACY_STALE_TIMEOUT)
+
+	def put(self, instance_name, status):
+		destrelpath = status['destinationfile']['relpath']
+		self.seq += 1
+		self.entries.pop(destrelpath, None)
+		self.entries[destrelpath] = (self.seq, instance_name, status)
+
+	def sync_files(self):
+		"""
+		Load statuses from the status files that are newer than what instances reported
+		"""
+		changed = self.status_index.refresh()
+		with self.lock:
+			for instance_name, videofile, destinationfile in changed:
+				current = self.entries.get(destinationfile.relpath)
+				if current is None or destinationfile.timestamp_start > current[2]['destinationfile']['timestamp_start']:
+					# Round trip through json so entries hold the same plain dicts instances send
+					self.put(instance_name, json.loads(common.json_compact({'videofile': videofile, 'destinationfile': destinationfile})))
+		return len(changed)
+
+	def claim(self, instance_name, status):
+		"""
+		Record an instance starting a job unless another instance holds a live lease on it
+		"""
+		with self.lock:
+			current = self.entries.get(status['destinationfile']['relpath'])
+			if current and current[1] != instance_name and current[2]['destinationfile']['status'] == 'IN_PROGRESS':
+				destinationfile = DestinationFile()
+				destinationfile.update(current[2]['destinationfile'])
+				if not self.leases.is_expired(destinationfile):
+					return False
+			self.put(instance_name, status)
+			return True
+
+	def update(self, instance_name, status):
+		with self.lock:
+			self.put(instance_name, status)
+
+	def changes(self, since):
+		"""
+		Returns the current sequence number and the (instance name, status) pairs updated after since
+		"""
+		with self.lock:
+			statuses = []
+			for destrelpath in reversed(self.entries):
+				seq, instance_name, status = self.entries[destrelpath]
+				if seq <= since:
+					break
+				statuses.append([instance_name, status])
+			statuses.reverse()
+			return (self.seq, statuses)
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		state = self.server.state
+		for line in iter(self.rfile.readline, ''):
+			try:
+				request = json.loads(line)
+				op = request.get('op')
+				if op == 'claim':
+					response = {'ok': True, 'granted': state.claim(request['instance'], request['status'])}
+				elif op == 'update':
+					state.update(request['instance'], request['status'])
+					response = {'ok': True}
+				elif op == 'changes':
+					seq, statuses = state.changes(request.get('since', 0))
+					response = {'ok': True, 'seq': seq, 'statuses': statuses}
+				else:
+					response = {'ok': False, 'error': 'Unknown operation: ' + str(op)}
+			except (ValueError, KeyError, TypeError) as e:
+				response = {'ok': False, 'error': 'Invalid request: ' + str(e)}
+			self.wfile.write(json.dumps(response, separators=(',', ':')) + '\n')
+			self.wfile.flush()
+
+class CoordinatorServer(object):
+	def __init__(self, destpath, address):
+		self.destpath = destpath
+		self.family, self.address = parse_address(address)
+		self.state = CoordinatorState(destpath)
+		self.server = None
+
+	def serve_forever(self):
+		log.info('Loading status files from ' + self.destpath)
+		log.info('Loaded ' + str(self.state.sync_files()) + ' statuses')
+
+		if self.family == socket.AF_UNIX:
+			if os.path.exists(self.address):
+				os.remove(self.address)
+			self.server = SocketServer.ThreadingUnixStreamServer(self.address, CoordinatorHandler)
+		else:
+			SocketServer.ThreadingTCPServer.allow_reuse_address = True
+			self.server = SocketServer.ThreadingTCPServer(self.address, CoordinatorHandler)
+		self.server.daemon_threads = True
+		self.server.state = self.state
+
+		sync_thread = threading.Thread(target=self.sync, name='coordinator-sync')
+		sync_thread.daemon = True
+		sync_thread.start()
+
+		log.info('Coordinator listening on ' + str(self.address), 'green')
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+
+	def sync(self):
+		while True:
+			time.sleep(CoordinatorState.SYNC_INTERVAL)
+			try:
+				self.state.sync_files()
+			except (IOError, OSError) as e:
+				log.warn('Error reading status files. Error = ' + str(e))
+
+class CoordinatorClient(object):
+	"""
+	Connection of one instance to the coordinator. Every failure raises CoordinatorError so the
+	scheduler can fall back to status files
+	"""
+	TIMEOUT = 5
+
+	def __init__(self, address, instance_name):
+		self.family, self.address = parse_address(address)
+		self.instance_name = instance_name
+		self.sock = None
+		self.file = None
+		self.seq = 0
+		self.lock = threading.Lock()
+
+	def connect(self):
+		try:
+			self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+			self.sock.settimeout(CoordinatorClient.TIMEOUT)
+			self.sock.connect(self.address)
+			if self.family == socket.AF_INET:
+				self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.file = self.sock.makefile('rb')
+		except socket.error as e:
+			self.close()
+			raise CoordinatorError('Cannot connect to coordinator at ' + str(self.address) + ': ' + str(e))
+		return self
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+	def request(self, op, **args):
+		args['op'] = op
+		args['instance'] = self.instance_name
+		with self.lock:
+			if self.sock is None:
+				raise CoordinatorError('Not connected to the coordinator')
+			try:
+				self.sock.sendall(common.json_compact(args) + '\n')
+				line = self.file.readline()
+				if not line:
+					raise CoordinatorError('Coordinator closed the connection')
+				response = json.loads(line)
+			except (socket.error, ValueError) as e:
+				self.close()
+				raise CoordinatorError('Coordinator request failed: ' + str(e))
+
+		if not response.get('ok'):
+			raise CoordinatorError(response.get('error', 'Coordinator request failed'))
+		return response
+
+	def claim(self, status):
+		return self.request('claim', status=status)['granted']
+
+	def update(self, status):
+		self.request('update', status=status)
+
+	def changes(self):
+		"""
+		The (instance name, status) pairs updated since the last call
+		"""
+		response = self.request('changes', since=self.seq)
+		self.seq = response['seq']
+		return response['statuses']
@@ -0,0 +1,185 @@
+import os
+import time
+
+import cost
+from VideoFile import VideoFileOp
+
+def codec_class(v_codec):
+	"""
+	Codec name without profile and tag, e.g. h264 for h264 (High) (avc1 / 0x31637661)
+	"""
+	return v_codec.split(' ')[0].lower() if v_codec else 'unknown'
+
+def format_time(seconds):
+	"""
+	Rough duration like 3d 4h, 2h 15m or 40s
+	"""
+	seconds = int(round(seconds))
+	days, hours, minutes = (seconds // 86400, seconds // 3600 % 24, seconds // 60 % 60)
+	if days:
+		return str(days) + 'd ' + str(hours) + 'h'
+	if hours:
+		return str(hours) + 'h ' + str(minutes) + 'm'
+	if minutes:
+		return str(minutes) + 'm'
+	return str(seconds) + 's'
+
+def format_size(size):
+	for unit in ('B', 'KB', 'MB', 'GB'):
+		if abs(size) < 1024:
+			return ('%.1f ' % size) + unit
+		size /= 1024.0
+	return ('%.1f ' % size) + 'TB'
+
+class Estimator(object):
+	"""
+	Learns how fast every host encodes and how large the output gets from the finished jobs in the
+	status files, and predicts the encode time and output size of the files still to be transcoded.
+	Rates are kept per job class (video, audio or copy), resolution class and source codec, and
+	coarser groups are used when a combination hasn't been seen. Without any finished jobs the
+	static reference machine estimates are used
+	"""
+	# Jobs that ran for less than this don't tell much about speed
+	MIN_WALL_SECONDS = 5
+
+	def __init__(self):
+		# key -> [source seconds encoded, wall clock seconds]
+		self.speeds = {}
+		# key -> [output bytes, source seconds]
+		self.sizes = {}
+		# host -> most jobs the host ran at the same time
+		self.concurrency = {}
+		# host -> [reference machine seconds of the jobs, wall clock seconds]
+		self.work = {}
+		self.samples = 0
+
+	@staticmethod
+	def keys(videofile, job_class_name=None):
+		"""
+		Groups a file belongs to, from the most to the least specific
+		"""
+		job_class_name = job_class_name or cost.job_class(videofile)
+		resolution_class = cost.resolution_class(videofile.v_resolution)
+		return [(job_class_name, resolution_class, codec_class(videofile.v_codec)), (job_class_name, resolution_class), (job_class_name,)]
+
+	@staticmethod
+	def add(table, key, value, weight):
+		total = table.setdefault(key, [0.0, 0.0])
+		total[0] += value
+		total[1] += weight
+
+	@staticmethod
+	def rate(table, keys):
+		for key in keys:
+			total = table.get(key)
+			if total and total[1] > 0:
+				return total[0] / total[1]
+		return None
+
+	def learn(self, statuses, destpath):
+		"""
+		Learn from the (instance name, video file, destination file) tuples of a status index.
+		Returns the number of jobs learned from
+		"""
+		statuses = [tupl for tupl in statuses if tupl[2].status == 'SUCCESS' and tupl[1].duration]
+		# Files encoded in segments finish with a stream copy join, their run time isn't an encode
+		segmented = set(getattr(videofile, 'parent_relpath', None) for instance_name, videofile, destinationfile in statuses)
+
+		for instance_name, videofile, destinationfile in statuses:
+			keys = self.keys(videofile)
+			# Status files hold copies of other instances' entries. Older entries don't record who ran them
+			instance_name = getattr(destinationfile, 'host', None) or instance_name
+
+			wall_seconds = (destinationfile.timestamp_end or 0) - (destinationfile.timestamp_start or 0)
+			encoded_seconds = videofile.duration - (getattr(destinationfile, 'resume_point', None) or 0)
+			if videofile.relpath not in segmented and wall_seconds >= Estimator.MIN_WALL_SECONDS and encoded_seconds > 0:
+				for key in keys:
+					self.add(self.speeds, key, encoded_seconds, wall_seconds)
+					self.add(self.speeds, (instance_name,) + key, encoded_seconds, wall_seconds)
+				self.add(self.work, instance_name, cost.estimate_cost(videofile) * encoded_seconds / videofile.duration, wall_seconds)
+				encoder = getattr(destinationfile, 'encoder', None) or {}
+				self.concurrency[instance_name] = max(self.concurrency.get(instance_name, 1), encoder.get('jobs') or 1)
+				self.samples += 1
+
+			# Segments are removed once they're joined, so only whole files can be measured
+			destfullpath = os.path.join(destpath, destinationfile.relpath)
+			if os.path.isfile(destfullpath):
+				for key in keys:
+					self.add(self.sizes, key, os.path.getsize(destfullpath), videofile.duration)
+
+		return self.samples
+
+	def hosts(self):
+		return sorted(self.concurrency.keys())
+
+	def host_speed(self, instance_name, job_class_name):
+		"""
+		Source seconds a host encodes per second in one job, or None if it never ran that kind of job
+		"""
+		return self.rate(self.speeds, [(instance_name, job_class_name)])
+
+	def capacity(self, instance_name):
+		"""
+		Reference machine seconds of work a host gets through per second with all its concurrent jobs.
+		Unlike speeds this doesn't depend on the mix of jobs the host happened to run
+		"""
+		return self.rate(self.work, [instance_name]) * self.concurrency[instance_name]
+
+	def profile(self, instance_name):
+		"""
+		Throughput profile of a host: speed in source seconds per second for every job and resolution class it ran
+		"""
+		speeds = {}
+		for key in self.speeds:
+			if len(key) == 3 and key[0] == instance_name:
+				speeds.setdefault(key[1], {})[key[2]] = round(self.rate(self.speeds, [key]), 2)
+		return {
+			'host': instance_name,
+			'updated': int(time.time()),
+			'jobs': self.concurrency[instance_name],
+			'capacity': round(self.capacity(instance_name), 3),
+			'speeds': speeds
+		}
+
+	def estimate_seconds(self, videofile, job_class_name=None):
+		"""
+		Wall clock seconds of one job on an average host
+		"""
+		speed = self.rate(self.speeds, self.keys(videofile, job_class_name))
+		if speed:
+			return (videofile.duration or 0.0) / speed
+		return cost.estimate_cost(videofile, job_class_name)
+
+	def estimate_size(self, videofile):
+		"""
+		Output size in bytes. Files of a kind that wasn't transcoded before are assumed to keep their size
+		"""
+		bytes_per_second = self.rate(self.sizes, self.keys(videofile))
+		if bytes_per_second and videofile.duration:
+			return int(bytes_per_second * videofile.duration)
+		return videofile.size or 0
+
+	def predict(self, videofiles, num_hosts):
+		"""
+		Totals for transcoding videofiles on num_hosts hosts. Files that need no transcode and files
+		that only need their audio transcoded are compared with re-encoding their video
+		"""
+		prediction = {'files': 0, 'seconds': 0.0, 'longest': 0.0, 'size': 0, 'source_size': 0, 'audio_savings': 0.0, 'copy_savings': 0.0}
+		for videofile in videofiles:
+			if not videofile.op_flag:
+				prediction['copy_savings'] += self.estimate_seconds(videofile, 'video')
+				continue
+
+			seconds = self.estimate_seconds(videofile)
+			if not videofile.op_flag & VideoFileOp.TRANSCODE_VIDEO:
+				prediction['audio_savings'] += max(0.0, self.estimate_seconds(videofile, 'video') - seconds)
+			prediction['files'] += 1
+			prediction['seconds'] += seconds
+			prediction['longest'] = max(prediction['longest'], seconds)
+			prediction['size'] += self.estimate_size(videofile)
+			prediction['source_size'] += videofile.size or 0
+
+		# Hosts run several jobs at once when they were started with --jobs or --autotune
+		concurrency = float(sum(self.concurrency.values())) / len(self.concurrency) if self.concurrency else 1.0
+		prediction['wall'] = max(prediction['seconds'] / (num_hosts * concurrency), prediction['longest'])
+		return prediction
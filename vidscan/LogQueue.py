@@ -0,0 +1,119 @@
+import logging
+import threading
+import Queue
+
+class QueueHandler(logging.Handler):
+	"""
+	Hands records to a LogWriter instead of writing them, so the calling thread never waits on a file.
+	Records are dropped when the queue is full rather than blocking
+	"""
+	def __init__(self, writer, handlers):
+		super(QueueHandler, self).__init__()
+		self.writer = writer
+		self.handlers = handlers
+
+	def emit(self, record):
+		# Render the message now, its arguments may change before the writer gets to it
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		self.writer.put(self.handlers, record)
+
+class LogWriter(object):
+	"""
+	Background thread that passes queued records on to the handlers they were meant for
+	"""
+	MAX_QUEUED = 10000
+
+	def __init__(self):
+		self.queue = Queue.Queue(LogWriter.MAX_QUEUED)
+		self.dropped = 0
+		self.thread = None
+		self.consoles = []
+
+	def put(self, handlers, record):
+		try:
+			self.queue.put_nowait((handlers, record))
+		except Queue.Full:
+			self.dropped += 1
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='log-writer')
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				return
+			handlers, record = item
+			if self.dropped:
+				dropped, self.dropped = (self.dropped, 0)
+				self.handle(handlers, logging.makeLogRecord({'name': __name__, 'levelno': logging.WARN, 'levelname': 'WARNING',
+					'msg': 'Dropped ' + str(dropped) + ' log records because the log queue was full'}))
+			self.handle(handlers, record)
+			self.queue.task_done()
+
+	@staticmethod
+	def handle(handlers, record):
+		for handler in handlers:
+			if record.levelno >= handler.level:
+				try:
+					handler.handle(record)
+				except Exception:
+					handler.handleError(record)
+
+	def flush(self):
+		"""
+		Wait until the records queued so far are written
+		"""
+		if self.thread is not None:
+			self.queue.join()
+
+	def attach(self, console):
+		"""
+		Render the messages and progress of console on the writer thread too
+		"""
+		console.attach(self)
+		self.consoles.append(console)
+
+	def stop(self):
+		"""
+		Write out the queued records and stop the thread. Consoles print for themselves again
+		"""
+		if self.thread is None:
+			return
+		self.queue.put(None)
+		self.thread.join(5)
+		self.thread = None
+		for console in self.consoles:
+			console.detach()
+		# Records queued while the thread was stopping
+		while True:
+			try:
+				item = self.queue.get_nowait()
+			except Queue.Empty:
+				return
+			if item is not None:
+				self.handle(*item)
+			self.queue.task_done()
+
+def install(loggers, console=None):
+	"""
+	Move the handlers of loggers, and the console output if given, behind a shared queue and writer
+	thread. Returns the started writer
+	"""
+	writer = LogWriter()
+	if console is not None:
+		writer.attach(console)
+	for logger in loggers:
+		handlers = logger.handlers[:]
+		for handler in handlers:
+			logger.removeHandler(handler)
+		logger.addHandler(QueueHandler(writer, handlers))
+	return writer.start()
@@ -0,0 +1,161 @@
+import time
+import threading
+import BaseHTTPServer
+
+import common
+from common import AppLogger
+
+log = AppLogger(__name__)
+
+"""
+Exported metrics and their help text. Every sample also carries a host label so files or
+scrapes collected from several hosts can be told apart
+"""
+METRICS = {
+	'vidscan_encode_fps': ('gauge', 'Frames per second of the running encode'),
+	'vidscan_encode_speed': ('gauge', 'Encoded seconds of video per wall clock second of the running encode'),
+	'vidscan_encoded_seconds_total': ('counter', 'Seconds of video encoded'),
+	'vidscan_bytes_written_total': ('counter', 'Bytes written by finished and running encodes'),
+	'vidscan_jobs_total': ('counter', 'Finished transcode jobs by result'),
+	'vidscan_job_duration_seconds': ('summary', 'Wall clock duration of finished transcode jobs'),
+	'vidscan_queue_files': ('gauge', 'Source files by scheduler state'),
+	'vidscan_scan_files': ('gauge', 'Video files found by the last source scan'),
+	'vidscan_scan_duration_seconds': ('gauge', 'Duration of the last source scan'),
+	'vidscan_probe_duration_seconds': ('summary', 'Time spent probing source files'),
+	'vidscan_hash_duration_seconds': ('summary', 'Time spent computing checksums of destination files'),
+	'vidscan_stage_reads_total': ('counter', 'Started jobs by whether they read a staged copy of their source (hit) or the source itself (miss)'),
+	'vidscan_staged_bytes': ('gauge', 'Bytes of source files staged on local scratch disk'),
+	'vidscan_last_update_timestamp_seconds': ('gauge', 'Time the metrics were last written')
+}
+
+class Metrics(object):
+	"""
+	Thread safe store of metric samples, rendered in the Prometheus text format
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.samples = {}
+
+	@staticmethod
+	def key(name, labels):
+		return (name, tuple(sorted(labels.items())))
+
+	def set(self, name, value, **labels):
+		with self.lock:
+			self.samples[self.key(name, labels)] = value
+
+	def inc(self, name, amount=1, **labels):
+		key = self.key(name, labels)
+		with self.lock:
+			self.samples[key] = self.samples.get(key, 0) + amount
+
+	def observe(self, name, value, **labels):
+		"""
+		Add an observation to a summary. Only the count and sum are kept
+		"""
+		with self.lock:
+			for suffix, amount in (('_count', 1), ('_sum', value)):
+				key = self.key(name + suffix, labels)
+				self.samples[key] = self.samples.get(key, 0) + amount
+
+	def remove(self, name, **labels):
+		with self.lock:
+			self.samples.pop(self.key(name, labels), None)
+
+	def render(self):
+		self.set('vidscan_last_update_timestamp_seconds', time.time())
+		host = common.gethostname()
+		with self.lock:
+			samples = sorted(self.samples.items())
+
+		lines = []
+		described = set()
+		for (name, labels), value in samples:
+			base = name
+			for suffix in ('_count', '_sum'):
+				if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+					base = name[:-len(suffix)]
+			if base not in described and base in METRICS:
+				described.add(base)
+				lines.append('# HELP ' + base + ' ' + METRICS[base][1])
+				lines.append('# TYPE ' + base + ' ' + METRICS[base][0])
+			label_text = ','.join(key + '="' + str(val).replace('\\', '\\\\').replace('"', '\\"') + '"'
+				for key, val in (('host', host),) + labels)
+			lines.append(name + '{' + label_text + '} ' + repr(float(value)))
+		return '\n'.join(lines) + '\n'
+
+# Metrics of this process
+registry = Metrics()
+
+class TextfileExporter(object):
+	"""
+	Periodically write the metrics to a file, for the node_exporter textfile collector or a shared folder
+	"""
+	INTERVAL = 15
+
+	def __init__(self, path, metrics=registry):
+		self.path = path
+		self.metrics = metrics
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.__run, name='metrics-textfile')
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def __run(self):
+		while not self.stopped.is_set():
+			self.write()
+			self.stopped.wait(TextfileExporter.INTERVAL)
+
+	def write(self):
+		# Write to a temp file first so the collector never reads a partial file
+		try:
+			common.write_file_atomic(self.path, lambda f: f.write(self.metrics.render()))
+		except (IOError, OSError) as e:
+			log.warn('Error writing metrics file (' + self.path + '). Error = ' + str(e))
+
+	def stop(self):
+		self.stopped.set()
+		self.write()
+
+class HttpExporter(object):
+	"""
+	Serve the metrics on http://<host>:<port>/metrics from a background thread
+	"""
+	def __init__(self, port, metrics=registry):
+		self.port = port
+		self.metrics = metrics
+		self.server = None
+
+	def start(self):
+		metrics = self.metrics
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] not in ('/', '/metrics'):
+					self.send_error(404)
+					return
+				body = metrics.render()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				log.debug('Metrics request from ' + self.client_address[0] + ': ' + (format % args))
+
+		self.server = BaseHTTPServer.HTTPServer(('', self.port), Handler)
+		thread = threading.Thread(target=self.server.serve_forever, name='metrics-http')
+		thread.daemon = True
+		thread.start()
+		log.info('Serving metrics on port ' + str(self.port))
+		return self
+
+	def stop(self):
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
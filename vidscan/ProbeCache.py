@@ -0,0 +1,100 @@
+import os
+import json
+import hashlib
+import threading
+
+import common
+from common import AppLogger
+
+log = AppLogger(__name__)
+
+class ProbeCache(object):
+	"""
+	On-disk cache of parsed probe results, keyed by the source relpath.
+	An entry is only reused while the file's size, mtime and inode are unchanged.
+	"""
+	FIELDS = ['bitrate', 'duration', 'v_codec', 'v_resolution', 'a_codec', 'a_channel', 'a_bitrate', 'a_stream', 'op_flag', 'size']
+
+	def __init__(self, cache_path, root):
+		self.cache_path = cache_path
+		self.root = os.path.abspath(root)
+		self.entries = {}
+		self.seen = set()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+		self.load()
+
+	@staticmethod
+	def default_path(root):
+		"""
+		Per source folder cache file in the user's home directory
+		"""
+		key = hashlib.md5(os.path.abspath(root)).hexdigest()[:12]
+		return os.path.join(os.path.expanduser('~'), '.vidscan', 'probecache.' + key + '.json')
+
+	def load(self):
+		if not os.path.isfile(self.cache_path):
+			return
+
+		try:
+			with open(self.cache_path, 'r') as f:
+				data = json.load(f)
+		except ValueError as e:
+			log.warn('Ignoring invalid probe cache (' + self.cache_path + '). Error = ' + str(e))
+			return
+
+		if data.get('root') != self.root:
+			log.debug('Probe cache ' + self.cache_path + ' belongs to a different source folder. Ignoring it')
+			return
+
+		self.entries = data.get('entries', {})
+		log.debug('Loaded ' + str(len(self.entries)) + ' probe cache entries')
+
+	def save(self):
+		folder = os.path.dirname(self.cache_path)
+		if folder and not os.path.isdir(folder):
+			os.makedirs(folder)
+
+		# Write to a temp file first so an interrupted save never leaves a truncated cache
+		common.write_file_atomic(self.cache_path, lambda f: json.dump({'root': self.root, 'entries': self.entries}, f, sort_keys=True, separators=(',', ':')))
+
+	@staticmethod
+	def statkey(st):
+		return [st.st_size, st.st_mtime, st.st_ino]
+
+	def get(self, relpath, st):
+		"""
+		Return the cached fields for relpath, or None if there's no entry, the file changed or the
+		entry was written by a version that didn't cache all fields
+		"""
+		with self.lock:
+			self.seen.add(relpath)
+			entry = self.entries.get(relpath)
+			if entry and entry['stat'] == self.statkey(st) and all(field in entry['fields'] for field in ProbeCache.FIELDS):
+				self.hits += 1
+				return entry['fields']
+			self.misses += 1
+			return None
+
+	def put(self, relpath, st, videofile):
+		fields = {}
+		for field in ProbeCache.FIELDS:
+			fields[field] = getattr(videofile, field)
+
+		with self.lock:
+			self.seen.add(relpath)
+			self.entries[relpath] = {'stat': self.statkey(st), 'fields': fields}
+
+	def evict(self):
+		"""
+		Drop entries for files that weren't seen during the scan. Returns the number of evicted entries
+		"""
+		with self.lock:
+			stale = [relpath for relpath in self.entries if relpath not in self.seen]
+			for relpath in stale:
+				del self.entries[relpath]
+		if stale:
+			log.debug('Evicted ' + str(len(stale)) + ' stale probe cache entries')
+		return len(stale)
@@ -0,0 +1,47 @@
+import os
+import re
+import json
+import time
+
+import common
+from common import AppLogger
+
+log = AppLogger(__name__)
+
+class ProfileStore(object):
+	"""
+	Throughput profiles of all hosts, in one _profile.<host>.json file per host next to the status files.
+	Each host only writes its own profile
+	"""
+	FILE_RE = re.compile('^_profile\.([^\.]+)\.json$')
+
+	def __init__(self, destpath):
+		self.destpath = destpath
+
+	def get_path(self, instance_name):
+		return os.path.join(self.destpath, '_profile.' + instance_name + '.json')
+
+	def publish(self, profile):
+		fullpath = self.get_path(profile['host'])
+		# Write to a temp file first so other hosts never read a truncated profile
+		common.write_file_atomic(fullpath, lambda f: common.json_prettify_to_file(profile, f))
+
+	def load(self, max_age=None):
+		"""
+		Returns the profiles of all hosts by host name. Profiles not updated within max_age seconds are left out
+		"""
+		profiles = {}
+		for file in sorted(os.listdir(self.destpath)):
+			match = ProfileStore.FILE_RE.match(file)
+			if not match:
+				continue
+			try:
+				with open(os.path.join(self.destpath, file), 'r') as f:
+					profile = json.load(f)
+			except (IOError, OSError, ValueError) as e:
+				log.debug('Skipping profile ' + file + '. Error = ' + str(e))
+				continue
+			if max_age is not None and time.time() - profile.get('updated', 0) > max_age:
+				continue
+			profiles[match.group(1)] = profile
+		return profiles
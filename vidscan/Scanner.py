@@ -1,18 +1,41 @@
 import os
 from subprocess import Popen, PIPE
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import threading
 import re
+import json
+import time
 
 from VideoFile import VideoFile, VideoFileOp
 from common import AppError, AppLogger
+from Metrics import registry as metrics
+from Walker import Walker
 import common
 
 log = AppLogger(__name__)
 
-class SourceScanResult():
-	videofiles = []
-	extension_count_map = {}
-	v_codec_count_map = {}
-	a_codec_count_map = {}
+# Duration: 01:37:58.08, start: 0.000000, bitrate: 997 kb/s"
+DURATION_RE = re.compile('Duration: (\d\d:\d\d:\d\d\.\d\d),[^,]+, bitrate: (\d+ [a-z\/]+)')
+# Stream #0:0: Video: mpeg4 (Advanced Simple Profile) (XVID / 0x44495658), yuv420p, 640x352 [SAR 1:1 DAR 20:11], 23.98 tbr, 23.98 tbn, 23.98 tbc
+VIDEO_STREAM_RE = re.compile('Stream #\d+:\d+[^:]*: Video: ([^,]+), [^,]+, ([^,]+)')
+# Stream #0:1: Audio: mp3 (U[0][0][0] / 0x0055), 48000 Hz, stereo, s16p, 126 kb/s
+AUDIO_STREAM_RE = re.compile('Stream #\d+:\d+[^:]*: Audio: ([^,]+), [^,]+, ([^,]+), [^,]+(?:, (\d+ [a-z\/]+))?')
+H264_HIGH_RE = re.compile('h264 \(High\)')
+H264_MAIN_RE = re.compile('^h264 \(Main\)(\s\(avc1 .*)?$')
+AUDIO_COPY_RE = re.compile('aac|mp3|dts', re.IGNORECASE)
+SAMPLE_RE = re.compile('[\-\.\(\)\[\]]?sample[\-\.\(\)\[\]]', re.IGNORECASE)
+
+class SourceScanResult(object):
+	def __init__(self):
+		self.videofiles = []
+		self.extension_count_map = {}
+		self.v_codec_count_map = {}
+		self.a_codec_count_map = {}
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.cache_evicted = 0
+
 	def addFile(self, videofile):
 		self.videofiles.append(videofile)
 		if videofile.v_codec not in self.v_codec_count_map:
@@ -21,14 +44,30 @@ class SourceScanResult():
 		if videofile.a_codec not in self.a_codec_count_map:
 			self.a_codec_count_map[videofile.a_codec] = 0
 		self.a_codec_count_map[videofile.a_codec] += 1
+
+	def replaceFile(self, videofile):
+		"""
+		Replace the entry of a file that changed since it was added, or add it if it's new
+		"""
+		for index, old in enumerate(self.videofiles):
+			if old.relpath == videofile.relpath:
+				self.v_codec_count_map[old.v_codec] -= 1
+				self.a_codec_count_map[old.a_codec] -= 1
+				del self.videofiles[index]
+				break
+		self.addFile(videofile)
+
 	def incrementExtensionCount(self, ext):
 		if ext not in self.extension_count_map:
 			self.extension_count_map[ext] = 0
 		self.extension_count_map[ext] += 1
 
 class Scanner(object): 
-	def __init__(self, path):
+	def __init__(self, path, jobs=1, probe_cache=None, walker=None):
 		self.path = path
+		self.jobs = max(1, jobs or 1)
+		self.probe_cache = probe_cache
+		self.walker = walker or Walker(path)
 		
 	def processFile(self, fullpath, lines):
 		pass
@@ -38,49 +77,121 @@ class Scanner(object):
 		# Check 2 things:
 		# 1) if this is not a sample file
 		# 2) if extension is whitelisted
-		return not re.search('[\-\.\(\)\[\]]?sample[\-\.\(\)\[\]]', file, re.IGNORECASE) and extension in common.EXTENSION_WHITELIST
+		return not SAMPLE_RE.search(file) and extension in common.EXTENSION_WHITELIST
 
-	def run(self):
-		videoObjs = []
-		for root, dirs, files in os.walk(self.path):
+	def walk(self):
+		"""
+		Yield the full path of every whitelisted file under the scan path, in walk order
+		"""
+		for root, files in self.walker.walk():
 			for file in files:
 				if self.checkFile(file):
-					fullpath = os.path.join(root, file)
-					
-					log.info("Processing video file " + fullpath + "...")
-					
-					# Call ffmpeg to get file information and capture output lines
-					lines = Popen(["ffmpeg", "-i", fullpath], stdout=PIPE, stderr=PIPE).communicate()
-					log.debug("\n".join(lines))
+					yield os.path.join(root, file)
+				else:
+					log.debug('Unhandled file/extension: ' + file)
 
-					videObj = None
+	def getrelpath(self, fullpath):
+		return os.path.relpath(fullpath, self.path).replace('\\', '/')
 
-					# processFile file
-					try:
-						videoObj = self.processFile(fullpath, lines)
-					except Exception as e:
-						log.error('Error processing file (' + file + '): ' + str(e))
+	def scanFile(self, fullpath):
+		"""
+		Probe a single file and return its video object, or None if it isn't a valid video
+		"""
+		file = os.path.basename(fullpath)
+
+		st = None
+		if self.probe_cache:
+			relpath = self.getrelpath(fullpath)
+			try:
+				st = os.stat(fullpath)
+			except OSError as e:
+				log.error('Cannot stat file (' + file + '): ' + str(e))
+				return None
+
+			fields = self.probe_cache.get(relpath, st)
+			if fields:
+				log.debug('Using cached probe results for ' + fullpath)
+				videoObj = VideoFile(fullpath, relpath)
+				videoObj.update(fields)
+				return videoObj
+
+		log.info("Processing video file " + fullpath + "...")
+
+		videoObj = None
+
+		probe_start = time.time()
+		try:
+			videoObj = self.probeFile(fullpath)
+		except Exception as e:
+			log.error('Error processing file (' + file + '): ' + str(e))
+		metrics.observe('vidscan_probe_duration_seconds', time.time() - probe_start)
+
+		# Basic integrity check. Assume if duration is set then it's a valid video file
+		if videoObj and videoObj.duration:
+			if st is not None:
+				self.probe_cache.put(relpath, st, videoObj)
+			return videoObj
 
-					# Basic integrity check. Assume if duration is set then it's a valid video file
-					if videoObj and videoObj.duration:
-						videoObjs.append(videoObj)
-					else:
-						log.error('Cannot process file. Check if valid video using "ffmpeg -i <file>": ' + file)
+		log.error('Cannot process file. Check if valid video using "ffmpeg -i <file>": ' + file)
+		return None
+
+	def probeFile(self, fullpath):
+		"""
+		Run the prober on a file and return the parsed video object
+		"""
+		# Call ffmpeg to get file information and capture output lines
+		lines = Popen(["ffmpeg", "-i", fullpath], stdout=PIPE, stderr=PIPE).communicate()
+		log.debug("\n".join(lines))
+
+		return self.processFile(fullpath, lines)
+
+	def iterate(self):
+		"""
+		Yield video objects in walk order as soon as they are probed
+		"""
+		if self.jobs > 1:
+			# Probing is dominated by waiting on ffmpeg so threads are enough to keep
+			# several probes in flight. imap keeps results in walk order.
+			pool = ThreadPool(self.jobs)
+			finished = False
+			try:
+				results = pool.imap(self.scanFile, self.walk())
+				while True:
+					try:
+						# wait with a timeout so signals still get delivered to the main thread
+						videoObj = results.next(1)
+					except TimeoutError:
+						continue
+					except StopIteration:
+						break
+					if videoObj:
+						yield videoObj
+				finished = True
+			finally:
+				if finished:
+					pool.close()
 				else:
-					log.debug('Unhandled file/extension: ' + file)
+					# Interrupted. Don't start the probes still queued
+					pool.terminate()
+				pool.join()
+		else:
+			for fullpath in self.walk():
+				videoObj = self.scanFile(fullpath)
+				if videoObj:
+					yield videoObj
 
-		return videoObjs
+	def run(self):
+		return list(self.iterate())
 
 
 class SourceScanner(Scanner):
-	
-	def __init__(self, path, data_out):
-		super(SourceScanner, self).__init__(path)
-		self.data_out = data_out
+	# None until the first probe finds out whether ffprobe is on the path
+	ffprobe_available = None
 
-	def writeData(self, msg):
-		if self.data_out:
-			self.data_out.write(msg)
+	def __init__(self, path, data_out, jobs=1, probe_cache=None, probe_backend='ffprobe', walker=None):
+		super(SourceScanner, self).__init__(path, jobs, probe_cache, walker)
+		self.data_out = data_out
+		self.probe_backend = probe_backend
 
 	def processFile(self, fullpath, lines): 
 		vf = VideoFile(fullpath, os.path.relpath(fullpath, self.path).replace('\\', '/'))		
@@ -88,63 +199,250 @@ class SourceScanner(Scanner):
 		for line in lines:
 			# Extract video file info
 			# Duration: 01:37:58.08, start: 0.000000, bitrate: 997 kb/s"
-			match = re.search('Duration: (\d\d:\d\d:\d\d\.\d\d),[^,]+, bitrate: (\d+ [a-z\/]+)', line)
+			match = DURATION_RE.search(line)
 			if match:
 				if vf.duration or vf.bitrate:
 					raise AppError("Video file data already exists. Check regex")
 				else:
-					vf.duration = match.group(1)
-					vf.bitrate = match.group(2)
+					vf.update({'duration': match.group(1), 'bitrate': match.group(2)})
 			# Extract video stream info
 			# Stream #0:0: Video: mpeg4 (Advanced Simple Profile) (XVID / 0x44495658), yuv420p, 640x352 [SAR 1:1 DAR 20:11], 23.98 tbr, 23.98 tbn, 23.98 tbc
-			match = re.search('Stream #\d+:\d+[^:]*: Video: ([^,]+), [^,]+, ([^,]+)', line)
+			match = VIDEO_STREAM_RE.search(line)
 			if match:
 				if vf.v_codec or vf.v_resolution:
 					raise AppError('Video stream already exists. Check regex')
 				else:
-					vf.v_codec = match.group(1)
-					vf.v_resolution = match.group(2)
+					vf.update({'v_codec': match.group(1), 'v_resolution': match.group(2)})
 			# Exract audio stream info
 			# Stream #0:1: Audio: mp3 (U[0][0][0] / 0x0055), 48000 Hz, stereo, s16p, 126 kb/s
 			# Stream #0:1(eng): Audio: aac, 48000 Hz, stereo, fltp (default)
-			match = re.search('Stream #\d+:\d+[^:]*: Audio: ([^,]+), [^,]+, ([^,]+), [^,]+(?:, (\d+ [a-z\/]+))?', line)
+			match = AUDIO_STREAM_RE.search(line)
 			if match:
 				if vf.a_codec or vf.a_channel or vf.a_bitrate:
 					raise AppError('Audio stream already exists. Check regex')
 				else:
-					vf.a_codec = match.group(1)
-					vf.a_channel = match.group(2)
-					if match.group(3) is not None:
-						vf.a_bitrate = match.group(3)
+					vf.update({'a_codec': match.group(1), 'a_channel': match.group(2), 'a_bitrate': match.group(3), 'a_stream': 0})
+
+		self.setOpFlag(vf)
+		vf.size = os.path.getsize(fullpath)
+		   
+		return vf 
+
+	def setOpFlag(self, vf):
 		# Determine if file requires video transcoding
 		# These video codecs do not need transcoding:
 		# 1) h264 (High)
 		# 2) h264 (Main) OR h264 (Main) (avc1 / 0x31637661) 
-		if not (vf.v_codec == '' or re.search('h264 \(High\)', vf.v_codec) or re.match('^h264 \(Main\)(\s\(avc1 .*)?$', vf.v_codec)):
+		if not (not vf.v_codec or H264_HIGH_RE.search(vf.v_codec) or H264_MAIN_RE.match(vf.v_codec)):
 			vf.op_flag = vf.op_flag | VideoFileOp.TRANSCODE_VIDEO
 		
 		# Determine if file requires audio transcoding
-		if not (vf.a_codec == '' or re.search('aac|mp3|dts', vf.a_codec, re.IGNORECASE)):
+		if not (not vf.a_codec or AUDIO_COPY_RE.search(vf.a_codec)):
 		   vf.op_flag = vf.op_flag | VideoFileOp.TRANSCODE_AUDIO
-		vf.size = os.path.getsize(fullpath)
-		   
-		return vf 
+
+	def probeFile(self, fullpath):
+		"""
+		Probe with ffprobe's json output. Falls back to parsing ffmpeg -i output if ffprobe isn't available or fails
+		"""
+		if self.probe_backend == 'ffprobe' and SourceScanner.ffprobe_available is not False:
+			try:
+				out, err = Popen(["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", fullpath], stdout=PIPE, stderr=PIPE).communicate()
+			except OSError as e:
+				log.warn('ffprobe is not available, falling back to ffmpeg for probing. Error = ' + str(e))
+				SourceScanner.ffprobe_available = False
+			else:
+				SourceScanner.ffprobe_available = True
+				try:
+					probe = json.loads(out) if out else {}
+				except ValueError:
+					probe = {}
+				if 'format' in probe:
+					try:
+						return self.processProbe(fullpath, probe)
+					except Exception as e:
+						# e.g. a duration of N/A or an odd codec tag
+						log.debug('Error reading ffprobe output for ' + fullpath + ', falling back to ffmpeg: ' + str(e))
+				else:
+					log.debug('ffprobe failed for ' + fullpath + ', falling back to ffmpeg: ' + err)
+
+		return super(SourceScanner, self).probeFile(fullpath)
+
+	@staticmethod
+	def selectStream(streams, codec_type):
+		"""
+		Pick the stream of a type that ffmpeg maps when it's given no -map: streams flagged as default
+		first, then the highest resolution or the most audio channels, then the first one.
+		Returns the stream and its index among the streams of that type
+		"""
+		candidates = [stream for stream in streams if stream.get('codec_type') == codec_type]
+		if not candidates:
+			return (None, None)
+		def score(index):
+			stream = candidates[index]
+			if codec_type == 'video':
+				size = (stream.get('width') or 0) * (stream.get('height') or 0)
+			else:
+				size = stream.get('channels') or 0
+			return (bool(stream.get('disposition', {}).get('default')), size)
+		# max() keeps the first of equal scores
+		index = max(range(len(candidates)), key=score)
+		return (candidates[index], index)
+
+	@staticmethod
+	def formatCodec(stream):
+		"""
+		Format a codec the way ffmpeg -i prints it, e.g. h264 (High) (avc1 / 0x31637661)
+		"""
+		codec = stream.get('codec_name', 'unknown')
+		profile = stream.get('profile')
+		if profile and profile != 'unknown':
+			codec += ' (' + profile + ')'
+		codec_tag = stream.get('codec_tag')
+		if codec_tag and int(codec_tag, 16) != 0:
+			codec += ' (' + stream.get('codec_tag_string', '') + ' / ' + codec_tag + ')'
+		return codec
+
+	@staticmethod
+	def parseBitrate(bit_rate):
+		"""
+		ffprobe's bits per second as kb/s
+		"""
+		if bit_rate is None or not str(bit_rate).isdigit():
+			return None
+		return int(bit_rate) // 1000
+
+	def processProbe(self, fullpath, probe):
+		"""
+		Build a video object from ffprobe's json output. Files with several video or audio 
+		streams are described by the streams ffmpeg picks, see selectStream
+		"""
+		vf = VideoFile(fullpath, self.getrelpath(fullpath))
+		streams = probe.get('streams', [])
+		fmt = probe['format']
+
+		if 'duration' in fmt:
+			vf.duration = round(float(fmt['duration']), 2)
+		vf.bitrate = self.parseBitrate(fmt.get('bit_rate'))
+
+		stream, index = self.selectStream(streams, 'video')
+		if stream:
+			v_resolution = str(stream.get('width')) + 'x' + str(stream.get('height'))
+			sar = stream.get('sample_aspect_ratio')
+			if sar and sar != '0:1':
+				v_resolution += ' [SAR ' + sar + ' DAR ' + stream.get('display_aspect_ratio', '') + ']'
+			vf.update({'v_codec': self.formatCodec(stream), 'v_resolution': v_resolution})
+
+		stream, index = self.selectStream(streams, 'audio')
+		if stream:
+			vf.update({'a_codec': self.formatCodec(stream), 
+				'a_channel': stream.get('channel_layout') or (str(stream.get('channels')) + ' channels'),
+				'a_bitrate': self.parseBitrate(stream.get('bit_rate')),
+				'a_stream': index})
+
+		self.setOpFlag(vf)
+		vf.size = int(fmt['size']) if 'size' in fmt else os.path.getsize(fullpath)
+
+		return vf
 
 	def checkFile(self, file):
 		extension = os.path.splitext(file)[1][1:]
 		self.__result.incrementExtensionCount(extension) 
 		return super(SourceScanner, self).checkFile(file)
 
-	def run(self): 
-		self.__result = SourceScanResult() 
+	@property
+	def result(self):
+		return self.__result
 
-		videofiles = super(SourceScanner, self).run()
+	def iterate(self):
+		"""
+		Yield video objects as they are found while building up the scan result
+		"""
+		self.__result = SourceScanResult() 
+		# The data file is written as files are found instead of dumping the whole list at the end
+		data_writer = common.JsonListWriter(self.data_out) if self.data_out else None
 
-		for vf in videofiles:
+		scan_start = time.time()
+		for vf in super(SourceScanner, self).iterate():
 			self.__result.addFile(vf)
+			if data_writer:
+				data_writer.write(vf)
+			yield vf
+
+		metrics.set('vidscan_scan_files', len(self.__result.videofiles))
+		metrics.set('vidscan_scan_duration_seconds', time.time() - scan_start)
 
+		self.walker.save()
+		if self.probe_cache:
+			self.__result.cache_evicted = self.probe_cache.evict()
+			self.__result.cache_hits = self.probe_cache.hits
+			self.__result.cache_misses = self.probe_cache.misses
+			self.probe_cache.save()
 
-		# Dump list of videos to json file
-		self.writeData(common.json_prettify(videofiles))
+		if data_writer:
+			data_writer.close()
+
+	def run(self):
+		for vf in self.iterate():
+			pass
 		return self.__result
 
+
+class ScanFeed(object):
+	"""
+	Runs a scanner in a background thread so video files can be consumed while the scan is still running.
+	Iterating over the feed blocks until the next video file is found or the scan is done
+	"""
+	def __init__(self, scanner):
+		self.scanner = scanner
+		self.videofiles = []
+		self.done = False
+		self.cond = threading.Condition()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.__scan)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def __scan(self):
+		try:
+			for vf in self.scanner.iterate():
+				with self.cond:
+					self.videofiles.append(vf)
+					self.cond.notify_all()
+		except Exception as e:
+			log.error('Error scanning source files: ' + str(e))
+		finally:
+			with self.cond:
+				self.done = True
+				self.cond.notify_all()
+
+	def get(self, index, block=True):
+		"""
+		Return the video files found after position index. If block is set, wait until
+		there is at least one or the scan is done
+		"""
+		with self.cond:
+			while block and len(self.videofiles) <= index and not self.done:
+				# wait with a timeout so signals still get delivered to the main thread
+				self.cond.wait(1)
+			return self.videofiles[index:]
+
+	def join(self):
+		while self.thread and self.thread.is_alive():
+			self.thread.join(1)
+
+	def __len__(self):
+		return len(self.videofiles)
+
+	def __iter__(self):
+		index = 0
+		while True:
+			videofiles = self.get(index)
+			if not videofiles:
+				return
+			for vf in videofiles:
+				yield vf
+			index += len(videofiles)
+
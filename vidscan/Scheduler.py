@@ -6,10 +6,19 @@ import time
 import zc.lockfile
 import json
 import signal
+import threading
+import collections
+import itertools
+import math
 
 import common
 from common import AppError, AppLogger
-from VideoFile import VideoFile, VideoFileOp
+from VideoFile import VideoFile, VideoFileOp, VideoSegment
+from ChecksumIndex import ChecksumIndex
+from Metrics import registry as metrics
+from Estimator import Estimator
+from Profile import ProfileStore
+import cost
 
 log = AppLogger(__name__)
 
@@ -17,6 +26,10 @@ class LockError(AppError):
 	"""Thrown if scheduler couldn't acquire a lock on a file"""
 	pass
 
+class CoordinatorError(AppError):
+	"""Thrown if the coordinator couldn't be reached or rejected a request"""
+	pass
+
 class DestinationFile(object):
 	def __init__(self, relpath=None, timestamp_start=None):
 		self.status = 'IN_PROGRESS'
@@ -24,40 +37,460 @@ class DestinationFile(object):
 		self.timestamp_start = timestamp_start
 		self.md5 = None
 		self.timestamp_end = None
+		# Renewed while the job runs. Entries from versions without heartbeats keep None
+		self.heartbeat = None
+		# Encoder settings the transcoder chose for this file
+		self.encoder = None
+		# Seconds of the source already encoded into chunks that a restarted job continues from.
+		# Finished jobs keep the point they resumed from, so their run time can be related to what they encoded
+		self.resume_point = None
+		# Instance that ran the job. Status files also hold copies of other instances' entries,
+		# so the file an entry was read from doesn't tell who ran it. None for older entries
+		self.host = None
+		# Size of the source file the job encoded, so a replaced source is transcoded again. None for older entries
+		self.source_size = None
 
 	def update(self, entries):
 		self.__dict__.update(entries)	
 
+class StatusJournal(object):
+	"""
+	Append-only status file of this instance. Each status update is appended as one json line, and the
+	journal is compacted down to the latest record per destination file once it has grown large enough.
+	The first line is a header that changes with every compaction so readers know to reload the file.
+	Updates are serialized when they're made and written in order, by the caller or, once start_writer()
+	was called, by a background thread so callers don't wait for the share
+	"""
+	COMPACT_RATIO = 4
+	COMPACT_MIN_LINES = 1000
+
+	def __init__(self, destpath, instance_name):
+		self.instance_name = instance_name
+		self.path = os.path.join(destpath, '_status.' + instance_name + '.jsonl')
+		self.legacy_path = os.path.join(destpath, '_status.' + instance_name + '.json')
+		self.file = None
+		# Lines in the journal once the pending writes are done
+		self.num_lines = 0
+		# Writes not done yet, as ('append', line) or ('compact', lines)
+		self.pending = []
+		self.cond = threading.Condition()
+		# Held while writing so writes are done one at a time and in order
+		self.write_lock = threading.Lock()
+		self.writer = None
+		self.writer_stopped = False
+
+	def header(self):
+		return common.json_compact({'journal': self.instance_name, 'created': time.time()}) + '\n'
+
+	def open(self):
+		header = None
+		if os.path.isfile(self.path):
+			with open(self.path, 'r') as f:
+				header = f.readline()
+				self.num_lines = sum(1 for line in f)
+		if not header:
+			# New journal, or one left empty by a crash during compaction
+			with open(self.path, 'w') as f:
+				f.write(self.header())
+			self.num_lines = 0
+
+		self.file = open(self.path, 'a')
+
+	def migrate(self):
+		"""
+		Convert the status file written by older versions into journal lines
+		"""
+		if not os.path.isfile(self.legacy_path):
+			return
+
+		status_json = open(self.legacy_path).read().decode('utf-8')
+		status_list = []
+		if status_json != '':
+			try:
+				status_list = json.loads(status_json)
+			except ValueError as e:
+				raise AppError('Error loading status list. Check that it is a valid json file or remove it. Error = ' + str(e))
+
+		log.info('Migrating ' + os.path.basename(self.legacy_path) + ' to ' + os.path.basename(self.path))
+		if self.file is None:
+			self.open()
+		for status in status_list:
+			self.append(status)
+		self.file.flush()
+
+		migrated_path = self.legacy_path + '.migrated'
+		if os.path.isfile(migrated_path):
+			os.remove(migrated_path)
+		os.rename(self.legacy_path, migrated_path)
+
+	def append(self, status):
+		self.submit(('append', common.json_compact(status)))
+		self.num_lines += 1
+
+	def needs_compaction(self, num_records):
+		return self.num_lines > max(StatusJournal.COMPACT_MIN_LINES, StatusJournal.COMPACT_RATIO * num_records)
+
+	def compact(self, status_list):
+		"""
+		Rewrite the journal with one line per status
+		"""
+		lines = [common.json_compact(status) for status in status_list]
+		self.submit(('compact', lines))
+		self.num_lines = len(lines)
+
+	def submit(self, write):
+		with self.cond:
+			self.pending.append(write)
+			self.cond.notify_all()
+		if self.writer is None:
+			self.flush()
+
+	def flush(self):
+		"""
+		Do the pending writes
+		"""
+		with self.write_lock:
+			with self.cond:
+				writes, self.pending = self.pending, []
+			for kind, data in writes:
+				if self.file is None:
+					self.open()
+				if kind == 'append':
+					self.file.write(data + '\n')
+					self.file.flush()
+				else:
+					self.rewrite(data)
+
+	def rewrite(self, lines):
+		def write(f):
+			f.write(self.header())
+			for line in lines:
+				f.write(line + '\n')
+
+		self.file.close()
+		self.file = None
+		common.write_file_atomic(self.path, write)
+		self.file = open(self.path, 'a')
+		log.debug('Compacted ' + os.path.basename(self.path) + ' to ' + str(len(lines)) + ' records')
+
+	def start_writer(self):
+		"""
+		Write from a background thread from now on
+		"""
+		if self.writer is None:
+			self.writer_stopped = False
+			self.writer = threading.Thread(target=self.run_writer, name='status-journal')
+			self.writer.daemon = True
+			self.writer.start()
+
+	def stop_writer(self):
+		"""
+		Finish the pending writes and write from the caller again
+		"""
+		writer = self.writer
+		if writer is None:
+			return
+		with self.cond:
+			self.writer_stopped = True
+			self.cond.notify_all()
+		if writer is not threading.current_thread():
+			writer.join()
+		self.writer = None
+		self.flush()
+
+	def run_writer(self):
+		while True:
+			with self.cond:
+				while not self.pending and not self.writer_stopped:
+					self.cond.wait(1)
+				if not self.pending:
+					return
+			try:
+				self.flush()
+			except (IOError, OSError) as e:
+				log.warn('Error writing ' + os.path.basename(self.path) + '. Error = ' + str(e))
+
+	def close(self):
+		self.stop_writer()
+		with self.write_lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+class LeaseTracker(object):
+	"""
+	Decides when the in-progress job of another instance is dead. Heartbeats carry the owner's clock,
+	which may be minutes off from ours, so a lease expires when this instance hasn't seen the heartbeat
+	change for lease_timeout seconds of its own clock
+	"""
+	def __init__(self, lease_timeout, legacy_timeout):
+		self.lease_timeout = lease_timeout
+		self.legacy_timeout = legacy_timeout
+		# destination relpath -> ((timestamp_start, heartbeat), local time it was first seen)
+		self.seen = {}
+		self.lock = threading.Lock()
+
+	def is_expired(self, destinationfile):
+		now = time.time()
+		heartbeat = getattr(destinationfile, 'heartbeat', None)
+		if heartbeat is None:
+			# Entries from versions without heartbeats. Clock differences don't matter at this timeout
+			return now - destinationfile.timestamp_start > self.legacy_timeout
+
+		value = (destinationfile.timestamp_start, heartbeat)
+		with self.lock:
+			seen = self.seen.get(destinationfile.relpath)
+			if seen is None or seen[0] != value:
+				seen = (value, now)
+				self.seen[destinationfile.relpath] = seen
+		return now - seen[1] > self.lease_timeout
+
+class StatusIndex(object):
+	"""
+	In-memory view of the status files of all instances. refresh() only re-reads the
+	status files whose size or mtime changed since the last look. Journals are read 
+	incrementally from where the last read stopped
+	"""
+	# Key of the entries received from a coordinator
+	COORDINATOR = '<coordinator>'
+
+	def __init__(self, destpath):
+		self.destpath = destpath
+		self.files = {}
+		self.status_relpath_dict = {}
+
+	@staticmethod
+	def add_status(status_relpath_dict, instance_name, status, replace_equal):
+		videofile = VideoSegment() if 'parent_relpath' in status['videofile'] else VideoFile()
+		videofile.update(status['videofile'])
+
+		destinationfile = DestinationFile()
+		destinationfile.update(status['destinationfile'])
+
+		destrelpath = destinationfile.relpath
+
+		if destrelpath in status_relpath_dict:
+			status_tupl = status_relpath_dict[destrelpath]
+			if (destinationfile.timestamp_start > status_tupl[2].timestamp_start
+				or (replace_equal and destinationfile.timestamp_start == status_tupl[2].timestamp_start)):
+				del status_relpath_dict[destrelpath]
+
+		if destrelpath not in status_relpath_dict:
+			status_relpath_dict[destrelpath] = (instance_name, videofile, destinationfile)
+
+		return destrelpath
+
+	def parse(self, instance_name, fullpath):
+		"""
+		Parse a legacy status file. Returns (entries, changed destination relpaths)
+		"""
+		status_relpath_dict = {}
+		instance_status_list = []
+
+		status_json = open(fullpath).read().decode('utf-8')
+		if status_json != '':
+			instance_status_list = json.loads(status_json)
+
+		for status in instance_status_list:
+			StatusIndex.add_status(status_relpath_dict, instance_name, status, False)
+
+		old_entries = self.files[fullpath]['entries'] if fullpath in self.files else {}
+		self.files[fullpath]['entries'] = status_relpath_dict
+		return set(old_entries.keys()) | set(status_relpath_dict.keys())
+
+	def parse_journal(self, instance_name, fullpath):
+		"""
+		Read the journal lines added since the last read, or the whole journal if it was compacted.
+		Returns the changed destination relpaths
+		"""
+		state = self.files[fullpath]
+		changed = set()
+		with open(fullpath, 'rb') as f:
+			header = f.readline()
+			if header != state.get('header') or not header.endswith('\n'):
+				# new or compacted journal. Start over
+				changed |= set(state['entries'].keys())
+				state['entries'] = {}
+				state['header'] = header
+				state['offset'] = f.tell()
+
+			f.seek(state['offset'])
+			data = f.read()
+
+		# Only consume complete lines. A partially written last line is picked up next time
+		end = data.rfind('\n') + 1
+		for line in data[:end].splitlines():
+			if not line.strip():
+				continue
+			try:
+				status = json.loads(line.decode('utf-8'))
+			except ValueError as e:
+				log.warn('Skipping invalid line in ' + os.path.basename(fullpath) + '. Error = ' + str(e))
+				continue
+			if 'destinationfile' in status:
+				changed.add(StatusIndex.add_status(state['entries'], instance_name, status, True))
+		state['offset'] += end
+		return changed
+
+	def refresh(self):
+		"""
+		Reload changed status files. Returns the list of status tuples that changed
+		"""
+		changed_relpaths = set()
+		found = set()
+		for file in sorted(os.listdir(self.destpath)):
+			match = re.match('^_status\.([^\.]+)\.(json|jsonl)$', file)
+			if match:
+				fullpath = os.path.join(self.destpath, file)
+				found.add(fullpath)
+				try:
+					st = os.stat(fullpath)
+				except OSError:
+					continue
+				stat = (st.st_size, st.st_mtime)
+				if fullpath in self.files and self.files[fullpath]['stat'] == stat:
+					continue
+
+				log.debug('Checking ' + file)
+				if fullpath not in self.files:
+					self.files[fullpath] = {'stat': None, 'entries': {}}
+				try:
+					if match.group(2) == 'jsonl':
+						changed_relpaths |= self.parse_journal(match.group(1), fullpath)
+					else:
+						changed_relpaths |= self.parse(match.group(1), fullpath)
+				except ValueError as e:
+					# Another instance may be in the middle of rewriting it. Keep the old entries and retry next time
+					log.warn('Error loading status file (' + file + '). Check that it is a valid json file or remove it. Error = ' + str(e))
+					continue
+				except (IOError, OSError) as e:
+					log.warn('Error reading status file (' + file + '). Error = ' + str(e))
+					continue
+				self.files[fullpath]['stat'] = stat
+
+		for fullpath in list(self.files.keys()):
+			if fullpath not in found:
+				changed_relpaths |= set(self.files[fullpath]['entries'].keys())
+				del self.files[fullpath]
+
+		return self.update(changed_relpaths)
+
+	def apply(self, statuses):
+		"""
+		Merge (instance name, status) pairs sent by a coordinator. Returns the list of status tuples that changed
+		"""
+		state = self.files.setdefault(StatusIndex.COORDINATOR, {'stat': None, 'entries': {}})
+		changed_relpaths = set()
+		for instance_name, status in statuses:
+			changed_relpaths.add(StatusIndex.add_status(state['entries'], instance_name, status, True))
+		return self.update(changed_relpaths)
+
+	def update(self, changed_relpaths):
+		"""
+		Recompute the merged status of changed destination files. Returns the status tuples that changed
+		"""
+		changed = []
+		for destrelpath in changed_relpaths:
+			tupl = self.merge(destrelpath)
+			if tupl is None:
+				self.status_relpath_dict.pop(destrelpath, None)
+			elif self.status_relpath_dict.get(destrelpath) is not tupl:
+				self.status_relpath_dict[destrelpath] = tupl
+				changed.append(tupl)
+		return changed
+
+	def merge(self, destrelpath):
+		"""
+		The latest status of a destination file across all instances
+		"""
+		result = None
+		for fullpath in sorted(self.files.keys()):
+			tupl = self.files[fullpath]['entries'].get(destrelpath)
+			if tupl is None:
+				continue
+			# Copies of an entry have the same start time. Prefer the one from the journal of the instance that ran the job
+			if (result is None or tupl[2].timestamp_start > result[2].timestamp_start
+				or (tupl[2].timestamp_start == result[2].timestamp_start and tupl[2].host == tupl[0] and result[2].host != result[0])):
+				result = tupl
+		return result
+
+	def values(self):
+		return self.status_relpath_dict.values()
+
 class Scheduler(object):
-	def __init__(self, videofiles, destpath):
-		self.skiplist = []
+	NEXT = 'NEXT'
+	DEFER = 'DEFER'
+	DONE = 'DONE'
+	FAIL = 'FAIL'
+
+	# Seconds between heartbeats of in-progress jobs, and after which a job without a heartbeat is considered dead
+	HEARTBEAT_INTERVAL = 10
+	LEASE_TIMEOUT = 60
+	# Jobs started by versions without heartbeats are only considered dead after a day
+	LEGACY_STALE_TIMEOUT = 86400
+	# Seconds of video per chunk of a resumable transcode. 0 encodes in one piece, chunks are opt-in
+	# since they're written to and read back from the destination share
+	CHECKPOINT_INTERVAL = 0
+	# Seconds between updates of this host's throughput profile. Profiles of hosts that haven't
+	# updated theirs for PROFILE_MAX_AGE seconds are ignored
+	PROFILE_INTERVAL = 300
+	PROFILE_MAX_AGE = 86400
+	# Number of queued files a host picks from when it prefers heavy or light jobs
+	ROUTING_WINDOW = 20
+
+	def __init__(self, videofiles, destpath, segment_length=None, order='walk', coordinator=None, checkpoint_interval=CHECKPOINT_INTERVAL, routing=True):
 		self.videofiles = videofiles
 		self.destpath = destpath
-		self.status_list = None
-		self.status_file_rw = None
-		self.md5_cache = None
+		self.segment_length = segment_length
+		self.checkpoint_interval = checkpoint_interval
+		# Fast hosts prefer expensive jobs and slow hosts cheap ones. 'heavy', 'light' or None to keep the queue order
+		self.routing = routing
+		self.preference = None
+		self.profiles = ProfileStore(destpath)
+		self.profile_time = 0
+		self.order_key = cost.ORDER_POLICIES[order]
+		self.segments = {}
+		self.status_dict = None
+		self.journal = None
+		self.checksums = None
+		# Claims and status updates go through the coordinator when there is one, instead of lock and status files
+		self.coordinator = coordinator
+
+		# In-flight jobs of this instance keyed by source relpath. Each job holds its lock and status entry
+		self.jobs = {}
+		# Guards the status list, status file and jobs. claim_lock is held by transcoder workers
+		# while they pick and start a file so two workers never claim the same one
+		self.mutex = threading.RLock()
+		self.claim_lock = threading.Lock()
+		self.heartbeat_thread = None
+		self.heartbeat_stopped = threading.Event()
+		self.leases = LeaseTracker(Scheduler.LEASE_TIMEOUT, Scheduler.LEGACY_STALE_TIMEOUT)
+
+		# Status of every instance, and the queue of source files still to be considered
+		self.status_index = StatusIndex(destpath)
+		self.status_by_source = {}
+		self.status_counts = None
+		self.pending = collections.deque()
+		self.deferred = []
+		# Deferred files whose claim failed by relpath, and whether another instance holds them. They're
+		# only retried once their status changes or after a wait
+		self.held = {}
+		self.num_queued = 0
 
 		"""
-		Initialize md5 cache for video files in the destination folder
+		Initialize the checksum index for video files in the destination folder.
+		Only the stat of each file is read here, checksums are verified lazily
 		"""
-		self.md5_cache = {}
-		for root, dirs, files in os.walk(destpath):
-			for file in files:
-				extension = os.path.splitext(file)[1][1:]
-				if extension in common.EXTENSION_WHITELIST:
-					fullpath = os.path.join(root, file)
-					relpath = self.getrelpath(fullpath)
-					self.md5_cache[relpath] = common.md5Checksum(fullpath)
+		self.checksums = ChecksumIndex(destpath)
+		self.checksums.scan()
 
 		"""
 		Scan for previous successful or failed transcodes and initialize status list
 		"""
-		self.status_list = []
-		status_file_path = os.path.join(destpath, '_status.' + common.gethostname() + '.json')
-		if os.path.isfile(status_file_path):
-			self.status_file_rw = open(status_file_path, 'r+') 
-		else:
-			self.status_file_rw = open(status_file_path, 'w+') 
+		self.status_dict = collections.OrderedDict()
+		self.journal = StatusJournal(destpath, common.gethostname())
+		self.journal.open()
+		self.journal.migrate()
 
 		for tupl in self.get_completed_list():
 			instance_name = tupl[0]
@@ -69,30 +502,52 @@ class Scheduler(object):
 				'destinationfile': destinationfile
 			}			
 
-			self.status_list.append(status)
+			self.status_dict[destinationfile.relpath] = status
+
+		# Start from a journal with just the completed transcodes, like the json status file used to be rewritten
+		if self.journal.num_lines != len(self.status_dict):
+			self.journal.compact(self.status_dict.values())
+
+		self.checksums.save()
+		self.update_profiles()
+
+		# The coordinator has the current state. The journal is only read by instances without one,
+		# so claims and updates don't wait for it to be written to the share
+		if self.coordinator:
+			self.journal.start_writer()
 
 	def attach_cleanup_listener(self):
 		def clean(signum, frame):
 			print '\n'
+
+			# Worker threads add and remove jobs while this runs
+			with self.mutex:
+				jobs = list(self.jobs.values())
 			
-			try:
-				log.debug('Removing lock file: ' + self.lock_fullpath)
-				self.lock.close()
-				time.sleep(0.5)	# this is needed for windows!
-				if os.path.isfile(self.lock_fullpath):
-					os.remove(self.lock_fullpath.replace('\\', '\\\\'))
-			except:
-				log.debug('Error removing lock file')
+			for job in jobs:
+				if job['lock'] is None:
+					continue
+				try:
+					log.debug('Removing lock file: ' + job['lock_fullpath'])
+					job['lock'].close()
+					time.sleep(0.5)	# this is needed for windows!
+					if os.path.isfile(job['lock_fullpath']):
+						os.remove(job['lock_fullpath'].replace('\\', '\\\\'))
+				except:
+					log.debug('Error removing lock file')
 
 			try:
 				log.warn('Stopping transcoder. Got a signal: ' + str(signum))
 
-				if self.status_list and len(self.status_list) > 0 and self.status_list[-1]['destinationfile'].status == 'IN_PROGRESS':
-					destinationfile = self.status_list[-1]['destinationfile']
-					destinationfile.status = 'INTERRUPTED'	
-					destinationfile.timestamp_end = int(time.time())
-					log.warn('Transcoding ' + destinationfile.relpath + ' was interrupted')
-					self.updatestatus()
+				for job in jobs:
+					destinationfile = job['status']['destinationfile']
+					if destinationfile.status == 'IN_PROGRESS':
+						destinationfile.status = 'INTERRUPTED'	
+						destinationfile.timestamp_end = int(time.time())
+						if self.is_resumable(job['status']['videofile']):
+							destinationfile.resume_point = self.get_checkpoint(job['status']['videofile'])
+						log.warn('Transcoding ' + destinationfile.relpath + ' was interrupted')
+						self.updatestatus(job['status'])
 			except:
 				log.debug('Error updating status during signal interrupt')
 			finally:
@@ -102,149 +557,659 @@ class Scheduler(object):
 		for sig in (signal.SIGABRT, signal.SIGILL, signal.SIGINT, signal.SIGSEGV, signal.SIGTERM):
 			signal.signal(sig, clean)
 
-	def updatestatus(self):
-		if self.status_file_rw is None:
-			self.openstatusfile()
-		self.status_file_rw.seek(0)
-		common.json_prettify_to_file(self.status_list, self.status_file_rw)
-		self.status_file_rw.truncate()		# truncate it to current position ie correct size
+	def updatestatus(self, status):
+		"""
+		Append the new state of a status entry to this instance's journal
+		"""
+		with self.mutex:
+			self.status_dict[status['destinationfile'].relpath] = status
+			self.journal.append(status)
+			if self.journal.needs_compaction(len(self.status_dict)):
+				self.journal.compact(self.status_dict.values())
+
+			if self.coordinator:
+				try:
+					self.coordinator.update(status)
+				except CoordinatorError as e:
+					self.use_file_mode(e)
+
+	def use_file_mode(self, error):
+		"""
+		Stop using the coordinator and go back to status and lock files on the destination share
+		"""
+		with self.mutex:
+			if self.coordinator is None:
+				return
+			log.warn('Lost the coordinator, falling back to status files. Error = ' + error.value)
+			self.coordinator.close()
+			self.coordinator = None
+			self.journal.stop_writer()
+			self.status_index = StatusIndex(self.destpath)
+			self.status_counts = None
 
 	def closestatusfile(self):
-		if self.status_file_rw is not None:
-			self.status_file_rw.close()
+		"""
+		Stop the heartbeat and close the journal
+		"""
+		self.heartbeat_stopped.set()
+		if self.heartbeat_thread is not None and self.heartbeat_thread is not threading.current_thread():
+			# Bounded, the signal handler may run while the main thread holds the mutex the heartbeat waits for
+			self.heartbeat_thread.join(5)
+		with self.mutex:
+			self.journal.close()
+
+	def start_heartbeat(self):
+		if self.heartbeat_thread is None:
+			self.heartbeat_thread = threading.Thread(target=self.heartbeat, name='scheduler-heartbeat')
+			self.heartbeat_thread.daemon = True
+			self.heartbeat_thread.start()
+
+	def heartbeat(self):
+		"""
+		Renew the lease of every in-progress job of this instance so other instances don't reclaim them
+		"""
+		while not self.heartbeat_stopped.wait(Scheduler.HEARTBEAT_INTERVAL):
+			with self.mutex:
+				if self.heartbeat_stopped.is_set():
+					return
+				for job in self.jobs.values():
+					destinationfile = job['status']['destinationfile']
+					if destinationfile.status == 'IN_PROGRESS':
+						destinationfile.heartbeat = int(time.time())
+						if self.is_resumable(job['status']['videofile']):
+							destinationfile.resume_point = self.get_checkpoint(job['status']['videofile'])
+						self.updatestatus(job['status'])
+
+	def is_lease_expired(self, destinationfile):
+		"""
+		True if the instance running an in-progress job stopped renewing its heartbeat
+		"""
+		return self.leases.is_expired(destinationfile)
+
+	@staticmethod
+	def get_lock_path(destfullpath):
+		return os.path.join(os.path.dirname(destfullpath), '.' + os.path.basename(destfullpath) + '.vslock')
+
+	@staticmethod
+	def is_source_changed(videofile, destinationfile):
+		"""
+		True if the source file was replaced since the job of this status entry ran
+		"""
+		return destinationfile.source_size is not None and destinationfile.source_size != videofile.size
 
 	def is_completed(self, instance_name, videofile, destinationfile):
+		if self.is_source_changed(videofile, destinationfile):
+			return False
+
 		status = destinationfile.status
 		destrelpath = destinationfile.relpath
 		md5 = destinationfile.md5
 
 		return ( status == 'FAIL' 
-				or (status == 'SUCCESS' and destrelpath in self.md5_cache and md5 == self.md5_cache[destrelpath])
+				or (status == 'SUCCESS' and destrelpath in self.checksums and md5 == self.checksums.get(destrelpath))
 				)
 
 	def get_completed_list(self):
 		return self.get_status_list(self.is_completed)
 
 	def get_status_list(self, filter = None):
-		status_relpath_dict = {}
-		for file in os.listdir(self.destpath):
-			match = re.match('^_status\.([^\.]+)\.json$', file)
-			if match:
-				log.debug('Checking ' + file)
-				instance_name = match.group(1)
-				instance_status_list = []
+		self.refresh_status()
 
-				status_json = open(os.path.join(self.destpath, file)).read().decode('utf-8')
-				if status_json != '':
-					try:
-						instance_status_list = json.loads(status_json)
-					except ValueError as e:
-						raise AppError('Error loading status list. Check that it is a valid json file or remove it. Error = ' + str(e))	
-						#log.warn('Error reading status file (' + file + ') so we will skip it. Error = ' + str(e))
-						#log.debug('Contents of ' + file + ': ' + status_json)
-
-				for status in instance_status_list:
-					videofile = VideoFile()
-					videofile.update(status['videofile'])
-
-					destinationfile = DestinationFile()
-					destinationfile.update(status['destinationfile'])
-
-	
-					destrelpath = destinationfile.relpath
-
-					if destrelpath in status_relpath_dict:
-						status_tupl = status_relpath_dict[destrelpath]
-						if destinationfile.timestamp_start > status_tupl[2].timestamp_start:
-							del status_relpath_dict[destrelpath]
-
-					if destrelpath not in status_relpath_dict:
-						status_relpath_dict[destrelpath] = (instance_name, videofile, destinationfile)
-			
 		if filter is not None:
 			result = []
-			for tupl in status_relpath_dict.values():
+			for tupl in self.status_index.values():
 				if filter(*tupl):
 					result.append(tupl)
 			return result
 
-		return status_relpath_dict.values()
+		return self.status_index.values()
 
-	def start(self, videofile, destfullpath):
-		# Create destination subfolders if necessary
+	def start(self, videofile, destfullpath, encoder=None):
 		destfolder = os.path.dirname(destfullpath)
-		if not os.path.exists(destfolder):
-			os.makedirs(destfolder)
 
+		with self.mutex:
+			if videofile.relpath in self.jobs:
+				raise LockError('File is already being transcoded')
+
+			# Segments are joined with stream copy, so they all have to be encoded with the same profile and pixel format
+			if isinstance(videofile, VideoSegment) and encoder:
+				formats = self.get_segment_formats(self.segments.get(videofile.parent_relpath, []))
+				if formats and (encoder.get('profile'), encoder.get('pix_fmt')) not in formats:
+					# Leave it to an instance whose x264 has the same bit depth
+					self.hold(videofile)
+					raise LockError('Other segments of this file are encoded as ' + ', '.join(sorted(profile + ' ' + str(pix_fmt) for profile, pix_fmt in formats)))
+
+			# Create destination subfolders if necessary
+			if not os.path.exists(destfolder):
+				os.makedirs(destfolder)
+
+			destrelpath = self.getrelpath(destfullpath).replace('\\', '/')
+			destinationfile = DestinationFile(destrelpath, int(time.time()))
+			destinationfile.heartbeat = destinationfile.timestamp_start
+			destinationfile.encoder = encoder
+			destinationfile.host = common.gethostname()
+			destinationfile.source_size = videofile.size
+			status = {
+				'videofile': videofile,
+				'destinationfile': destinationfile 
+			}
+
+			lock, lock_fullpath = (None, None)
+			if self.coordinator and not self.claim(status):
+				self.hold(videofile, True)
+				raise LockError('File is claimed by another instance')
+
+			# The coordinator's claim is authoritative. Lock files are only taken without one,
+			# or when it went away during the claim
+			if not self.coordinator:
+				try:
+					lock_fullpath = self.get_lock_path(destfullpath)
+					lock = zc.lockfile.LockFile(lock_fullpath)
+				except (zc.lockfile.LockError, IOError) as e:
+					# Look at it again once its owner's status shows up, so it can be reclaimed if the owner dies
+					self.hold(videofile, True)
+					raise LockError('Error locking file')
+
+			if self.is_resumable(videofile):
+				try:
+					destinationfile.resume_point = self.prepare_chunks(videofile, encoder)
+				except (IOError, OSError):
+					# The job isn't recorded, so end() would never release the lock
+					if lock is not None:
+						lock.close()
+						os.remove(lock_fullpath)
+					raise
+
+			self.jobs[videofile.relpath] = {
+				'lock': lock,
+				'lock_fullpath': lock_fullpath,
+				'status': status,
+				'resumed_from': destinationfile.resume_point
+			}
+			
+			self.updatestatus(status)
+			self.start_heartbeat()
+
+	def claim(self, status):
+		"""
+		Ask the coordinator for the job. Returns False if another instance holds a live lease on it
+		"""
 		try:
-			self.lock_fullpath = os.path.join(destfolder,'.' + os.path.basename(destfullpath) + '.vslock')
-			self.lock = zc.lockfile.LockFile(self.lock_fullpath)
-		except (zc.lockfile.LockError, IOError) as e:
-			self.skiplist.append(videofile.relpath)
-			raise LockError('Error locking file')
-
-		destrelpath = self.getrelpath(destfullpath).replace('\\', '/')
-		destinationfile = DestinationFile(destrelpath, int(time.time()))
-		status = {
-			'videofile': videofile,
-			'destinationfile': destinationfile 
-		}
+			return self.coordinator.claim(status)
+		except CoordinatorError as e:
+			self.use_file_mode(e)
+			return True
 
-		self.status_list.append(status)
-		
-		self.updatestatus()
+	def end(self, videofile, is_success, md5=None):
+		destinationfile = self.jobs[videofile.relpath]['status']['destinationfile']
+		if is_success and not md5:
+			# The transcoder may have hashed the output while writing it. Otherwise read it back
+			hash_start = time.time()
+			md5 = common.md5Checksum(os.path.join(self.destpath, destinationfile.relpath))
+			metrics.observe('vidscan_hash_duration_seconds', time.time() - hash_start)
 
-	def end(self, videofile, is_success):
-		self.lock.close()
-		os.remove(self.lock_fullpath)
+		with self.mutex:
+			job = self.jobs.pop(videofile.relpath)
+			if job['lock'] is not None:
+				job['lock'].close()
+				os.remove(job['lock_fullpath'])
 
-		destinationfile = self.status_list[-1]['destinationfile']
-		if is_success:
-			destfullpath = os.path.join(self.destpath, destinationfile.relpath)
-			destinationfile.status = 'SUCCESS'
-			destinationfile.timestamp_end = int(time.time())
-			destinationfile.md5 = common.md5Checksum(destfullpath)
-			self.md5_cache[destinationfile.relpath] = destinationfile.md5
+			destinationfile.resume_point = job['resumed_from']
+			if is_success:
+				destinationfile.status = 'SUCCESS'
+				destinationfile.timestamp_end = int(time.time())
+				destinationfile.md5 = md5
+				self.checksums.set(destinationfile.relpath, destinationfile.md5)
+			else:
+				destinationfile.status = 'FAIL'
+
+			self.updatestatus(job['status'])
+
+		if is_success and self.is_segmented(videofile):
+			log.debug('Removing segments of ' + videofile.relpath)
+			self.remove_segments(videofile)
+		if self.is_resumable(videofile):
+			self.remove_chunks(videofile)
+
+		self.update_metrics()
+
+	def update_metrics(self):
+		"""
+		Export the number of source files in each state. Completed, failed and in progress counts
+		come from the status files so they include the work of other instances
+		"""
+		if self.status_counts is None:
+			# Only recount after refresh_status picked up changes
+			self.status_counts = {'in_progress': 0, 'completed': 0, 'failed': 0}
+			for instance_name, videofile, destinationfile in self.status_index.values():
+				if destinationfile.status == 'IN_PROGRESS':
+					self.status_counts['in_progress'] += 1
+				elif destinationfile.status == 'SUCCESS':
+					self.status_counts['completed'] += 1
+				elif destinationfile.status == 'FAIL':
+					self.status_counts['failed'] += 1
+
+		counts = dict(self.status_counts)
+		counts['pending'] = len(self.pending) + max(0, len(self.videofiles) - self.num_queued)
+		counts['deferred'] = len(self.deferred)
+		for state, count in counts.items():
+			metrics.set('vidscan_queue_files', count, state=state)
+
+	def refresh_status(self):
+		"""
+		Pick up status changes from all instances and requeue deferred files whose status changed
+		"""
+		with self.mutex:
+			changed = None
+			if self.coordinator:
+				try:
+					changed = self.status_index.apply(self.coordinator.changes())
+				except CoordinatorError as e:
+					self.use_file_mode(e)
+			if changed is None:
+				changed = self.status_index.refresh()
+			if changed:
+				self.status_counts = None
+
+		changed_relpaths = set()
+		for tupl in changed:
+			self.status_by_source[tupl[1].relpath] = (tupl[0], tupl[2])
+			changed_relpaths.add(tupl[1].relpath)
+			# A segment changing may make its file ready to be concatenated
+			parent_relpath = getattr(tupl[1], 'parent_relpath', None)
+			if parent_relpath:
+				changed_relpaths.add(parent_relpath)
+
+		if changed_relpaths and self.deferred:
+			requeue = [videofile for videofile in self.deferred if videofile.relpath in changed_relpaths]
+			if requeue:
+				self.deferred = [videofile for videofile in self.deferred if videofile.relpath not in changed_relpaths]
+				for relpath in changed_relpaths:
+					self.held.pop(relpath, None)
+				self.pending.extendleft(reversed(requeue))
+
+	def hold(self, videofile, locked=False):
+		"""
+		Defer a file whose claim failed. A file locked by another instance is waited for even before
+		that instance's status shows up, so it can be reclaimed if the owner dies. Called with claim_lock held
+		"""
+		self.deferred.append(videofile)
+		self.held[videofile.relpath] = locked
+
+	def queue_videofiles(self):
+		"""
+		Add source files that haven't been queued yet, sorted by the ordering policy. If the video files 
+		come from a scan feed this blocks until the next file is found. Returns False when there is nothing left to queue
+		"""
+		if hasattr(self.videofiles, 'get'):
+			videofiles = self.videofiles.get(self.num_queued)
 		else:
-			destinationfile.status = 'FAIL'
+			videofiles = self.videofiles[self.num_queued:]
+
+		self.num_queued += len(videofiles)
+		if self.order_key:
+			videofiles = cost.order_for_host(videofiles, self.order_key, common.gethostname())
+		self.pending.extend(videofiles)
+		return len(videofiles) > 0
+
+	def check_videofile(self, videofile):
+		"""
+		Returns NEXT if the file should be transcoded now, DEFER if it's blocked for now or DONE if it never needs to be considered again
+		"""
+		if (not videofile.op_flag or videofile.relpath in self.jobs):
+			return Scheduler.DONE
+
+		if videofile.relpath in self.status_by_source:
+			instance_name, destinationfile = self.status_by_source[videofile.relpath]
+			if self.is_completed(instance_name, videofile, destinationfile):
+				return Scheduler.DONE
+
+			destfullpath = os.path.join(self.destpath, destinationfile.relpath)
+			status = destinationfile.status
+			if status == 'IN_PROGRESS':
+				if not self.is_lease_expired(destinationfile):
+					log.debug('Skipping file being transcoded by ' + instance_name + ': ' + destinationfile.relpath)
+					return Scheduler.DEFER
+
+				# The owner died. Take over its job along with the lock file it left behind
+				log.info('Reclaiming ' + destinationfile.relpath + ' from ' + instance_name + ' because its lease expired')
+				lock_fullpath = self.get_lock_path(destfullpath)
+				if os.path.isfile(lock_fullpath):
+					try:
+						os.remove(lock_fullpath)
+					except OSError as e:
+						log.debug('Error removing orphaned lock file ' + lock_fullpath + ': ' + str(e))
+
+			if status in ('INTERRUPTED', 'IN_PROGRESS') and os.path.isfile(destfullpath):
+				# Only the joined output is incomplete. Encoded chunks are kept and the next job continues from them
+				log.debug('Removing incomplete file because encoding was stopped or interrupted ' + destinationfile.relpath + ' (status=' + destinationfile.status + ', instance=' + instance_name + ')')
+				os.remove(destfullpath)
+			elif status in ('SUCCESS', 'FAIL') and self.is_source_changed(videofile, destinationfile) and os.path.isfile(destfullpath):
+				log.info('Source of ' + destinationfile.relpath + ' changed. Transcoding it again', 'cyan')
+				os.remove(destfullpath)
+
+			if os.path.isfile(destfullpath):
+				log.debug('Skipping existing file ' + destinationfile.relpath + ' (status=' + destinationfile.status + ', instance=' + instance_name + ')')
+				return Scheduler.DEFER
+
+		return Scheduler.NEXT
+
+	def update_profiles(self):
+		"""
+		Publish the throughput profile of this host, learned from its own finished jobs, and compare it
+		with the other hosts. The slower half of the hosts prefers cheap jobs and the faster half expensive
+		ones, so a long encode doesn't end up on the slowest host at the end of the run
+		"""
+		self.profile_time = time.time()
+		instance_name = common.gethostname()
+		estimator = Estimator()
+		# Only jobs this instance ran, whichever status file they were read from
+		if estimator.learn([tupl for tupl in self.status_index.values() if (tupl[2].host or tupl[0]) == instance_name], self.destpath):
+			try:
+				self.profiles.publish(estimator.profile(instance_name))
+			except (IOError, OSError) as e:
+				log.warn('Error writing throughput profile. Error = ' + str(e))
+
+		preference = None
+		capacities = dict((host, profile['capacity']) for host, profile in self.profiles.load(Scheduler.PROFILE_MAX_AGE).items() if profile.get('capacity'))
+		if self.routing and instance_name in capacities and len(capacities) > 1:
+			hosts = sorted(capacities, key=lambda host: (capacities[host], host))
+			rank = hosts.index(instance_name)
+			if rank < len(hosts) // 2:
+				preference = 'light'
+			elif rank >= len(hosts) - len(hosts) // 2:
+				preference = 'heavy'
+
+		if preference != self.preference:
+			if preference:
+				log.info('Preferring ' + preference + ' jobs. This computer is number ' + str(len(hosts) - rank) + ' of ' + str(len(hosts)) + ' by throughput')
+			else:
+				log.info('Taking files in queue order')
+			self.preference = preference
+
+	def pop_pending(self):
+		"""
+		Take the next queued file. With a preference, the most or least expensive of the next ROUTING_WINDOW files
+		"""
+		if self.preference is None:
+			return self.pending.popleft()
+		window = list(itertools.islice(self.pending, Scheduler.ROUTING_WINDOW))
+		pick = max if self.preference == 'heavy' else min
+		videofile = pick(window, key=cost.estimate_cost)
+		self.pending.remove(videofile)
+		return videofile
+
+	def peek_pending(self, count):
+		"""
+		Best guess of the next count source files to be transcoded, without taking them off the queue.
+		Files that are done or being transcoded by another instance are passed over
+		"""
+		window = list(itertools.islice(self.pending, Scheduler.ROUTING_WINDOW + count))
+		if self.preference is not None:
+			window.sort(key=cost.estimate_cost, reverse=self.preference == 'heavy')
 
-		self.updatestatus()
+		upcoming = []
+		for videofile in window:
+			if len(upcoming) == count:
+				break
+			if not videofile.op_flag or videofile.relpath in self.held or videofile.relpath in self.jobs:
+				continue
+			if videofile.relpath in self.status_by_source:
+				instance_name, destinationfile = self.status_by_source[videofile.relpath]
+				if destinationfile.status == 'IN_PROGRESS' or self.is_completed(instance_name, videofile, destinationfile):
+					continue
+			upcoming.append(videofile)
+		return upcoming
 
 	def get_next_videofile(self):
-		completed_dict = {}
-		destinationfile_dict = {}
-
-		def filter(instance_name, videofile, destinationfile):
-			is_completed = self.is_completed(instance_name, videofile, destinationfile)
-			destinationfile_dict[videofile.relpath] = (instance_name,destinationfile)
-			if is_completed:
-				completed_dict[videofile.relpath] = 1
-			return True
+		self.refresh_status()
+		if time.time() - self.profile_time > Scheduler.PROFILE_INTERVAL:
+			self.update_profiles()
 
-		self.get_status_list(filter)
-
-		for videofile in self.videofiles:
-			if videofile.op_flag and videofile.relpath not in completed_dict and videofile.relpath not in self.skiplist:
-				if videofile.relpath in destinationfile_dict:
-					tupl = destinationfile_dict[videofile.relpath]
-					instance_name = tupl[0]
-					destinationfile = tupl[1]
-					destfullpath = os.path.join(self.destpath, destinationfile.relpath)
-					status = destinationfile.status
-					timestamp_start = destinationfile.timestamp_start
-					if ((status == 'INTERRUPTED' 
-						 or (status == 'IN_PROGRESS' and int(time.time()) - timestamp_start > 86400)) and os.path.isfile(destfullpath)):
-							log.debug('Removing incomplete file because encoding was stopped or interrupted ' + destinationfile.relpath + ' (status=' + destinationfile.status + ', instance=' + instance_name + ')')
-							os.remove(destfullpath)
-
-					if os.path.isfile(destfullpath):
-						log.debug('Skipping existing file ' + destinationfile.relpath + ' (status=' + destinationfile.status + ', instance=' + instance_name + ')')
+		retry_deferred = True
+		while True:
+			while self.pending:
+				videofile = self.pop_pending()
+				verdict = self.check_videofile(videofile)
+				if verdict == Scheduler.NEXT and self.is_segmented(videofile):
+					state = self.get_segments_state(videofile)
+					if state == Scheduler.FAIL:
+						log.warn('Not concatenating ' + videofile.relpath + ' because some of its segments failed')
+						continue
+					if state != Scheduler.DONE:
+						# Queue the segments first. The file itself is requeued once the status of its segments changes
+						if state == Scheduler.NEXT:
+							queued = set(vf.relpath for vf in self.pending) | set(vf.relpath for vf in self.deferred)
+							segments = [segment for segment in self.get_segments(videofile) if segment.relpath not in queued]
+							self.pending.extendleft(reversed(segments))
+						self.deferred.append(videofile)
 						continue
+				if verdict == Scheduler.NEXT:
+					log.debug('Suggesting file to encode next: ' + videofile.relpath)
+					self.update_metrics()
+					return videofile
+				if verdict == Scheduler.DEFER:
+					self.deferred.append(videofile)
+
+			if self.queue_videofiles():
+				self.refresh_status()
+				continue
+
+			# Files skipped earlier may have been interrupted or gone stale since. Give them one more look
+			if retry_deferred and self.deferred:
+				retry_deferred = False
+				retry = [videofile for videofile in self.deferred if videofile.relpath not in self.held]
+				if retry:
+					self.pending.extend(retry)
+					self.deferred = [videofile for videofile in self.deferred if videofile.relpath in self.held]
+					continue
+
+			# A file held by a live lease comes back if its owner dies, and segmented files can be joined
+			# once their segments finish. Wait for those instead of exiting
+			if self.deferred and (self.jobs or any(self.held.values()) or self.get_leased_files()):
+				self.update_metrics()
+				log.debug('Waiting for ' + str(len(self.deferred)) + ' files that are being transcoded')
+				time.sleep(Scheduler.HEARTBEAT_INTERVAL)
+				self.refresh_status()
+				self.held.clear()
+				retry_deferred = True
+				continue
+
+			if not getattr(self.videofiles, 'done', True):
+				# A watch feed never finishes. queue_videofiles() waited a while for new files, look at the deferred files again
+				self.refresh_status()
+				retry_deferred = True
+				continue
+
+			self.update_metrics()
+			return None
+
+	def get_leased_files(self):
+		"""
+		Deferred files with an in-progress job whose lease is still being renewed
+		"""
+		leased = []
+		for videofile in self.deferred:
+			if videofile.relpath in self.status_by_source:
+				instance_name, destinationfile = self.status_by_source[videofile.relpath]
+				if destinationfile.status == 'IN_PROGRESS' and not self.is_lease_expired(destinationfile):
+					leased.append(videofile)
+		return leased
+
+	def is_segmented(self, videofile):
+		"""
+		Long video transcodes are split into segments that any instance can encode
+		"""
+		return bool(self.segment_length
+			and not isinstance(videofile, VideoSegment)
+			and videofile.op_flag & VideoFileOp.TRANSCODE_VIDEO
+			and videofile.duration
+			and videofile.duration > 1.5 * self.segment_length)
+
+	def get_segments(self, videofile):
+		# Split again if the source was replaced, its segments are new jobs
+		if videofile.relpath not in self.segments or self.segments[videofile.relpath][0].size != videofile.size:
+			total = videofile.duration
+			count = int(math.ceil(total / self.segment_length))
+			segments = []
+			for index in range(count):
+				start = index * self.segment_length
+				segments.append(VideoSegment(videofile, index, count, start, min(self.segment_length, total - start)))
+			self.segments[videofile.relpath] = segments
+		return self.segments[videofile.relpath]
+
+	def get_segments_state(self, videofile):
+		"""
+		DONE if every segment was encoded successfully, FAIL if any of them failed, DEFER if the remaining 
+		segments are being encoded and NEXT if some segments still have to be queued
+		"""
+		state = Scheduler.DONE
+		for segment in self.get_segments(videofile):
+			if segment.relpath in self.status_by_source:
+				instance_name, destinationfile = self.status_by_source[segment.relpath]
+				if self.is_completed(instance_name, segment, destinationfile):
+					if destinationfile.status == 'FAIL':
+						return Scheduler.FAIL
+					continue
+				if (destinationfile.status == 'IN_PROGRESS' and not self.is_lease_expired(destinationfile)) or segment.relpath in self.jobs:
+					state = Scheduler.DEFER
+					continue
+			if segment.relpath in self.held or segment.relpath in self.jobs:
+				state = Scheduler.DEFER
+				continue
+			return Scheduler.NEXT
+
+		if state == Scheduler.DONE and len(self.get_segment_formats(self.get_segments(videofile))) > 1:
+			log.warn('Segments of ' + videofile.relpath + ' were encoded with different x264 profiles and can\'t be joined')
+			return Scheduler.FAIL
+		return state
+
+	def get_segment_formats(self, segments):
+		"""
+		The (profile, pixel format) pairs that segments were or are being encoded with. Failed segments
+		and entries of versions that didn't record the profile are left out
+		"""
+		formats = set()
+		for segment in segments:
+			if segment.relpath not in self.status_by_source:
+				continue
+			destinationfile = self.status_by_source[segment.relpath][1]
+			encoder = getattr(destinationfile, 'encoder', None) or {}
+			if destinationfile.status != 'FAIL' and encoder.get('profile'):
+				formats.add((encoder['profile'], encoder.get('pix_fmt')))
+		return formats
+
+	def get_segment_destpath(self, segment):
+		"""
+		Segments are kept under _segments/ in the destination folder until they are concatenated
+		"""
+		return os.path.join(self.destpath, '_segments', os.path.splitext(segment.parent_relpath)[0], 'seg%03d.mkv' % segment.segment_index)
+
+	def remove_segments(self, videofile):
+		for segment in self.get_segments(videofile):
+			segment_fullpath = self.get_segment_destpath(segment)
+			if os.path.isfile(segment_fullpath):
+				os.remove(segment_fullpath)
+		segment_folder = os.path.dirname(self.get_segment_destpath(self.get_segments(videofile)[0]))
+		if os.path.isdir(segment_folder):
+			for file in os.listdir(segment_folder):
+				os.remove(os.path.join(segment_folder, file))
+			try:
+				# also prune the parent folders under _segments that are now empty
+				os.removedirs(segment_folder)
+			except OSError:
+				pass
+
+	def is_resumable(self, videofile):
+		"""
+		Video transcodes longer than a chunk are encoded in chunks so an interrupted job can continue
+		from the last finished chunk. Segments and segmented files are already split into jobs
+		"""
+		return bool(self.checkpoint_interval
+			and not isinstance(videofile, VideoSegment)
+			and videofile.op_flag & VideoFileOp.TRANSCODE_VIDEO
+			and not self.is_segmented(videofile)
+			and videofile.duration
+			and videofile.duration > self.checkpoint_interval)
+
+	def get_resume_point(self, videofile):
+		with self.mutex:
+			return self.jobs[videofile.relpath]['status']['destinationfile'].resume_point or 0
+
+	def get_chunk_folder(self, videofile):
+		"""
+		Chunks are kept under _partial/ in the destination folder until they are joined
+		"""
+		return os.path.join(self.destpath, '_partial', os.path.splitext(videofile.relpath)[0])
 
-				log.debug('Suggesting file to encode next: ' + videofile.relpath)
-				return videofile
+	def get_chunk_paths(self, videofile):
+		"""
+		Paths of the chunks written so far, in order. Numbering has no gaps since chunks are written one after the other
+		"""
+		chunk_folder = self.get_chunk_folder(videofile)
+		paths = []
+		while os.path.isfile(os.path.join(chunk_folder, 'chunk%03d.mkv' % len(paths))):
+			paths.append(os.path.join(chunk_folder, 'chunk%03d.mkv' % len(paths)))
+		return paths
+
+	def get_checkpoint(self, videofile):
+		"""
+		Seconds of the source covered by finished chunks. The newest chunk is still being written,
+		or was cut off when the job stopped
+		"""
+		return max(0, len(self.get_chunk_paths(videofile)) - 1) * self.checkpoint_interval
+
+	def prepare_chunks(self, videofile, encoder):
+		"""
+		Keep the finished chunks of an earlier job on this file and return the second to continue from. 
+		Chunks of a different source file, chunk length or encoder settings are thrown away. The chunks are
+		on the destination share, so they may come from another host with a different x264 bit depth
+		"""
+		chunk_folder = self.get_chunk_folder(videofile)
+		manifest_path = os.path.join(chunk_folder, 'chunks.json')
+		manifest = {
+			'size': videofile.size,
+			'duration': videofile.duration,
+			'checkpoint_interval': self.checkpoint_interval,
+			'preset': encoder.get('preset') if encoder else None,
+			'crf': encoder.get('crf') if encoder else None,
+			'profile': encoder.get('profile') if encoder else None,
+			'pix_fmt': encoder.get('pix_fmt') if encoder else None
+		}
+
+		resume_point = 0
+		if os.path.isfile(manifest_path):
+			try:
+				with open(manifest_path, 'r') as f:
+					previous = json.load(f)
+			except ValueError:
+				previous = None
+			if previous == manifest:
+				resume_point = self.get_checkpoint(videofile)
+			else:
+				log.info('Encoder settings or source of ' + videofile.relpath + ' changed. Starting over')
 
-		return None
+		# Drop the unfinished chunk, or everything when starting over
+		for chunk_path in self.get_chunk_paths(videofile)[resume_point // self.checkpoint_interval:]:
+			os.remove(chunk_path)
+
+		if not os.path.isdir(chunk_folder):
+			os.makedirs(chunk_folder)
+		# A truncated manifest would make the next host throw the finished chunks away
+		common.write_file_atomic(manifest_path, lambda f: common.json_prettify_to_file(manifest, f))
+		return resume_point
+
+	def remove_chunks(self, videofile):
+		chunk_folder = self.get_chunk_folder(videofile)
+		if os.path.isdir(chunk_folder):
+			log.debug('Removing chunks of ' + videofile.relpath)
+			for file in os.listdir(chunk_folder):
+				os.remove(os.path.join(chunk_folder, file))
+			try:
+				# also prune the parent folders under _partial that are now empty
+				os.removedirs(chunk_folder)
+			except OSError:
+				pass
 
 	def getrelpath(self, fullpath):
 		return os.path.relpath(fullpath, self.destpath)
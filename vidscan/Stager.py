@@ -0,0 +1,307 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+import collections
+
+from common import AppLogger
+from Metrics import registry as metrics
+
+log = AppLogger(__name__)
+
+class StagedFile(object):
+	def __init__(self, fullpath, path, size, mtime):
+		self.fullpath = fullpath
+		self.path = path
+		self.size = size
+		self.mtime = mtime
+		self.ready = False
+		# Bytes copied so far
+		self.copied = 0
+		# Number of jobs reading the copy. It's never removed while it's in use
+		self.users = 0
+
+class Stager(object):
+	"""
+	Copies the source files the scheduler will hand out next to a local scratch folder while the current
+	jobs encode, so ffmpeg reads and seeks on local disk instead of the network share. The copies take up
+	to budget bytes. A copy is removed when its job ends unless another queued job reads the same source,
+	and the least recently used of the remaining copies are removed when room is needed
+	"""
+	# Default budget in bytes
+	BUDGET = 20 * 1073741824
+	# Bytes copied at a time
+	BLOCK_SIZE = 4194304
+	# Bytes the copies always leave free on the scratch disk, whatever the budget
+	MIN_FREE = 1073741824
+
+	def __init__(self, scratchpath, budget=BUDGET):
+		self.path = os.path.join(scratchpath, 'vidscan-stage')
+		self.budget = budget
+		# Source fullpath -> StagedFile, least recently used first
+		self.files = collections.OrderedDict()
+		self.used = 0
+		# Source fullpaths expected to be transcoded next, copied in this order
+		self.wanted = []
+		# Source fullpath -> number of jobs that claimed it and haven't released it yet. Their copies
+		# are kept even though they're no longer expected
+		self.claimed = collections.Counter()
+		# Sources that can't be staged, because they're larger than the budget or copying them failed
+		self.skipped = set()
+		self.cond = threading.Condition()
+		self.stopped = False
+		self.thread = None
+
+	def start(self):
+		# Copies left behind by an earlier run are of no use, their sources may have changed since
+		if os.path.isdir(self.path):
+			shutil.rmtree(self.path, ignore_errors=True)
+		os.makedirs(self.path)
+		log.info('Staging source files in ' + self.path + ' (budget ' + str(self.budget // 1048576) + ' MB)')
+
+		self.thread = threading.Thread(target=self.run, name='stager')
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		"""
+		Stop copying and remove all staged copies
+		"""
+		with self.cond:
+			self.stopped = True
+			self.cond.notify_all()
+		if self.thread:
+			self.thread.join(5)
+			self.thread = None
+		shutil.rmtree(self.path, ignore_errors=True)
+
+	def get_staged_path(self, fullpath):
+		name = hashlib.md5(fullpath.encode('utf-8') if isinstance(fullpath, unicode) else fullpath).hexdigest()[:16]
+		return os.path.join(self.path, name + os.path.splitext(fullpath)[1])
+
+	def prefetch(self, videofiles):
+		"""
+		Set the files expected to be transcoded next, most likely first. Copies of earlier expected files
+		that aren't used are kept until room is needed
+		"""
+		wanted = []
+		for videofile in videofiles:
+			if videofile.fullpath not in wanted:
+				wanted.append(videofile.fullpath)
+		with self.cond:
+			self.wanted = wanted
+			self.cond.notify_all()
+
+	def claim(self, fullpath):
+		"""
+		A job was handed the source. Its copy isn't evicted until release() is called, even once
+		prefetch() no longer lists it
+		"""
+		with self.cond:
+			self.claimed[fullpath] += 1
+
+	def is_wanted(self, fullpath):
+		"""
+		True if the copy of a source will be read. Called with the condition held
+		"""
+		return fullpath in self.wanted or self.claimed[fullpath] > 0
+
+	def acquire(self, fullpath):
+		"""
+		Path of the local copy of a source file, or None if it isn't staged. Waits for a copy
+		that is in progress. A copy that hasn't started yet is dropped and the source is read
+		from the share instead. The copy is kept until release() is called
+		"""
+		with self.cond:
+			staged = self.files.get(fullpath)
+			if staged is not None and not staged.ready and not staged.copied and not staged.users:
+				log.debug('Not waiting for the staged copy of ' + fullpath + ' because it hasn\'t started')
+				if fullpath not in self.wanted:
+					self.discard(staged)
+				staged = None
+			if staged is None:
+				metrics.inc('vidscan_stage_reads_total', result='miss')
+				return None
+			staged.users += 1
+			while not staged.ready and not self.stopped and self.files.get(fullpath) is staged:
+				# wait with a timeout so signals still get delivered when this is the main thread
+				self.cond.wait(1)
+			if not staged.ready:
+				staged.users -= 1
+				metrics.inc('vidscan_stage_reads_total', result='miss')
+				return None
+			# Move to the most recently used end
+			del self.files[fullpath]
+			self.files[fullpath] = staged
+
+		# The source may have been replaced since it was copied
+		try:
+			stat = os.stat(fullpath)
+			is_current = (stat.st_size, stat.st_mtime) == (staged.size, staged.mtime)
+		except OSError:
+			is_current = False
+		if not is_current:
+			log.debug('Not using the staged copy of ' + fullpath + ' because the source changed')
+			with self.cond:
+				staged.users -= 1
+				if not staged.users:
+					self.discard(staged)
+			metrics.inc('vidscan_stage_reads_total', result='miss')
+			return None
+
+		metrics.inc('vidscan_stage_reads_total', result='hit')
+		return staged.path
+
+	def get(self, fullpath):
+		"""
+		Path of the local copy of a source file acquired by a job, or None
+		"""
+		with self.cond:
+			staged = self.files.get(fullpath)
+			return staged.path if staged and staged.ready and staged.users else None
+
+	def release(self, fullpath, acquired=True):
+		"""
+		A job that claimed the source ended, and stopped reading the copy if it acquired it. The copy
+		is removed unless another queued job reads the same source
+		"""
+		with self.cond:
+			if self.claimed[fullpath] > 0:
+				self.claimed[fullpath] -= 1
+				if not self.claimed[fullpath]:
+					del self.claimed[fullpath]
+			staged = self.files.get(fullpath)
+			if staged is None:
+				return
+			if acquired:
+				staged.users = max(0, staged.users - 1)
+			if not staged.users and not self.is_wanted(fullpath):
+				self.discard(staged)
+			self.cond.notify_all()
+
+	def discard(self, staged):
+		"""
+		Remove a copy. Called with the condition held
+		"""
+		if self.files.get(staged.fullpath) is staged:
+			del self.files[staged.fullpath]
+			self.used -= staged.size
+			metrics.set('vidscan_staged_bytes', self.used)
+		for path in (staged.path, staged.path + '.part'):
+			if os.path.isfile(path):
+				try:
+					os.remove(path)
+				except OSError as e:
+					log.debug('Error removing staged copy ' + path + ': ' + str(e))
+		self.cond.notify_all()
+
+	def make_room(self, size):
+		"""
+		Remove the least recently used copies that aren't in use or expected until size more bytes fit
+		in the budget. Called with the condition held. Returns False if they don't fit yet
+		"""
+		for staged in self.files.values():
+			if self.used + size <= self.budget:
+				break
+			if staged.ready and not staged.users and not self.is_wanted(staged.fullpath):
+				log.debug('Evicting staged copy of ' + staged.fullpath)
+				self.discard(staged)
+		return self.used + size <= self.budget
+
+	def get_free_space(self):
+		if not hasattr(os, 'statvfs'):
+			return None
+		stat = os.statvfs(self.path)
+		return stat.f_bavail * stat.f_frsize
+
+	def next_fullpath(self):
+		"""
+		The first expected source that has no copy yet. Called with the condition held
+		"""
+		for fullpath in self.wanted:
+			if fullpath not in self.files and fullpath not in self.skipped:
+				return fullpath
+		return None
+
+	def reserve(self, fullpath):
+		"""
+		Make room for a copy of fullpath. Returns the StagedFile to copy to, or None if it can't be staged now
+		"""
+		try:
+			stat = os.stat(fullpath)
+		except OSError as e:
+			log.debug('Not staging ' + fullpath + ': ' + str(e))
+			with self.cond:
+				self.skipped.add(fullpath)
+			return None
+
+		with self.cond:
+			if stat.st_size > self.budget:
+				log.debug('Not staging ' + fullpath + ' because it\'s larger than the budget')
+				self.skipped.add(fullpath)
+				return None
+			# Wait for a job to end or for the expected files to change
+			if self.next_fullpath() != fullpath or not self.make_room(stat.st_size):
+				return None
+			free = self.get_free_space()
+			if free is not None and free - stat.st_size < Stager.MIN_FREE:
+				log.warn('Not staging ' + fullpath + ' because the scratch disk is almost full')
+				self.skipped.add(fullpath)
+				return None
+
+			staged = StagedFile(fullpath, self.get_staged_path(fullpath), stat.st_size, stat.st_mtime)
+			self.files[fullpath] = staged
+			self.used += staged.size
+			metrics.set('vidscan_staged_bytes', self.used)
+			return staged
+
+	def run(self):
+		while True:
+			with self.cond:
+				fullpath = self.next_fullpath()
+				while fullpath is None and not self.stopped:
+					self.cond.wait()
+					fullpath = self.next_fullpath()
+				if self.stopped:
+					return
+
+			staged = self.reserve(fullpath)
+			if staged is None:
+				with self.cond:
+					# Nothing changed since the file was picked, wait until something does
+					if not self.stopped and self.next_fullpath() == fullpath:
+						self.cond.wait(10)
+				continue
+			self.copy(staged)
+
+	def copy(self, staged):
+		tmp_path = staged.path + '.part'
+		copy_start = time.time()
+		try:
+			with open(staged.fullpath, 'rb') as src:
+				with open(tmp_path, 'wb') as dst:
+					# Stop early if the copy was discarded because its job didn't wait for it
+					while not self.stopped and self.files.get(staged.fullpath) is staged:
+						data = src.read(Stager.BLOCK_SIZE)
+						if not data:
+							break
+						dst.write(data)
+						staged.copied += len(data)
+			if not self.stopped and self.files.get(staged.fullpath) is staged:
+				os.rename(tmp_path, staged.path)
+		except (IOError, OSError) as e:
+			log.warn('Error staging ' + staged.fullpath + '. Error = ' + str(e))
+			with self.cond:
+				self.skipped.add(staged.fullpath)
+				self.discard(staged)
+			return
+
+		with self.cond:
+			if self.stopped or self.files.get(staged.fullpath) is not staged:
+				self.discard(staged)
+				return
+			staged.ready = True
+			self.cond.notify_all()
+		log.debug('Staged ' + staged.fullpath + ' in ' + str(int(time.time() - copy_start)) + 's')
@@ -8,21 +8,143 @@ from termcolor import colored,cprint
 import time
 
 import threading
-import Queue
+import multiprocessing
+import collections
+import hashlib
 
 import common
 from common import AppError, AppLogger
-from VideoFile import VideoFile, VideoFileOp
+from VideoFile import VideoFile, VideoFileOp, VideoSegment
 from Scanner import Scanner
 from Scheduler import Scheduler, LockError
+from Metrics import registry as metrics
+import cost
 
 log = AppLogger(__name__)
+# ffmpeg's own messages go to a separate rotated log file, see logging.conf
+ffmpeg_log = logging.getLogger('vidscan.ffmpeg')
+
+"""
+Output containers that ffmpeg can write to a pipe when enabled. Their output is hashed while it is
+written. Otherwise ffmpeg writes a seekable file so it can rewrite the headers (the mp4 index, the
+mkv seek index and duration) and the checksum is computed after the encode. avi always needs a file.
+"""
+PIPED_MKV_FORMATS = {
+	'mkv': 'matroska'
+}
+FRAGMENTED_MP4_FORMATS = {
+	'mp4': 'mp4',
+	'm4v': 'mp4'
+}
+
+# Minimum number of seconds between two progress line updates
+PROGRESS_RENDER_INTERVAL = 1.0
+
+# x264 rate control settings
+PRESET = 'veryfast'
+CRF = 23
+
+class CapacityGate(object):
+	"""
+	Share of the computer used by running jobs. A job tuned to run N at a time takes 1/N of it,
+	so a worker waits before starting a job that doesn't fit next to the running ones. Jobs that
+	don't run x264 (share 0) hardly use the CPU but read and write the share, so they're counted
+	separately and at most MAX_LIGHT_JOBS of them run at a time
+	"""
+	MAX_LIGHT_JOBS = 4
+
+	def __init__(self):
+		self.used = 0.0
+		self.light = 0
+		self.cond = threading.Condition()
+
+	def acquire(self, share):
+		with self.cond:
+			if not share:
+				while self.light >= CapacityGate.MAX_LIGHT_JOBS:
+					self.cond.wait(1)
+				self.light += 1
+				return
+			# A job always fits on an idle computer
+			while self.used > 0 and self.used + share > 1.0 + 1e-6:
+				self.cond.wait(1)
+			self.used += share
+
+	def release(self, share):
+		with self.cond:
+			if share:
+				self.used = max(0.0, self.used - share)
+			else:
+				self.light = max(0, self.light - 1)
+			self.cond.notify_all()
+
+class FFmpegProgress(object):
+	"""
+	Parser for the key=value blocks ffmpeg writes with -progress. Each block ends with a
+	progress=continue or progress=end line. Other lines are ffmpeg's regular log messages
+	"""
+	KEYS = frozenset(['frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'out_time_ms', 'out_time', 
+		'dup_frames', 'drop_frames', 'speed', 'progress'])
+
+	def __init__(self, name=''):
+		self.name = name
+		self.values = {}
+		self.snapshot = {}
+		self.messages = collections.deque(maxlen=20)
+
+	def feed(self, line):
+		"""
+		Returns the completed block as a dict when line ends one, otherwise None
+		"""
+		line = line.strip()
+		key, sep, value = line.partition('=')
+		if sep and (key in FFmpegProgress.KEYS or key.startswith('stream_')):
+			self.values[key] = value.strip()
+			if key == 'progress':
+				self.snapshot = self.values
+				self.values = {}
+				return self.snapshot
+			return None
+
+		if line:
+			ffmpeg_log.debug('[' + self.name + '] ' + line)
+			self.messages.append(line)
+		return None
+
+	def seconds(self):
+		out_time_us = self.snapshot.get('out_time_us', self.snapshot.get('out_time_ms', ''))
+		if out_time_us.isdigit():
+			return int(out_time_us) / 1000000.0
+		return 0.0
+
+	def bytes(self):
+		total_size = self.snapshot.get('total_size', '')
+		if total_size.isdigit():
+			return int(total_size)
+		return 0
+
+	def size(self):
+		total_size = self.snapshot.get('total_size', '')
+		if total_size.isdigit():
+			return str(int(total_size) // 1024) + 'kB'
+		return total_size
 
 class Transcoder(object):
-	def __init__(self, destpath, videofiles, scheduler):
+	def __init__(self, destpath, videofiles, scheduler, jobs=1, autotuner=None, stager=None):
 		self.destpath = destpath
 		self.videofiles = videofiles
 		self.scheduler = scheduler
+		self.autotuner = autotuner
+		# Copies the next source files to local disk while the current ones encode
+		self.stager = stager
+		self.capacity = None
+		if autotuner:
+			# Run as many workers as the resolution class with the most parallel jobs needs and
+			# let the capacity gate hold back jobs of classes that want fewer
+			self.jobs = jobs or autotuner.max_jobs()
+			self.capacity = CapacityGate()
+		else:
+			self.jobs = max(1, jobs or 1)
 
 		scheduler.attach_cleanup_listener()
 		self.init_transcoder()
@@ -33,25 +155,85 @@ class Transcoder(object):
 	def get_transcoder_args(self, videofile):
 		pass
 
-	def transcode(self, videofile, transcoder_args):
+	def get_encoder_settings(self, videofile):
+		"""
+		Encoder settings recorded in the status entry, or None. 'jobs' is how many jobs like this one run at a time
+		"""
+		return None
+
+	def transcode(self, videofile, transcoder_args, destfullpath):
+		"""
+		Returns a tuple (is_success, md5). md5 is None if the checksum wasn't computed during the encode
+		"""
 		pass
 	
 	def run(self):
 		"""
-		Start the transcoding loop
+		Start the transcoding loop. With more than one job, each job runs the loop in its own worker thread
 		"""
-		videofile = self.scheduler.get_next_videofile()
-		while videofile is not None:
-			transcoder_args, destfullpath = self.get_transcoder_args(videofile)
+		try:
+			if self.jobs == 1:
+				self.run_worker()
+				return
+
+			workers = []
+			for i in range(self.jobs):
+				worker = threading.Thread(target=self.run_worker, name='transcoder-' + str(i))
+				worker.daemon = True
+				worker.start()
+				workers.append(worker)
+
+			# Join with a timeout so the main thread can still handle signals
+			for worker in workers:
+				while worker.is_alive():
+					worker.join(1)
+		finally:
+			# Stop the heartbeat before the interpreter shuts down
+			self.scheduler.closestatusfile()
+
+	def run_worker(self):
+		while True:
+			with self.scheduler.claim_lock:
+				videofile = self.scheduler.get_next_videofile()
+				if videofile is None:
+					return
+
+				transcoder_args, destfullpath = self.get_transcoder_args(videofile)
+				encoder = self.get_encoder_settings(videofile)
+				share = 1.0 / encoder['jobs'] if encoder else 0.0
+				if self.capacity:
+					self.capacity.acquire(share)
+				try:
+					self.scheduler.start(videofile, destfullpath, encoder)
+				except LockError as e:
+					if self.capacity:
+						self.capacity.release(share)
+					log.info('Couldn\'t acquire a lock. Skipping file: ' + destfullpath + ' (' + e.value + ')')
+					continue
 
+				if self.stager:
+					# Pin the copy of this file before it drops out of the expected files
+					self.stager.claim(videofile.fullpath)
+					self.stager.prefetch(self.scheduler.peek_pending(self.jobs))
+
+			job_start = time.time()
+			# Waits if the copy of this file is still being made
+			staged_path = self.stager.acquire(videofile.fullpath) if self.stager else None
 			try:
-				self.scheduler.start(videofile, destfullpath)
-				is_success = self.transcode(videofile, transcoder_args)
-				self.scheduler.end(videofile, is_success)
-			except LockError:
-				log.info('Couldn\'t acquire a lock. Skipping file: ' + destfullpath)
+				is_success, md5 = self.transcode(videofile, transcoder_args, destfullpath)
+			except Exception as e:
+				log.error('Error transcoding ' + videofile.relpath + ': ' + str(e))
+				is_success, md5 = (False, None)
+			finally:
+				if self.stager:
+					self.stager.release(videofile.fullpath, staged_path is not None)
+				if self.capacity:
+					self.capacity.release(share)
+			self.scheduler.end(videofile, is_success, md5)
 
-			videofile = self.scheduler.get_next_videofile()
+			result = 'success' if is_success else 'fail'
+			metrics.inc('vidscan_jobs_total', result=result)
+			metrics.observe('vidscan_job_duration_seconds', time.time() - job_start, result=result)
 
 class FFmpegTranscoder(Transcoder):
 	def init_transcoder(self):
@@ -68,133 +250,336 @@ class FFmpegTranscoder(Transcoder):
 		log.info('Detected x264 output bit depth = ' + str(self.x264_bit_depth))
 
 
+	def get_encoder_settings(self, videofile):
+		"""
+		x264 settings of a video transcode. Stream copies and concatenations of segments have none
+		"""
+		if not videofile.op_flag & VideoFileOp.TRANSCODE_VIDEO or self.scheduler.is_segmented(videofile):
+			return None
+
+		# Streams of a different bit depth can't be joined with stream copy, so chunks and segments record it
+		if self.x264_bit_depth == 8:
+			profile, pix_fmt = ('high', 'yuv420p')
+		else:
+			profile, pix_fmt = ('high10', 'yuv420p10le')
+		settings = {'preset': PRESET, 'crf': CRF, 'profile': profile, 'pix_fmt': pix_fmt, 'threads': None, 'jobs': self.jobs}
+		if self.autotuner:
+			resolution_class = cost.resolution_class(videofile.v_resolution)
+			tuned = self.autotuner.get(resolution_class)
+			settings.update({'threads': tuned['threads'], 'jobs': tuned['jobs'], 'resolution_class': resolution_class})
+		elif self.jobs > 1:
+			# Split the cores between the concurrent jobs instead of letting every encoder grab all of them
+			settings['threads'] = max(1, multiprocessing.cpu_count() // self.jobs)
+		return settings
+
+	def get_video_args(self, videofile):
+		"""
+		Encoder options for transcoding the video stream
+		"""
+		video_args = ['libx264']
+
+		settings = self.get_encoder_settings(videofile)
+
+		video_args.append('-profile:v')
+		video_args.append(settings['profile'])
+
+		video_args.append('-pix_fmt')
+		video_args.append(settings['pix_fmt'])
+
+		video_args.append('-crf')
+		video_args.append(str(settings['crf']))
+
+		video_args.append('-preset')
+		video_args.append(settings['preset'])
+
+		if settings['threads']:
+			video_args.append('-threads')
+			video_args.append(str(settings['threads']))
+
+		return video_args
+
+	def get_audio_args(self, videofile):
+		if videofile.op_flag & VideoFileOp.TRANSCODE_AUDIO:
+			return ['libfdk_aac']
+		return ['copy']
+
+	def get_output_args(self, newfullpath):
+		output_format = self.get_stream_format(newfullpath)
+		if output_format:
+			# Stream the output through our pipe so it can be hashed as it's written
+			output_args = ['-f', output_format]
+			if output_format == 'mp4':
+				output_args.extend(['-movflags', 'frag_keyframe+empty_moov'])
+			output_args.append('pipe:1')
+			return output_args
+		return [newfullpath]
+
 	def get_transcoder_args(self, videofile):
+		if isinstance(videofile, VideoSegment):
+			return self.get_segment_args(videofile)
+		if self.scheduler.is_segmented(videofile):
+			return self.get_concat_args(videofile)
+		if self.scheduler.is_resumable(videofile):
+			# The chunks are encoded first, see transcode()
+			return self.get_join_args(videofile, os.path.join(self.scheduler.get_chunk_folder(videofile), 'concat.txt'))
+
 		newfilename = videofile.relpath
-		ffmpeg_args = ['ffmpeg', '-i', videofile.fullpath, '-y']
+		ffmpeg_args = ['ffmpeg', '-nostats', '-progress', 'pipe:2', '-i', videofile.fullpath, '-y']
 
 		if common.DEBUG_SHORT_TRANSCODE:
 			ffmpeg_args.extend(['-ss', '0', '-t', '120'])
 		
 		ffmpeg_args.append('-c:v')
 		if videofile.op_flag & VideoFileOp.TRANSCODE_VIDEO:
-			ffmpeg_args.append('libx264')
-
-			if self.x264_bit_depth == 8:
-				ffmpeg_args.append('-profile:v')
-				ffmpeg_args.append('high')
-			else:
-				ffmpeg_args.append('-profile:v')
-				ffmpeg_args.append('high10')
-
-			ffmpeg_args.append('-crf')
-			ffmpeg_args.append('23')
-
-			ffmpeg_args.append('-preset')
-			ffmpeg_args.append('veryfast')
-
+			ffmpeg_args.extend(self.get_video_args(videofile))
 			newfilename = os.path.splitext(newfilename)[0] + '.mp4'
 		else:
 			ffmpeg_args.append('copy')
 
 		ffmpeg_args.append('-c:a')
-		if videofile.op_flag & VideoFileOp.TRANSCODE_AUDIO:
-			ffmpeg_args.append('libfdk_aac')
-		else:
-			ffmpeg_args.append('copy')
+		ffmpeg_args.extend(self.get_audio_args(videofile))
 
 		newfullpath = os.path.join(self.destpath, newfilename)
-		ffmpeg_args.append(newfullpath)
+		ffmpeg_args.extend(self.get_output_args(newfullpath))
 	
 		return (ffmpeg_args, newfullpath)
-	
-	def transcode(self, videofile, ffmpeg_args):
+
+	def get_segment_args(self, segment):
+		"""
+		Encode the video of one time range. Seeking before -i is frame accurate when re-encoding and
+		every segment starts on a keyframe, so the segments can be joined with stream copy
+		"""
+		newfullpath = self.scheduler.get_segment_destpath(segment)
+		ffmpeg_args = ['ffmpeg', '-nostats', '-progress', 'pipe:2', 
+			'-ss', str(segment.segment_start), '-i', segment.fullpath, '-y',
+			'-t', str(segment.duration),
+			'-map', '0:v:0', '-an', '-sn', '-c:v']
+		ffmpeg_args.extend(self.get_video_args(segment))
+		ffmpeg_args.extend(self.get_output_args(newfullpath))
+
+		return (ffmpeg_args, newfullpath)
+
+	def get_concat_args(self, videofile):
+		"""
+		Join the encoded video segments and add the audio from the source
+		"""
+		segments = self.scheduler.get_segments(videofile)
+		segment_folder = os.path.dirname(self.scheduler.get_segment_destpath(segments[0]))
+		concat_list = os.path.join(segment_folder, 'concat.txt')
+		self.write_concat_list(concat_list, [self.scheduler.get_segment_destpath(segment) for segment in segments])
+
+		return self.get_join_args(videofile, concat_list)
+
+	@staticmethod
+	def write_concat_list(concat_list, paths):
+		with open(concat_list, 'w') as f:
+			for path in paths:
+				f.write("file '" + os.path.basename(path) + "'\n")
+
+	def get_join_args(self, videofile, concat_list):
+		"""
+		Join the video files of a concat list and add the audio from the source. The audio stream is
+		the one a plain transcode gets from ffmpeg's stream selection, found when the source was probed
+		"""
+		newfullpath = os.path.join(self.destpath, os.path.splitext(videofile.relpath)[0] + '.mp4')
+		ffmpeg_args = ['ffmpeg', '-nostats', '-progress', 'pipe:2', 
+			'-f', 'concat', '-safe', '0', '-i', concat_list, '-i', videofile.fullpath, '-y']
+
+		if common.DEBUG_SHORT_TRANSCODE:
+			ffmpeg_args.extend(['-t', '120'])
+
+		ffmpeg_args.extend(['-map', '0:v:0', '-map', '1:a:' + str(videofile.a_stream or 0) + '?', '-c:v', 'copy', '-c:a'])
+		ffmpeg_args.extend(self.get_audio_args(videofile))
+		ffmpeg_args.extend(self.get_output_args(newfullpath))
+
+		return (ffmpeg_args, newfullpath)
+
+	def get_chunk_args(self, videofile, resume_point):
+		"""
+		Encode the video from resume_point on into chunks. Keyframes are forced at every chunk boundary
+		so the segment muxer cuts exactly there and a restarted job can seek to the first missing chunk
+		"""
+		interval = self.scheduler.checkpoint_interval
+		ffmpeg_args = ['ffmpeg', '-nostats', '-progress', 'pipe:2']
+		if resume_point:
+			ffmpeg_args.extend(['-ss', str(resume_point)])
+		ffmpeg_args.extend(['-i', videofile.fullpath, '-y'])
+
+		if common.DEBUG_SHORT_TRANSCODE:
+			ffmpeg_args.extend(['-t', '120'])
+
+		ffmpeg_args.extend(['-map', '0:v:0', '-an', '-sn', '-c:v'])
+		ffmpeg_args.extend(self.get_video_args(videofile))
+		ffmpeg_args.extend(['-force_key_frames', 'expr:gte(t,n_forced*' + str(interval) + ')',
+			'-f', 'segment', '-segment_time', str(interval), '-segment_start_number', str(resume_point // interval),
+			'-reset_timestamps', '1', os.path.join(self.scheduler.get_chunk_folder(videofile), 'chunk%03d.mkv')])
+
+		return ffmpeg_args
+
+	def get_stream_format(self, destfullpath):
+		"""
+		Return the ffmpeg format name if the output can be written through a pipe, otherwise None
+		"""
+		extension = os.path.splitext(destfullpath)[1][1:].lower()
+		if common.PIPED_MKV and extension in PIPED_MKV_FORMATS:
+			return PIPED_MKV_FORMATS[extension]
+		if common.FRAGMENTED_MP4 and extension in FRAGMENTED_MP4_FORMATS:
+			return FRAGMENTED_MP4_FORMATS[extension]
+		return None
+
+	def transcode(self, videofile, ffmpeg_args, destfullpath):
 		filename = os.path.basename(videofile.fullpath)
 
 		log.info('Starting ' + filename)
+
+		if self.scheduler.is_resumable(videofile):
+			resume_point = self.scheduler.get_resume_point(videofile)
+			if resume_point:
+				log.info('Resuming ' + filename + ' at ' + common.seconds_to_duration(resume_point), 'cyan')
+			is_success, md5 = self.run_ffmpeg(videofile, self.get_chunk_args(videofile, resume_point), None, resume_point)
+			if not is_success:
+				return (False, None)
+
+			log.debug('Joining the chunks of ' + filename)
+			self.write_concat_list(os.path.join(self.scheduler.get_chunk_folder(videofile), 'concat.txt'), self.scheduler.get_chunk_paths(videofile))
+
+		is_success, md5 = self.run_ffmpeg(videofile, ffmpeg_args, destfullpath)
+		if is_success:
+			log.info('Finished ' + filename, 'green')
+		return (is_success, md5)
+
+	def run_ffmpeg(self, videofile, ffmpeg_args, destfullpath, start_seconds=0):
+		"""
+		Run ffmpeg and render its progress. start_seconds is where in the source the encode starts
+		"""
+		filename = os.path.basename(videofile.fullpath)
+
+		# Tell the progress lines of concurrent jobs apart
+		job_prefix = '[' + filename + '] ' if self.jobs > 1 else ''
+		staged_path = self.stager.get(videofile.fullpath) if self.stager else None
+		if staged_path:
+			log.debug('Reading ' + filename + ' from the staged copy ' + staged_path)
+			ffmpeg_args = [staged_path if arg == videofile.fullpath else arg for arg in ffmpeg_args]
 		log.debug('CMD = ' + " ".join(ffmpeg_args))
+		ffmpeg_log.info('[' + filename + '] CMD = ' + " ".join(ffmpeg_args))
 
-		def log_queue_worker(pipe, queue, stop_event):
-			while True:
-				chunk = pipe.read(256)
+		output_errors = []
+		def output_hash_worker(process, out, md5):
+			try:
 				while True:
-					try:
-						# Post to the queue with a large timeout in case the
-						# queue is full.
-						queue.put(chunk, block=True, timeout=60)
+					data = process.stdout.read(1048576)
+					if not data:
 						break
-					except Queue.Full:
-						if stop_event.isSet():
-							break
-						continue
-				if stop_event.isSet() or chunk=="":
-					break
-			pipe.close()
-
-		queue = Queue.Queue(1000)
-		stop_event = threading.Event()
-		
-		process = subprocess.Popen(ffmpeg_args, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-
-		thread = threading.Thread(target=log_queue_worker, args=(process.stdout, queue, stop_event))
-		thread.daemon = True
-		thread.start()
-
-
-		hour, minute, second = videofile.duration.split(':')
-		target_seconds = float(hour) * 3600 + float(minute) * 60 + float(second)
-
-		avg_fps, encode_time_start, num_samples = (0, time.time(), 0)
-		while process.poll() is None or not queue.empty():
-			if not queue.empty():
-				chunk = queue.get()
-				log.debug(chunk)
-				queue.task_done()
-				for line in chunk.split("\n"):
-					match = re.search('frame=\s*([^\s]+)\s*fps=\s*([^\s]+)\s*q=\s*([^\s]+)\s*size=\s*([^\s]+)\s*time=\s*([^\s]+)\s*bitrate=\s*([^\s]+)\s*', line)
-					if match:
-						frame, fps, q, size, video_time, bitrate = match.groups()
-						hour, minute, second = video_time.split(':')
-						current_seconds = float(hour) * 3600 + float(minute) * 60 + float(second)
-						progress = int(current_seconds/target_seconds*10000) / 100.0
-
-						avg_fps += float(fps)
-						num_samples += 1
-						
-						sys.stdout.write(
-							("In progress ({progress}%) "	
-							+ "fps = {fps} "
-							+ "time = {video_time} "
-							+ "bitrate = {bitrate} "
-							+ "size = {size} "
-							+ "\r").format( 
-								progress = progress,
-								fps = fps,
-								video_time = video_time,
-								bitrate = bitrate,
-								size = size
-							)
-						)
-						sys.stdout.flush()
-
-		sys.stdout.write('                                                                                             \r')
-		sys.stdout.flush()
+					out.write(data)
+					md5.update(data)
+				out.close()
+			except (IOError, OSError) as e:
+				# e.g. disk full or the share went away. ffmpeg would block on the full pipe, stop it
+				output_errors.append(e)
+				process.kill()
+				try:
+					out.close()
+				except (IOError, OSError):
+					pass
+			finally:
+				process.stdout.close()
+
+		is_piped = ffmpeg_args[-1] == 'pipe:1'
+		output_thread = None
+		md5 = None
+		if is_piped:
+			md5 = hashlib.md5()
+			# Open the output before starting ffmpeg so a failure here doesn't leave it blocked on the pipe
+			out = open(destfullpath, 'wb')
+			process = subprocess.Popen(ffmpeg_args, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+
+			output_thread = threading.Thread(target=output_hash_worker, args=(process, out, md5))
+			output_thread.daemon = True
+			output_thread.start()
+		else:
+			devnull = open(os.devnull, 'wb')
+			process = subprocess.Popen(ffmpeg_args, stderr=subprocess.PIPE, stdout=devnull)
+			devnull.close()
+
+		target_seconds = videofile.duration
+
+		# ffmpeg writes -progress blocks to stderr. Block on readline so the supervisor sleeps between updates
+		progress = FFmpegProgress(filename)
+		avg_fps, encode_time_start, num_samples, last_render = (0, time.time(), 0, 0)
+
+		worker = threading.current_thread().name
+		reported = {'seconds': 0.0, 'bytes': 0}
+		def report_metrics(fps):
+			current_seconds, current_bytes = (progress.seconds(), progress.bytes())
+			elapsed = time.time() - encode_time_start
+			metrics.set('vidscan_encode_fps', float(fps), worker=worker)
+			metrics.set('vidscan_encode_speed', current_seconds / elapsed if elapsed else 0.0, worker=worker)
+			metrics.inc('vidscan_encoded_seconds_total', max(0.0, current_seconds - reported['seconds']))
+			metrics.inc('vidscan_bytes_written_total', max(0, current_bytes - reported['bytes']))
+			reported.update({'seconds': current_seconds, 'bytes': current_bytes})
+		for line in iter(process.stderr.readline, ''):
+			snapshot = progress.feed(line)
+			if snapshot is None:
+				continue
+
+			fps = snapshot.get('fps', '0')
+			avg_fps += float(fps)
+			num_samples += 1
+
+			now = time.time()
+			if now - last_render < PROGRESS_RENDER_INTERVAL:
+				continue
+			last_render = now
+			report_metrics(fps)
+
+			current_seconds = progress.seconds()
+			percent = int((start_seconds + current_seconds)/target_seconds*10000) / 100.0 if target_seconds else 0
+			# The console batches the lines of all jobs and limits how often it redraws them
+			common.console.set_progress(worker,
+				(job_prefix
+				+ "In progress ({progress}%) "	
+				+ "fps = {fps} "
+				+ "time = {video_time} "
+				+ "bitrate = {bitrate} "
+				+ "size = {size}").format( 
+					progress = percent,
+					fps = fps,
+					video_time = snapshot.get('out_time', ''),
+					bitrate = snapshot.get('bitrate', ''),
+					size = progress.size()
+				)
+			)
+		process.stderr.close()
+
+		# Count the progress made since the last update, then drop the gauges of the finished encode
+		report_metrics(0)
+		metrics.remove('vidscan_encode_fps', worker=worker)
+		metrics.remove('vidscan_encode_speed', worker=worker)
+
+		common.console.remove_progress(worker)
 
 		process.wait()
-		thread.join(10)
+		if output_thread:
+			# the output file must be fully flushed before it's checksummed or recorded
+			output_thread.join()
+
+		if output_errors:
+			log.error('ERROR: writing the output of ' + filename + ' failed: ' + str(output_errors[0]))
+			return (False, None)
 		
 		if process.returncode != 0:
 			log.error('ERROR: transcoding ' + filename + ' closed with unsuccessful exit code: ' + str(process.returncode))
-			return False
+			for line in progress.messages:
+				log.error(line)
+			return (False, None)
 
-		avg_fps = int(avg_fps / num_samples)
+		avg_fps = int(avg_fps / num_samples) if num_samples else 0
 		total_sec = int(time.time() - encode_time_start)
 		total_min = int(total_sec / 60.0)
 		remainder_sec = total_sec % 60
 		encode_time = str(remainder_sec) + 's'
 		if total_min > 0:
 			encode_time = str(total_min) + 'm ' + encode_time
-		sys.stdout.write(("Encode time = {encode_time}, Avg fps = {fps}\n").format(encode_time = encode_time, fps = avg_fps))
-		sys.stdout.flush()
-		log.info('Finished ' + filename, 'green')
-		return True
+		common.console.write((job_prefix + "Encode time = {encode_time}, Avg fps = {fps}").format(encode_time = encode_time, fps = avg_fps))
+		return (True, md5.hexdigest() if md5 else None)
 
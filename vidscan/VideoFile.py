@@ -1,15 +1,68 @@
-
 import json
+import re
+
+import common
 
 
 class VideoFileOp:
 	TRANSCODE_AUDIO=1
 	TRANSCODE_VIDEO=2
 
+# 997 kb/s
+BITRATE_RE = re.compile('^(\d+(?:\.\d+)?)\s*([kmg]?)b/s$', re.IGNORECASE)
+BITRATE_SCALE = {'': 0.001, 'k': 1, 'm': 1000, 'g': 1000000}
+
+def parse_duration(value):
+	"""
+	Duration in seconds. Accepts numbers and ffmpeg durations (HH:MM:SS.cc) from older status and cache files
+	"""
+	if value is None or isinstance(value, (int, long, float)):
+		return value
+	return common.duration_to_seconds(value) if ':' in value else float(value)
+
+def parse_bitrate(value):
+	"""
+	Bitrate in kb/s. Accepts numbers and ffmpeg bitrates (997 kb/s) from older status and cache files
+	"""
+	if value is None or isinstance(value, (int, long)):
+		return value
+	match = BITRATE_RE.match(str(value).strip())
+	if not match:
+		return None
+	return int(float(match.group(1)) * BITRATE_SCALE[match.group(2).lower()])
+
+# Slot names of VideoFile and its subclasses, filled in by VideoFile.fields()
+FIELDS_BY_CLASS = {}
+
+def intern_string(value):
+	"""
+	Interned copy of a string. json gives unicode strings, those are interned if they're plain ascii
+	"""
+	if isinstance(value, unicode):
+		try:
+			value = value.encode('ascii')
+		except UnicodeError:
+			return value
+	return intern(value)
+
 class VideoFile(object):
+	"""
+	Probe results of a source file. Slots keep a large library small in memory: durations are seconds,
+	bitrates are kb/s and the codec strings shared by many files are interned. a_stream is the index 
+	of the described audio stream among the audio streams of the file
+	"""
+	__slots__ = ('fullpath', 'relpath', 'bitrate', 'duration', 'v_codec', 'v_resolution', 'a_codec', 'a_channel', 'a_bitrate', 'a_stream', 'op_flag', 'size')
+
+	PARSERS = {
+		'duration': parse_duration,
+		'bitrate': parse_bitrate,
+		'a_bitrate': parse_bitrate
+	}
+	INTERNED = frozenset(['v_codec', 'v_resolution', 'a_codec', 'a_channel'])
+
 	def __init__(self, fullpath = None, relpath = None):
-			
-		self.fullpath = fullpath	
+
+		self.fullpath = fullpath
 		self.relpath = relpath
 		self.bitrate = None
 		self.duration = None
@@ -18,9 +71,55 @@ class VideoFile(object):
 		self.a_codec = None
 		self.a_channel = None
 		self.a_bitrate = None
+		self.a_stream = None
 		self.op_flag = 0
 		self.size = None
 
+	@classmethod
+	def fields(cls):
+		"""
+		Names of all slots, including those of base classes
+		"""
+		if cls not in FIELDS_BY_CLASS:
+			FIELDS_BY_CLASS[cls] = frozenset(name for klass in cls.__mro__ for name in klass.__dict__.get('__slots__', ()))
+		return FIELDS_BY_CLASS[cls]
+
+	def todict(self):
+		return dict((name, getattr(self, name)) for name in self.fields())
+
 	def update(self, entries):
-		self.__dict__.update(entries)	
-	
+		"""
+		Set fields from a dict, e.g. a status or probe cache entry. Keys that aren't fields of this class are ignored
+		"""
+		names = self.fields()
+		for key, value in entries.items():
+			if key not in names:
+				continue
+			if key in VideoFile.PARSERS:
+				value = VideoFile.PARSERS[key](value)
+			elif key in VideoFile.INTERNED and isinstance(value, basestring):
+				value = intern_string(value)
+			setattr(self, key, value)
+
+
+class VideoSegment(VideoFile):
+	"""
+	A time range of a source video that is encoded on its own. The encoded segments
+	of a file are concatenated into the final output once all of them are done
+	"""
+	__slots__ = ('parent_relpath', 'segment_index', 'segment_count', 'segment_start')
+
+	def __init__(self, videofile=None, index=0, count=0, start=0, duration=0):
+		super(VideoSegment, self).__init__()
+
+		if videofile is not None:
+			self.update(dict((k, getattr(videofile, k)) for k in VideoFile.fields()))
+			self.relpath = videofile.relpath + '#seg%03d' % index
+			self.parent_relpath = videofile.relpath
+		else:
+			self.parent_relpath = None
+
+		self.duration = round(duration, 2)
+		self.segment_index = index
+		self.segment_count = count
+		self.segment_start = start
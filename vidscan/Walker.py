@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import fnmatch
+import hashlib
+
+import common
+from common import AppLogger
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+log = AppLogger(__name__)
+
+class Walker(object):
+	"""
+	Directory walker that prunes excluded folders and ignored names. Directory entries come from
+	scandir when it's available, so telling folders from files doesn't need a stat per entry.
+	With a cache, the listing of every folder is remembered along with its mtime and a folder
+	whose mtime didn't change isn't listed again on the next walk
+	"""
+	DEFAULT_IGNORE = ['*.vslock', '*.tmp']
+	# Folders modified this recently may still change within their mtime's resolution and aren't cached
+	MTIME_SETTLE = 2
+
+	def __init__(self, root, excludes=None, ignore=None, cache_path=None):
+		self.root = root
+		self.excludes = set(self.normpath(path) for path in (excludes or []))
+		self.ignore = list(ignore or [])
+		self.cache_path = cache_path
+		self.cache = {}
+		self.seen = set()
+		self.hits = 0
+		self.misses = 0
+
+		if cache_path:
+			self.load()
+
+	@staticmethod
+	def normpath(path):
+		return os.path.normcase(os.path.abspath(path))
+
+	@staticmethod
+	def default_path(root):
+		"""
+		Per source folder cache file in the user's home directory
+		"""
+		key = hashlib.md5(os.path.abspath(root)).hexdigest()[:12]
+		return os.path.join(os.path.expanduser('~'), '.vidscan', 'walkcache.' + key + '.json')
+
+	def load(self):
+		if not os.path.isfile(self.cache_path):
+			return
+		try:
+			with open(self.cache_path, 'r') as f:
+				data = json.load(f)
+		except ValueError as e:
+			log.warn('Ignoring invalid walk cache (' + self.cache_path + '). Error = ' + str(e))
+			return
+		if data.get('root') == os.path.abspath(self.root):
+			self.cache = data.get('dirs', {})
+
+	def save(self):
+		if not self.cache_path:
+			return
+		for reldir in [reldir for reldir in self.cache if reldir not in self.seen]:
+			del self.cache[reldir]
+
+		folder = os.path.dirname(self.cache_path)
+		if folder and not os.path.isdir(folder):
+			os.makedirs(folder)
+		common.write_file_atomic(self.cache_path, lambda f: json.dump({'root': os.path.abspath(self.root), 'dirs': self.cache}, f, sort_keys=True, separators=(',', ':')))
+		log.debug('Walk cache: ' + str(self.hits) + ' folders unchanged, ' + str(self.misses) + ' listed')
+
+	def is_ignored(self, name):
+		for pattern in Walker.DEFAULT_IGNORE + self.ignore:
+			if fnmatch.fnmatch(name, pattern):
+				return True
+		return False
+
+	def is_excluded(self, path):
+		return self.normpath(path) in self.excludes
+
+	def is_inside_excluded(self, path):
+		"""
+		True if path is an excluded folder or anywhere below one
+		"""
+		path = self.normpath(path)
+		for exclude in self.excludes:
+			if path == exclude or path.startswith(exclude.rstrip(os.sep) + os.sep):
+				return True
+		return False
+
+	@staticmethod
+	def scan_dir(dirpath):
+		"""
+		Returns the sorted names of the sub folders and the other entries of a folder. Symlinked folders aren't followed
+		"""
+		dirs, files = ([], [])
+		if scandir:
+			for entry in scandir(dirpath):
+				try:
+					is_dir = entry.is_dir() and not entry.is_symlink()
+				except OSError:
+					is_dir = False
+				(dirs if is_dir else files).append(entry.name)
+		else:
+			for name in os.listdir(dirpath):
+				fullpath = os.path.join(dirpath, name)
+				(dirs if os.path.isdir(fullpath) and not os.path.islink(fullpath) else files).append(name)
+		dirs.sort()
+		files.sort()
+		return (dirs, files)
+
+	def list_dir(self, dirpath):
+		if not self.cache_path:
+			return self.scan_dir(dirpath)
+
+		reldir = os.path.relpath(dirpath, self.root).replace('\\', '/')
+		mtime = os.stat(dirpath).st_mtime
+		self.seen.add(reldir)
+		entry = self.cache.get(reldir)
+		if entry and entry['mtime'] == mtime:
+			self.hits += 1
+			return (entry['dirs'], entry['files'])
+
+		self.misses += 1
+		dirs, files = self.scan_dir(dirpath)
+		if time.time() - mtime > Walker.MTIME_SETTLE:
+			self.cache[reldir] = {'mtime': mtime, 'dirs': dirs, 'files': files}
+		else:
+			self.cache.pop(reldir, None)
+		return (dirs, files)
+
+	def walk(self, top=None):
+		"""
+		Yield (folder, file names) for every folder under top, depth first in name order
+		"""
+		stack = [top or self.root]
+		while stack:
+			dirpath = stack.pop()
+			if self.is_excluded(dirpath):
+				log.debug('Skipping excluded folder ' + dirpath)
+				continue
+			try:
+				dirs, files = self.list_dir(dirpath)
+			except OSError as e:
+				log.warn('Cannot list folder ' + dirpath + ': ' + str(e))
+				continue
+
+			yield (dirpath, [file for file in files if not self.is_ignored(file)])
+			stack.extend(os.path.join(dirpath, name) for name in reversed(dirs) if not self.is_ignored(name))
@@ -0,0 +1,232 @@
+import os
+import time
+import threading
+import collections
+
+from common import AppLogger
+from Scanner import Scanner, ScanFeed
+from Walker import Walker
+
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
+
+log = AppLogger(__name__)
+
+class PollingWatcher(object):
+	"""
+	Detects new source files by polling directory mtimes. Only directories whose mtime changed are
+	listed again, and their known files are stat'ed again so files replaced by a rename or deleted and
+	recreated are reported too. A file is reported once its size and mtime stop changing between two
+	polls, so files still being copied aren't probed. Files rewritten in place don't change their
+	directory's mtime and aren't noticed
+	"""
+	def __init__(self, scanner, interval):
+		self.scanner = scanner
+		self.interval = interval
+		self.dirs = {}
+		self.files = {}
+		self.settling = {}
+
+		# A separate walker so the scanner's folder cache isn't touched
+		self.walker = Walker(scanner.path, scanner.walker.excludes, scanner.walker.ignore)
+		for root, files in self.walker.walk():
+			self.add_dir(root, files, False)
+
+	@staticmethod
+	def statkey(fullpath):
+		try:
+			st = os.stat(fullpath)
+		except OSError:
+			return None
+		return (st.st_size, st.st_mtime, st.st_ino)
+
+	def add_dir(self, dirpath, files, settle):
+		try:
+			self.dirs[dirpath] = os.stat(dirpath).st_mtime
+		except OSError:
+			return
+		listed = set()
+		for file in files:
+			if not Scanner.checkFile(self.scanner, file):
+				continue
+			fullpath = os.path.join(dirpath, file)
+			listed.add(fullpath)
+			stat = self.statkey(fullpath)
+			if stat is None:
+				continue
+			if not settle:
+				self.files[fullpath] = stat
+			elif self.files.get(fullpath) != stat and fullpath not in self.settling:
+				# New, or replaced since it was last seen
+				self.settling[fullpath] = stat
+
+		# Forget files that were removed from the folder, so they're reported if they come back
+		for fullpath in [path for path in self.files if os.path.dirname(path) == dirpath and path not in listed]:
+			del self.files[fullpath]
+
+	def poll(self):
+		"""
+		Wait for the poll interval and return the full paths of the new or replaced files that finished settling
+		"""
+		time.sleep(self.interval)
+
+		for dirpath in sorted(self.dirs.keys()):
+			try:
+				mtime = os.stat(dirpath).st_mtime
+			except OSError:
+				self.remove_dir(dirpath)
+				continue
+			if mtime == self.dirs[dirpath]:
+				continue
+
+			try:
+				dirs, files = self.walker.scan_dir(dirpath)
+			except OSError:
+				continue
+			self.add_dir(dirpath, [file for file in files if not self.walker.is_ignored(file)], True)
+			for name in dirs:
+				subdir = os.path.join(dirpath, name)
+				if subdir not in self.dirs and not self.walker.is_ignored(name):
+					for root, files in self.walker.walk(subdir):
+						self.add_dir(root, files, True)
+
+		settled = []
+		for fullpath, stat in sorted(self.settling.items()):
+			current = self.statkey(fullpath)
+			if current is None:
+				del self.settling[fullpath]
+			elif current == stat:
+				del self.settling[fullpath]
+				self.files[fullpath] = current
+				settled.append(fullpath)
+			else:
+				self.settling[fullpath] = current
+		return settled
+
+	def remove_dir(self, dirpath):
+		prefix = dirpath + os.sep
+		for path in [path for path in self.dirs if path == dirpath or path.startswith(prefix)]:
+			del self.dirs[path]
+		for path in [path for path in self.files if path.startswith(prefix)]:
+			del self.files[path]
+
+class InotifyWatcher(object):
+	"""
+	Detects new source files with inotify. Files are reported once they're closed after writing
+	or moved into the source folder
+	"""
+	def __init__(self, scanner, interval):
+		self.scanner = scanner
+		self.interval = interval
+		self.changed = collections.OrderedDict()
+		self.mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+
+		self.wm = pyinotify.WatchManager()
+		self.notifier = pyinotify.Notifier(self.wm, self.process, timeout=interval * 1000)
+		# Don't watch the destination when it's inside the source folder, or any other excluded folder
+		self.exclude_filter = scanner.walker.is_inside_excluded
+		self.wm.add_watch(scanner.path, self.mask, rec=True, auto_add=True, exclude_filter=self.exclude_filter)
+
+	def process(self, event):
+		if self.exclude_filter(event.pathname):
+			return
+		if event.dir:
+			if event.mask & pyinotify.IN_MOVED_TO:
+				# auto_add only covers folders created in place. A moved folder arrives with its files
+				self.wm.add_watch(event.pathname, self.mask, rec=True, auto_add=True, exclude_filter=self.exclude_filter)
+				for root, dirs, files in os.walk(event.pathname):
+					dirs[:] = [name for name in dirs if not self.exclude_filter(os.path.join(root, name))]
+					for file in files:
+						if Scanner.checkFile(self.scanner, file):
+							self.changed[os.path.join(root, file)] = True
+			return
+		if event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO) and Scanner.checkFile(self.scanner, event.name):
+			self.changed[event.pathname] = True
+
+	def poll(self):
+		"""
+		Wait up to the poll interval for events and return the full paths of new or rewritten files
+		"""
+		if self.notifier.check_events():
+			self.notifier.read_events()
+			self.notifier.process_events()
+		changed = list(self.changed.keys())
+		self.changed.clear()
+		return changed
+
+class WatchFeed(ScanFeed):
+	"""
+	Scan feed that keeps watching the source folder after the first scan and adds new files
+	as they appear. It never finishes, get() returns after a timeout instead so the scheduler
+	can look at deferred files in between
+	"""
+	POLL_INTERVAL = 10
+	WAIT_TIMEOUT = 10
+
+	def __init__(self, scanner, interval=POLL_INTERVAL):
+		super(WatchFeed, self).__init__(scanner)
+		self.interval = interval
+		self.watcher = None
+		self.relpaths = {}
+
+	def start(self):
+		# Take the directory snapshot before the first scan so files added during the scan are still noticed
+		if pyinotify:
+			self.watcher = InotifyWatcher(self.scanner, self.interval)
+		else:
+			log.debug('pyinotify is not available, polling for new files every ' + str(self.interval) + ' seconds')
+			self.watcher = PollingWatcher(self.scanner, self.interval)
+
+		self.thread = threading.Thread(target=self.__watch, name='watch-feed')
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def add(self, vf):
+		with self.cond:
+			self.relpaths[vf.relpath] = (vf.size, vf.duration)
+			self.videofiles.append(vf)
+			self.cond.notify_all()
+
+	def __watch(self):
+		try:
+			for vf in self.scanner.iterate():
+				self.add(vf)
+		except Exception as e:
+			log.error('Error scanning source files: ' + str(e))
+
+		log.info('Watching ' + self.scanner.path + ' for new files', 'cyan')
+		while True:
+			try:
+				fullpaths = self.watcher.poll()
+			except Exception as e:
+				log.error('Error watching source files: ' + str(e))
+				time.sleep(self.interval)
+				continue
+
+			for fullpath in fullpaths:
+				vf = self.scanner.scanFile(fullpath)
+				if vf is None or self.relpaths.get(vf.relpath) == (vf.size, vf.duration):
+					continue
+				if vf.relpath in self.relpaths:
+					log.info('Found changed video file ' + vf.relpath, 'cyan')
+				else:
+					log.info('Found new video file ' + vf.relpath, 'cyan')
+				self.scanner.result.replaceFile(vf)
+				self.add(vf)
+
+			if fullpaths and self.scanner.probe_cache:
+				self.scanner.probe_cache.save()
+
+	def get(self, index, block=True):
+		"""
+		Return the video files found after position index. If block is set, wait up to WAIT_TIMEOUT
+		seconds for one
+		"""
+		deadline = time.time() + WatchFeed.WAIT_TIMEOUT
+		with self.cond:
+			while block and len(self.videofiles) <= index and time.time() < deadline:
+				self.cond.wait(1)
+			return self.videofiles[index:]
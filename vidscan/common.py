@@ -2,6 +2,10 @@ import json
 import socket
 import hashlib
 import os
+import sys
+import time
+import threading
+import collections
 from colorama import Fore, Back, Style
 import logging
 
@@ -10,10 +14,16 @@ EXTENSION_WHITELIST = ['avi', 'mkv', 'mp4', 'm4v']
 DEBUG_SHORT_TRANSCODE = False
 DEBUG_LOG_ENABLE = False
 
+FRAGMENTED_MP4 = False
+PIPED_MKV = False
+
 class AppJsonEncoder(json.JSONEncoder):
 	def default(self, obj):
 		if hasattr(obj, '__dict__'):
 			return obj.__dict__
+		if hasattr(obj, '__slots__'):
+			return dict((name, getattr(obj, name)) for klass in type(obj).__mro__ 
+				for name in klass.__dict__.get('__slots__', ()) if hasattr(obj, name))
 
 		return json.JSONEncoder.default(self, obj)
 
@@ -29,6 +39,52 @@ def json_prettify(obj):
 def json_prettify_to_file(obj, file):
 	json.dump(obj, file, sort_keys=True, indent=4, separators=(',', ': '), cls=AppJsonEncoder)
 
+def json_compact(obj):
+	return json.dumps(obj, sort_keys=True, separators=(',', ':'), cls=AppJsonEncoder)
+
+class JsonListWriter(object):
+	"""
+	Writes a json list to a file one item at a time, formatted the same as json_prettify,
+	so the whole list never has to be in memory
+	"""
+	def __init__(self, file):
+		self.file = file
+		self.count = 0
+
+	def write(self, obj):
+		self.file.write(('[\n    ' if self.count == 0 else ',\n    ') + json_prettify(obj).replace('\n', '\n    '))
+		self.count += 1
+
+	def close(self):
+		self.file.write('\n]' if self.count else '[]')
+		self.file.flush()
+
+def duration_to_seconds(duration):
+	"""
+	Convert an ffmpeg duration (HH:MM:SS.cc) to seconds
+	"""
+	hour, minute, second = duration.split(':')
+	return float(hour) * 3600 + float(minute) * 60 + float(second)
+
+def seconds_to_duration(seconds):
+	"""
+	Format seconds as an ffmpeg duration (HH:MM:SS.cc)
+	"""
+	centiseconds = int(round(seconds * 100))
+	return '%02d:%02d:%02d.%02d' % (centiseconds // 360000, centiseconds // 6000 % 60, centiseconds // 100 % 60, centiseconds % 100)
+
+def write_file_atomic(path, write):
+	"""
+	Write a file through a temp file that is renamed over it, so readers never see a partial file.
+	write is called with the open temp file. The rename replaces the file atomically on POSIX,
+	Windows can't rename over an existing file so it's removed first there
+	"""
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as f:
+		write(f)
+	if os.name == 'nt' and os.path.isfile(path):
+		os.remove(path)
+	os.rename(tmp_path, path)
 
 def gethostname():
 	return socket.gethostname().split('.')[0]
@@ -44,6 +100,96 @@ def md5Checksum(filePath):
         return m.hexdigest()
 
 
+class Console(object):
+	"""
+	The terminal, shared by log messages and the progress of running jobs. Progress of all jobs is
+	batched into one status line that is redrawn at most once per RENDER_INTERVAL. Messages are
+	printed over it and the line comes back with the next redraw.
+	Once a LogWriter is attached, messages and redraws are queued to its thread like a log handler,
+	so jobs never wait on the terminal
+	"""
+	RENDER_INTERVAL = 1.0
+	# Handler interface for LogWriter
+	level = logging.NOTSET
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.progress = collections.OrderedDict()
+		self.last_render = 0
+		self.width = 0
+		self.writer = None
+		self.pid = None
+
+	def attach(self, writer):
+		self.writer = writer
+		# A forked process doesn't get the writer thread, it prints itself
+		self.pid = os.getpid()
+
+	def detach(self):
+		self.writer = None
+
+	def write(self, msg):
+		self.put('write', msg)
+
+	def set_progress(self, job, text):
+		with self.lock:
+			self.progress[job] = text
+			now = time.time()
+			if now - self.last_render < Console.RENDER_INTERVAL:
+				return
+			self.last_render = now
+		self.put('render')
+
+	def remove_progress(self, job):
+		with self.lock:
+			self.progress.pop(job, None)
+		self.put('clear')
+
+	def flush(self):
+		"""
+		Wait until the queued messages are on the terminal, e.g. before asking the user something
+		"""
+		writer = self.writer
+		if writer and self.pid == os.getpid():
+			writer.flush()
+
+	def put(self, op, msg=None):
+		record = logging.makeLogRecord({'name': __name__, 'levelno': logging.INFO, 'levelname': 'INFO',
+			'msg': msg, 'console_op': op})
+		writer = self.writer
+		if writer and self.pid == os.getpid():
+			writer.put([self], record)
+		else:
+			self.handle(record)
+
+	def handle(self, record):
+		# Records LogWriter makes itself, like the dropped records warning, are plain messages
+		op = getattr(record, 'console_op', 'write')
+		with self.lock:
+			if op == 'write':
+				self.clear()
+				print(record.getMessage())
+			elif op == 'render':
+				line = ' | '.join(self.progress.values())
+				self.clear()
+				if line:
+					sys.stdout.write(line + '\r')
+					sys.stdout.flush()
+					self.width = len(line)
+			else:
+				self.clear()
+
+	def handleError(self, record):
+		pass
+
+	def clear(self):
+		if self.width:
+			sys.stdout.write(' ' * self.width + '\r')
+			sys.stdout.flush()
+			self.width = 0
+
+console = Console()
+
 class AppLogger(object):
 	COLOR_MAP = {
 		'red' : Fore.RED,
@@ -62,22 +208,22 @@ class AppLogger(object):
 		self.logger.debug(msg)
 		if DEBUG_LOG_ENABLE:
 			if fore_color:
-				print(AppLogger.COLOR_MAP[fore_color.lower()] + msg)
+				console.write(AppLogger.COLOR_MAP[fore_color.lower()] + msg)
 			else:
-				print(msg)
+				console.write(msg)
 
 	def info(self, msg, fore_color=None):
 		self.logger.info(msg)
 		if fore_color:
-			print(AppLogger.COLOR_MAP[fore_color.lower()] + msg)
+			console.write(AppLogger.COLOR_MAP[fore_color.lower()] + msg)
 		else:
-			print(msg)
+			console.write(msg)
 
 	def warn(self, msg):
 		self.logger.warn(msg)
-		print(Fore.MAGENTA + msg)
+		console.write(Fore.MAGENTA + msg)
 
 	def error(self, msg):
 		self.logger.error(msg)
-		print(Fore.RED + msg)
+		console.write(Fore.RED + msg)
 
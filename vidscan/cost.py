@@ -0,0 +1,93 @@
+import re
+import hashlib
+
+from VideoFile import VideoFileOp
+
+"""
+Static estimates of how long a job takes, in seconds on a reference machine. They are only
+used to compare jobs with each other so rough numbers are fine
+"""
+# 1080p x264 veryfast runs at about 2.5x realtime on the reference machine
+REFERENCE_PIXELS = 1920 * 1080
+REFERENCE_VIDEO_SPEED = 2.5
+# Audio transcodes run far faster than realtime
+AUDIO_SPEED = 100.0
+# Stream copies are bound by reading and writing the file
+COPY_BYTES_PER_SECOND = 100 * 1024 * 1024
+
+RESOLUTION_RE = re.compile('(\d+)x(\d+)')
+
+def get_pixels(v_resolution):
+	"""
+	Number of pixels per frame of a resolution like 1920x1080 [SAR 1:1 DAR 16:9], or None if unknown
+	"""
+	match = RESOLUTION_RE.search(v_resolution or '')
+	if match:
+		return int(match.group(1)) * int(match.group(2))
+	return None
+
+def resolution_class(v_resolution):
+	pixels = get_pixels(v_resolution)
+	if pixels is None:
+		return 'unknown'
+	if pixels <= 720 * 576:
+		return 'SD'
+	if pixels <= 1280 * 720:
+		return 'HD'
+	if pixels <= 1920 * 1080:
+		return 'FHD'
+	return 'UHD'
+
+def job_class(videofile):
+	"""
+	video, audio or copy depending on the most expensive operation the job needs
+	"""
+	if videofile.op_flag & VideoFileOp.TRANSCODE_VIDEO:
+		return 'video'
+	if videofile.op_flag & VideoFileOp.TRANSCODE_AUDIO:
+		return 'audio'
+	return 'copy'
+
+def estimate_cost(videofile, job_class_name=None):
+	"""
+	Seconds the job takes on the reference machine. job_class_name overrides the job class of the file,
+	e.g. to estimate re-encoding a file that only needs a stream copy
+	"""
+	job_class_name = job_class_name or job_class(videofile)
+	duration = videofile.duration or 0.0
+	copy_cost = float(videofile.size or 0) / COPY_BYTES_PER_SECOND
+
+	if job_class_name == 'video':
+		pixels = get_pixels(videofile.v_resolution) or REFERENCE_PIXELS
+		return duration * pixels / REFERENCE_PIXELS / REFERENCE_VIDEO_SPEED
+	if job_class_name == 'audio':
+		return duration / AUDIO_SPEED + copy_cost
+	return copy_cost
+
+"""
+Ordering policies for the work queue. Each maps to a sort key, or None to keep the scan order.
+Ties are broken by relpath so the order only depends on the files, see order_for_host()
+"""
+ORDER_POLICIES = {
+	'walk': None,
+	'longest': lambda videofile: (-estimate_cost(videofile), videofile.relpath),
+	'shortest': lambda videofile: (estimate_cost(videofile), videofile.relpath)
+}
+# Number of consecutive files of the sorted queue that instances take in different orders
+STRIPE_LENGTH = 8
+
+def order_for_host(videofiles, key, instance_name):
+	"""
+	Sort files by a policy key, then rotate each stripe of STRIPE_LENGTH files by an offset taken from
+	the instance name. Every instance keeps the coarse order but starts on a different file of each
+	stripe, so they don't all go for the same head item. The files are sorted as they are queued,
+	in stream and watch mode that's within each batch found by the scan
+	"""
+	ordered = sorted(videofiles, key=key)
+	offset = int(hashlib.md5(instance_name).hexdigest()[:8], 16)
+	result = []
+	for start in range(0, len(ordered), STRIPE_LENGTH):
+		stripe = ordered[start:start + STRIPE_LENGTH]
+		shift = offset % len(stripe)
+		result.extend(stripe[shift:] + stripe[:shift])
+	return result
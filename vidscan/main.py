@@ -11,17 +11,34 @@ import re
 import os
 import io
 import cStringIO
+import atexit
 
 vidscan_log_file = os.path.join(os.path.expanduser("~"), 'vidscan.log')
+ffmpeg_log_file = os.path.join(os.path.expanduser("~"), 'vidscan-ffmpeg.log')
 logconf_file = os.path.join(os.path.dirname(__file__), 'logging.conf')
-logging.config.fileConfig(logconf_file, disable_existing_loggers=True, defaults = {'logFilePath': vidscan_log_file})
+logging.config.fileConfig(logconf_file, disable_existing_loggers=True, defaults = {'logFilePath': vidscan_log_file, 'ffmpegLogFilePath': ffmpeg_log_file})
 
+# Log files and console output are written by a background thread so slow home directories and
+# terminals never hold up the transcoders
+from vidscan import LogQueue
 from vidscan import common
+atexit.register(LogQueue.install([logging.getLogger(), logging.getLogger('vidscan.ffmpeg')], common.console).stop)
+
 from common import AppLogger
 from vidscan.VideoFile import VideoFile, VideoFileOp
-from vidscan.Scanner import SourceScanner
-from vidscan.Transcoder import FFmpegTranscoder
-from vidscan.Scheduler import Scheduler
+from vidscan.Scanner import SourceScanner, ScanFeed
+from vidscan.Watcher import WatchFeed
+from vidscan.ProbeCache import ProbeCache
+from vidscan.Walker import Walker
+from vidscan.Transcoder import FFmpegTranscoder, PRESET, CRF
+from vidscan.Autotune import Autotuner
+from vidscan.Stager import Stager
+from vidscan.Scheduler import Scheduler, StatusIndex
+from vidscan.Estimator import Estimator, format_time, format_size
+from vidscan.cost import ORDER_POLICIES
+from vidscan.Metrics import TextfileExporter, HttpExporter
+from vidscan.Coordinator import CoordinatorServer, CoordinatorClient
+from vidscan.Scheduler import CoordinatorError
 
 colorama.init(autoreset=True)
 log = AppLogger(__name__)
@@ -47,18 +64,134 @@ Misc:
 	-y					Attempt to transcode without prompting for confirmation
 	-f, --datafile FILE			Save list of detected videos to FILE (in JSON format)
 	-w, --whatif				Do a dry run to see proposed changes. No files will be transcoded with this option 
+	--hosts N				Estimate the --whatif encode time for N computers (default: the computers that
+						finished jobs in the --dst status files, or 1)
+
+Output:
+	--fragmented-mp4			Write fragmented mp4 so mp4 output can be checksummed while it's written
+	--piped-mkv				Write mkv through a pipe so it can be checksummed while it's written.
+						The mkv has no seek index or duration
+
+Performance:
+	--scan-jobs N				Probe up to N source files concurrently (default 1)
+	-j, --jobs N				Run N transcodes concurrently on this computer (default 1)
+	--autotune				Benchmark this computer once and pick the x264 threads per job and the number of
+						concurrent jobs for each resolution (cached in ~/.vidscan/autotune.<host>.json)
+	--segment-length SECONDS		Split video transcodes longer than SECONDS into segments that any computer can encode
+	--checkpoint-interval SECONDS		Encode video in chunks of SECONDS so interrupted transcodes continue from the last
+						finished chunk (default 0, always start over)
+	--order POLICY				Transcode in scan order ("walk", default), most expensive first ("longest")
+						or cheapest first ("shortest")
+	--no-routing				Take queued files in order. By default computers that are faster than the others
+						prefer expensive jobs and slower ones cheap jobs (see _profile.<host>.json in DIR)
+	--stage-dir DIR				Copy the next source files to DIR on a local disk while the current ones encode,
+						so ffmpeg doesn't read from a slow network share
+	--stage-budget GB			Use at most GB gigabytes of DIR for staged files (default 20)
+	--stream				Start transcoding as soon as the first eligible file is scanned
+	--watch					Keep running after the scan and transcode new source files as they appear
+	--probe-cache FILE			Cache probe results in FILE (default ~/.vidscan/probecache.<id>.json)
+	--no-probe-cache			Probe every source file even if it hasn't changed, and list every source folder
+	--ignore GLOB				Skip source files and folders whose name matches GLOB. Can be given more than once
+	--probe-backend NAME			Probe with "ffprobe" json output (default) or by parsing "ffmpeg" -i output
+
+Coordination:
+	--coordinator ADDRESS			Claim jobs and share status through the coordinator at ADDRESS (host:port or unix:path)
+						instead of lock and status files. Falls back to the files if it can't be reached
+	--serve-coordinator ADDRESS		Run a coordinator for the --dst folder on ADDRESS
+
+Monitoring:
+	--metrics-file FILE			Write Prometheus metrics to FILE every 15 seconds (e.g. for the node_exporter textfile collector)
+	--metrics-port PORT			Serve Prometheus metrics on http://<host>:PORT/metrics
 '''.strip()
 
 
+def print_scan_summary(result, probe_cache):
+	log.info('# Extensions Found:', 'yellow')
+	log.info(common.json_prettify(result.extension_count_map))
+
+	log.info('# Video Codecs Found:', 'yellow')
+	log.info(common.json_prettify(result.v_codec_count_map))
+
+	log.info('# Audio Codecs Found:', 'yellow')
+	log.info(common.json_prettify(result.a_codec_count_map))
+
+	if probe_cache:
+		log.info('# Probe Cache:', 'yellow')
+		log.info('hits = ' + str(result.cache_hits) + ', misses = ' + str(result.cache_misses) + ', evicted = ' + str(result.cache_evicted))
+
+def print_estimate(estimator, videofiles, num_hosts):
+	log.info('# Estimate:', 'yellow')
+	if estimator.samples:
+		log.info('Learned from ' + str(estimator.samples) + ' finished jobs on ' + str(len(estimator.hosts())) + (' computer' if len(estimator.hosts()) == 1 else ' computers'))
+		for host in estimator.hosts():
+			speeds = []
+			for job_class_name in ('video', 'audio', 'copy'):
+				speed = estimator.host_speed(host, job_class_name)
+				if speed:
+					speeds.append(job_class_name + ' ' + ('%.1f' % speed) + 'x realtime')
+			log.info('\t' + host + ': ' + ', '.join(speeds) + ' (' + str(estimator.concurrency[host]) + ' jobs at a time)')
+	else:
+		log.info('No finished jobs to learn from. Using reference machine speeds')
+
+	num_hosts = num_hosts or max(1, len(estimator.hosts()))
+	prediction = estimator.predict(videofiles, num_hosts)
+	log.info('Encode time: ' + format_time(prediction['wall']) + ' on ' + str(num_hosts) + (' computer (' if num_hosts == 1 else ' computers (') + format_time(prediction['seconds']) + ' of jobs)')
+	log.info('Output size: ' + format_size(prediction['size']) + ' (source ' + format_size(prediction['source_size']) + ')')
+	log.info('Audio only transcodes save ' + format_time(prediction['audio_savings']) + ' compared to also encoding their video')
+	log.info('Files that need no transcode save ' + format_time(prediction['copy_savings']))
+
+def get_autotuner(autotune):
+	if not autotune:
+		return None
+	return Autotuner(PRESET, CRF).tune()
+
+def get_stager(stage_dir, stage_budget):
+	if not stage_dir:
+		return None
+	stager = Stager(stage_dir, stage_budget).start()
+	atexit.register(stager.stop)
+	return stager
+
+def prompt_continue(question):
+	do_continue = None
+	common.console.flush()
+	while not do_continue:
+		do_continue = raw_input(colored(question, 'yellow'))
+		if do_continue not in ['y','n']:
+			print 'Invalid choice: ' + do_continue + '. Please try again.'
+			do_continue = None
+
+	return do_continue.strip().lower() == 'y'
+
 def main():
 
 	srcdir = None 
 	dstdir = None
 	yestranscode = None
 	whatif = None
+	num_hosts = None
 	datafile = None
+	scan_jobs = 1
+	probe_cache_file = None
+	use_probe_cache = True
+	stream = False
+	watch = False
+	ignore = []
+	jobs = None
+	autotune = False
+	probe_backend = 'ffprobe'
+	segment_length = None
+	checkpoint_interval = Scheduler.CHECKPOINT_INTERVAL
+	routing = True
+	stage_dir = None
+	stage_budget = Stager.BUDGET
+	order = 'walk'
+	metrics_file = None
+	metrics_port = None
+	coordinator_address = None
+	serve_coordinator = None
 	try:
-		optlist, args = getopt.getopt(sys.argv[1:],"hs:d:ywf:",["help","src=", "dst=","","whatif","datafile","debug-short-transcode", "debug-log-enable"])
+		optlist, args = getopt.getopt(sys.argv[1:],"hs:d:ywf:j:",["help","src=", "dst=","","whatif","hosts=","datafile","debug-short-transcode", "debug-log-enable", "scan-jobs=", "probe-cache=", "no-probe-cache", "fragmented-mp4", "piped-mkv", "stream", "jobs=", "probe-backend=", "segment-length=", "checkpoint-interval=", "no-routing", "stage-dir=", "stage-budget=", "order=", "metrics-file=", "metrics-port=", "coordinator=", "serve-coordinator=", "watch", "autotune", "ignore="])
 	except getopt.GetoptError as e:
 		print 'Input error: ' + e.msg
 		usage();
@@ -75,8 +208,109 @@ def main():
 			yestranscode = True
 		elif opt in ('-w', '--whatif'):
 			whatif = True
+		elif opt == '--hosts':
+			try:
+				num_hosts = int(arg)
+			except ValueError:
+				num_hosts = 0
+			if num_hosts < 1:
+				print 'invalid number of hosts: ' + arg
+				usage()
+				sys.exit(2)
 		elif opt in ('-f', '--datafile'):
 			datafile = arg
+		elif opt == '--scan-jobs':
+			try:
+				scan_jobs = int(arg)
+			except ValueError:
+				scan_jobs = 0
+			if scan_jobs < 1:
+				print 'invalid number of scan jobs: ' + arg
+				usage()
+				sys.exit(2)
+		elif opt == '--probe-cache':
+			probe_cache_file = arg
+		elif opt == '--no-probe-cache':
+			use_probe_cache = False
+		elif opt == '--ignore':
+			ignore.append(arg)
+		elif opt == '--probe-backend':
+			if arg not in ('ffprobe', 'ffmpeg'):
+				print 'invalid probe backend: ' + arg
+				usage()
+				sys.exit(2)
+			probe_backend = arg
+		elif opt in ('-j', '--jobs'):
+			try:
+				jobs = int(arg)
+			except ValueError:
+				jobs = 0
+			if jobs < 1:
+				print 'invalid number of jobs: ' + arg
+				usage()
+				sys.exit(2)
+		elif opt == '--autotune':
+			autotune = True
+		elif opt == '--segment-length':
+			try:
+				segment_length = int(arg)
+			except ValueError:
+				segment_length = 0
+			if segment_length < 1:
+				print 'invalid segment length: ' + arg
+				usage()
+				sys.exit(2)
+		elif opt == '--checkpoint-interval':
+			try:
+				checkpoint_interval = int(arg)
+			except ValueError:
+				checkpoint_interval = -1
+			if checkpoint_interval < 0:
+				print 'invalid checkpoint interval: ' + arg
+				usage()
+				sys.exit(2)
+		elif opt == '--no-routing':
+			routing = False
+		elif opt == '--stage-dir':
+			stage_dir = arg
+		elif opt == '--stage-budget':
+			try:
+				stage_budget = int(arg) * 1073741824
+			except ValueError:
+				stage_budget = 0
+			if stage_budget < 1:
+				print 'invalid stage budget: ' + arg
+				usage()
+				sys.exit(2)
+		elif opt == '--order':
+			if arg not in ORDER_POLICIES:
+				print 'invalid order: ' + arg
+				usage()
+				sys.exit(2)
+			order = arg
+		elif opt == '--metrics-file':
+			metrics_file = arg
+		elif opt == '--metrics-port':
+			try:
+				metrics_port = int(arg)
+			except ValueError:
+				metrics_port = 0
+			if not 0 < metrics_port < 65536:
+				print 'invalid metrics port: ' + arg
+				usage()
+				sys.exit(2)
+		elif opt == '--coordinator':
+			coordinator_address = arg
+		elif opt == '--serve-coordinator':
+			serve_coordinator = arg
+		elif opt == '--stream':
+			stream = True
+		elif opt == '--watch':
+			watch = True
+		elif opt == '--fragmented-mp4':
+			common.FRAGMENTED_MP4 = True
+		elif opt == '--piped-mkv':
+			common.PIPED_MKV = True
 		elif opt == '--debug-short-transcode':
 			log.warn('DEBUG_SHORT_TRANSCODE On')
 			common.DEBUG_SHORT_TRANSCODE = True
@@ -87,6 +321,13 @@ def main():
 			print 'invalid option: ' + opt
 			usage()
 			sys.exit(2)
+	if serve_coordinator:
+		if not dstdir or not os.path.isdir(dstdir):
+			print 'missing or invalid destination'
+			usage()
+			sys.exit(2)
+		CoordinatorServer(dstdir, serve_coordinator).serve_forever()
+		sys.exit()
 	if not srcdir or not os.path.isdir(srcdir):
 		print 'missing or invalid source'
 		usage()
@@ -113,6 +354,22 @@ def main():
 	cprint('Logging to ' + vidscan_log_file, 'cyan')
 	log.info('Source dir is ' + srcdir, 'yellow')
 
+	"""
+	Metrics
+	"""
+	if metrics_file:
+		atexit.register(TextfileExporter(metrics_file).start().stop)
+	if metrics_port:
+		atexit.register(HttpExporter(metrics_port).start().stop)
+
+	coordinator = None
+	if coordinator_address:
+		try:
+			coordinator = CoordinatorClient(coordinator_address, common.gethostname()).connect()
+			log.info('Connected to coordinator at ' + coordinator_address)
+		except CoordinatorError as e:
+			log.warn(e.value + '. Using status files instead')
+
 	"""
 	Scanner
 	"""
@@ -120,7 +377,42 @@ def main():
 	if datafile:
 		data_out = open(datafile, 'w')
 
-	result = SourceScanner(srcdir, data_out).run()
+	probe_cache = None
+	if use_probe_cache:
+		probe_cache = ProbeCache(probe_cache_file or ProbeCache.default_path(srcdir), srcdir)
+
+	# Never scan our own output when the destination is inside the source folder
+	walker = Walker(srcdir, [dstdir] if dstdir else [], ignore, Walker.default_path(srcdir) if use_probe_cache else None)
+
+	scanner = SourceScanner(srcdir, data_out, scan_jobs, probe_cache, probe_backend, walker)
+
+	if (stream or watch) and not whatif:
+		"""
+		Streaming mode. Scan in the background and transcode files as soon as they are found.
+		In watch mode the source folder keeps being watched for new files after the scan
+		"""
+		if not yestranscode and not prompt_continue('\nTranscode files as soon as they are found (y/n) ? '):
+			log.info('Exiting as per user command')
+			sys.exit()
+
+		if not os.path.isdir(dstdir):
+			os.makedirs(dstdir)
+
+		feed = WatchFeed(scanner).start() if watch else ScanFeed(scanner).start()
+		scheduler = Scheduler(feed, dstdir, segment_length, order, coordinator, checkpoint_interval, routing)
+
+		log.info('Initializing transcoder...')
+		FFmpegTranscoder(dstdir, feed, scheduler, jobs, get_autotuner(autotune), get_stager(stage_dir, stage_budget)).run()
+		feed.join()
+
+		if data_out:
+			data_out.close()
+
+		print_scan_summary(scanner.result, probe_cache)
+		log.info('Finished transcoding. Exiting.')
+		sys.exit()
+
+	result = scanner.run()
 
 	if data_out:
 		data_out.close()
@@ -131,9 +423,23 @@ def main():
 	"""
 	completed_dict = {}
 	scheduler = None
+	estimator = None
+
+	if whatif:
+		# Learn encode speeds and output sizes from the jobs that already finished
+		estimator = Estimator()
+		if dstdir and os.path.isdir(dstdir):
+			status_index = StatusIndex(dstdir)
+			status_index.refresh()
+			estimator.learn(status_index.values(), dstdir)
+
+			# Only the remaining files are listed and estimated
+			for tupl in status_index.values():
+				if tupl[2].status in ('SUCCESS', 'FAIL'):
+					completed_dict[tupl[1].relpath] = tupl
 
 	if not whatif:
-		scheduler = Scheduler(result.videofiles, dstdir)
+		scheduler = Scheduler(result.videofiles, dstdir, segment_length, order, coordinator, checkpoint_interval, routing)
 
 
 		for tupl in scheduler.get_completed_list():
@@ -147,14 +453,7 @@ def main():
 	"""
 	Print scanner and scheduler info
 	"""
-	log.info('# Extensions Found:', 'yellow')
-	log.info(common.json_prettify(result.extension_count_map))
-
-	log.info('# Video Codecs Found:', 'yellow')
-	log.info(common.json_prettify(result.v_codec_count_map))
-
-	log.info('# Audio Codecs Found:', 'yellow')
-	log.info(common.json_prettify(result.a_codec_count_map))
+	print_scan_summary(result, probe_cache)
 
 	log.info('Previously Completed Transcodes:', 'yellow')
 	if len(completed_dict) > 0:
@@ -179,9 +478,12 @@ def main():
 				log.info('\tVideo: ' + vf.v_codec + ' --> h264 (High) [mp4]')
 			if vf.op_flag & VideoFileOp.TRANSCODE_AUDIO:
 				log.info('\tAudio: ' + vf.a_codec + ' --> aac')
+			if estimator:
+				log.info('\tEstimate: ' + format_time(estimator.estimate_seconds(vf)) + ', ' + format_size(estimator.estimate_size(vf)))
 
 	if whatif:
 		log.info('Found ' + str(num_transcode) + ' files to transcode')
+		print_estimate(estimator, [vf for vf in result.videofiles if vf.relpath not in completed_dict], num_hosts)
 		log.info('Running in "whatif" mode. Exiting.', 'cyan')
 		sys.exit()
 	
@@ -189,17 +491,7 @@ def main():
 		log.info('No transcoding needed. Exiting.', 'cyan')
 		sys.exit()
 
-	do_continue = None
-	if yestranscode:
-		do_continue = 'y'
-
-	while not do_continue:
-		do_continue = raw_input(colored('\nFound ' + str(num_transcode) + ' files to transcode. Do you wish to Continue (y/n) ? ', 'yellow'))
-		if do_continue not in ['y','n']:
-			print 'Invalid choice: ' + do_continue + '. Please try again.'
-			do_continue = None
-
-	if do_continue.strip().lower() != 'y':
+	if not yestranscode and not prompt_continue('\nFound ' + str(num_transcode) + ' files to transcode. Do you wish to Continue (y/n) ? '):
 		log.info('Exiting as per user command')
 		sys.exit()
 
@@ -207,7 +499,7 @@ def main():
 		os.makedirs(dstdir)
 
 	log.info('Initializing transcoder...')
-	FFmpegTranscoder(dstdir, result.videofiles, scheduler).run()
+	FFmpegTranscoder(dstdir, result.videofiles, scheduler, jobs, get_autotuner(autotune), get_stager(stage_dir, stage_budget)).run()
 	log.info('Finished transcoding. Exiting.')
 	
 if __name__ == "__main__":